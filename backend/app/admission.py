@@ -0,0 +1,326 @@
+# Cost-based admission control in front of the analysis pipeline
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Callable, Hashable, Tuple
+from app.utils.logger import get_logger
+from app.utils.metrics import track_stage
+
+logger = get_logger(__name__)
+
+MB = 1024 * 1024
+
+
+def _node_memory_bytes() -> Optional[int]:
+    """Memory limit of the container (cgroup v2, then v1), else the machine's physical memory."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # "max" and v1's near-2^63 sentinel both mean unlimited
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# uvicorn's --workers; each worker process admits against its share of the node
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+# Share of the node's memory analyses may use, unless ADMISSION_MEMORY_BUDGET_MB sets this worker's budget
+ADMISSION_MEMORY_FRACTION = float(os.getenv("ADMISSION_MEMORY_FRACTION", "0.6"))
+ADMISSION_MEMORY_BUDGET_MB = float(os.getenv("ADMISSION_MEMORY_BUDGET_MB", "0"))
+# Analyses running at once per worker (0: twice the worker's share of the CPUs, as jobs also wait on I/O)
+ADMISSION_CPU_SLOTS = int(os.getenv("ADMISSION_CPU_SLOTS", "0"))
+# Queued jobs wait at most this long, and at most this many wait, before being turned away
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "120"))
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "100"))
+# Jobs estimated above this share of the budget take the chunked path where they can
+ADMISSION_CHUNKED_FRACTION = float(os.getenv("ADMISSION_CHUNKED_FRACTION", "0.5"))
+# Rows per chunk on the chunked path
+ADMISSION_CHUNK_ROWS = int(os.getenv("ADMISSION_CHUNK_ROWS", "500000"))
+
+# Cost model. Peak memory of a job is a multiple of its loaded frame (parsing, filtering and
+# aggregation copies); CSVs are also held as raw bytes while parsing
+MEMORY_FACTOR = float(os.getenv("ADMISSION_MEMORY_FACTOR", "5"))
+CELL_BYTES = {'integer': 8, 'float': 8, 'datetime': 8, 'boolean': 1}
+STRING_CELL_BYTES = 32
+# Peak bytes per event row of building a cohort index (entries plus the sort scratch of the final merge)
+INDEX_BYTES_PER_ROW = 128
+# Bytes per index entry of answering a query from a built index
+INDEX_QUERY_BYTES_PER_ENTRY = 48
+CPU_SECONDS_PER_CELL = 200e-9
+# Compressed CSVs the schema sample didn't cover: assumed ratio and bytes per uncompressed row
+CSV_COMPRESSION_RATIO = 4
+CSV_ROW_BYTES = 64
+# Jobs whose size can't be estimated (database sources)
+DEFAULT_JOB_MB = float(os.getenv("ADMISSION_DEFAULT_JOB_MB", "256"))
+
+# Lower runs first
+PRIORITY_PREVIEW = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BATCH = 2
+PRIORITY_WARMUP = 3
+
+
+class AdmissionRejected(Exception):
+    """Raised when a job can't be admitted: the queue is full or the job waited too long."""
+
+
+class JobCost:
+    """Estimated peak memory and CPU time of one analysis, and the CPU slots it runs on."""
+
+    def __init__(
+        self,
+        memory_bytes: int,
+        cpu_seconds: float,
+        rows: Optional[int] = None,
+        columns: Optional[int] = None,
+        slots: int = 1
+    ):
+        self.memory_bytes = int(memory_bytes)
+        self.cpu_seconds = cpu_seconds
+        self.rows = rows
+        self.columns = columns
+        self.slots = max(1, int(slots))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "memory_mb": round(self.memory_bytes / MB, 1),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "rows": self.rows,
+            "columns": self.columns,
+            "slots": self.slots,
+        }
+
+
+def estimate_rows(file_size: int, ext: str, schema: Optional[Dict[str, Any]], profiled_rows: Optional[int]) -> int:
+    """Row count of an upload: profiled by an earlier analysis, from the schema sample, else guessed from its size."""
+    if profiled_rows is not None:
+        return profiled_rows
+    if schema and schema.get("estimated_rows") is not None:
+        return schema["estimated_rows"]
+    ratio = 1 if ext == '.csv' else CSV_COMPRESSION_RATIO
+    return int(file_size * ratio / CSV_ROW_BYTES)
+
+
+def estimate_cost(rows: int, column_types: List[str], raw_bytes: int = 0) -> JobCost:
+    """Cost of loading rows x columns (inferred types as in the upload schema) and analysing them."""
+    frame_bytes = rows * sum(CELL_BYTES.get(t, STRING_CELL_BYTES) for t in column_types)
+    return JobCost(
+        frame_bytes * MEMORY_FACTOR + raw_bytes,
+        rows * len(column_types) * CPU_SECONDS_PER_CELL,
+        rows,
+        len(column_types)
+    )
+
+
+def chunked_cost(rows: int, column_types: List[str], chunk_rows: int = ADMISSION_CHUNK_ROWS) -> JobCost:
+    """Cost of scanning the columns in chunks into a cohort index and querying it."""
+    chunk = estimate_cost(min(rows, chunk_rows), column_types)
+    return JobCost(
+        chunk.memory_bytes + rows * INDEX_BYTES_PER_ROW,
+        rows * len(column_types) * CPU_SECONDS_PER_CELL,
+        rows,
+        len(column_types)
+    )
+
+
+def indexed_cost(entries: int) -> JobCost:
+    """Cost of an analysis served from a cohort index of the given number of entries."""
+    return JobCost(entries * INDEX_QUERY_BYTES_PER_ENTRY, entries * CPU_SECONDS_PER_CELL, entries)
+
+
+def batch_cost(single: JobCost, configs: int, concurrent: int) -> JobCost:
+    """
+    Cost of a batch of configs analysing one shared frame, concurrent of them at a time.
+
+    single is the cost of one analysis: its loaded frame plus MEMORY_FACTOR - 1
+    frames of working set. The frame is loaded once, but every config running
+    at once holds its own working set (filtered copy, period columns, dedup
+    frame) and CPU slot.
+    """
+    concurrent = max(1, min(configs, concurrent))
+    working_set = single.memory_bytes * (MEMORY_FACTOR - 1) / MEMORY_FACTOR
+    return JobCost(
+        single.memory_bytes + (concurrent - 1) * working_set,
+        single.cpu_seconds * configs,
+        single.rows,
+        single.columns,
+        slots=concurrent
+    )
+
+
+def default_cost() -> JobCost:
+    return JobCost(DEFAULT_JOB_MB * MB, 0.0)
+
+
+def _memory_budget() -> int:
+    if ADMISSION_MEMORY_BUDGET_MB > 0:
+        return int(ADMISSION_MEMORY_BUDGET_MB * MB)
+    node = _node_memory_bytes() or 4096 * MB
+    return int(node * ADMISSION_MEMORY_FRACTION / WORKERS)
+
+
+class AdmissionController:
+    """
+    Admits analyses against a memory budget and a number of CPU slots.
+
+    Each job states its estimated cost when it asks to run and holds that much
+    of the budget (and one slot) until it finishes; a job estimated above the
+    whole budget holds all of it, i.e. runs alone. Waiting jobs form a priority
+    queue ordered by priority class, then by virtual deadline (arrival plus
+    estimated CPU time), so short jobs overtake long ones that arrived just
+    before them without starving them. Only the head of the queue is admitted,
+    so a large job is never passed over indefinitely by smaller ones.
+
+    Caches holding data between jobs (warmed frames) charge it with hold(); when
+    the head of the queue doesn't fit, held entries are evicted oldest first
+    to make room.
+    """
+
+    def __init__(
+        self,
+        memory_budget: Optional[int] = None,
+        cpu_slots: int = ADMISSION_CPU_SLOTS,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+        max_queued: int = ADMISSION_MAX_QUEUED,
+        chunked_fraction: float = ADMISSION_CHUNKED_FRACTION
+    ):
+        self.memory_budget = memory_budget if memory_budget is not None else _memory_budget()
+        self.cpu_slots = cpu_slots or max(2, 2 * (os.cpu_count() or 1) // WORKERS)
+        self.queue_timeout = queue_timeout
+        self.max_queued = max_queued
+        self.chunked_fraction = chunked_fraction
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._queue: List[tuple] = []
+        self._sequence = itertools.count()
+        self._memory_in_use = 0
+        self._running = 0
+        self._held: "OrderedDict[Hashable, Tuple[int, Callable[[], None]]]" = OrderedDict()
+        self._memory_held = 0
+        self._counts = {"admitted": 0, "rejected": 0, "evicted": 0}
+
+    def oversized(self, cost: JobCost) -> bool:
+        """Whether the job should take the chunked path instead of loading its data whole."""
+        return cost.memory_bytes > self.memory_budget * self.chunked_fraction
+
+    @contextmanager
+    def admit(self, cost: JobCost, priority: int = PRIORITY_INTERACTIVE):
+        """Block until the job may run, then hold its share of the budget for the duration of the block."""
+        memory = min(cost.memory_bytes, self.memory_budget)
+        # Like memory, a job wanting more slots than there are runs alone
+        slots = min(cost.slots, self.cpu_slots)
+        with track_stage("queue"):
+            self._acquire(memory, priority, cost.cpu_seconds, slots)
+        try:
+            yield
+        finally:
+            with self._changed:
+                self._memory_in_use -= memory
+                self._running -= slots
+                self._changed.notify_all()
+
+    def hold(self, key: Hashable, memory_bytes: int, evict: Callable[[], None]) -> None:
+        """
+        Charge memory a cache keeps between jobs to the budget until release(key).
+
+        evict() is called, with the controller's lock held, when a queued job
+        needs the room; it must drop the cached data without calling back into
+        the controller.
+        """
+        memory = min(int(memory_bytes), self.memory_budget)
+        with self._changed:
+            previous = self._held.pop(key, None)
+            if previous is not None:
+                self._memory_held -= previous[0]
+            self._held[key] = (memory, evict)
+            self._memory_held += memory
+            self._changed.notify_all()
+
+    def release(self, key: Hashable) -> None:
+        """Stop charging memory held for key (the cache dropped it itself)."""
+        with self._changed:
+            entry = self._held.pop(key, None)
+            if entry is not None:
+                self._memory_held -= entry[0]
+                self._changed.notify_all()
+
+    def _reclaim(self, memory: int) -> bool:
+        """Evict held entries, oldest first, until a job of memory fits; whether any was evicted."""
+        # Caller holds the lock
+        evicted = False
+        while self._held and self._memory_in_use + self._memory_held + memory > self.memory_budget:
+            key, (held, evict) = self._held.popitem(last=False)
+            self._memory_held -= held
+            self._counts["evicted"] += 1
+            evicted = True
+            try:
+                evict()
+            except Exception as e:
+                logger.warning(f"Evicting {key} failed: {str(e)}")
+        return evicted
+
+    def _fits(self, memory: int, slots: int) -> bool:
+        return (
+            self._running + slots <= self.cpu_slots
+            and self._memory_in_use + self._memory_held + memory <= self.memory_budget
+        )
+
+    def _acquire(self, memory: int, priority: int, cpu_seconds: float, slots: int = 1) -> None:
+        now = time.monotonic()
+        deadline = now + self.queue_timeout
+        with self._changed:
+            if len(self._queue) >= self.max_queued:
+                self._counts["rejected"] += 1
+                raise AdmissionRejected(f"Analysis queue is full ({self.max_queued} jobs waiting)")
+            entry = (priority, now + cpu_seconds, next(self._sequence))
+            heapq.heappush(self._queue, entry)
+            try:
+                while self._queue[0] is not entry or not self._fits(memory, slots):
+                    if self._queue[0] is entry and self._running + slots <= self.cpu_slots and self._reclaim(memory):
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counts["rejected"] += 1
+                        raise AdmissionRejected(f"No capacity for the analysis within {self.queue_timeout:.0f}s")
+                    self._changed.wait(remaining)
+            except BaseException:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._changed.notify_all()
+                raise
+            heapq.heappop(self._queue)
+            self._memory_in_use += memory
+            self._running += slots
+            self._counts["admitted"] += 1
+            # The next job in line may fit as well
+            self._changed.notify_all()
+        if time.monotonic() - now > 1:
+            logger.info(f"Analysis admitted after {time.monotonic() - now:.1f}s in the queue", extra={
+                "memory_mb": round(memory / MB, 1), "priority": priority,
+            })
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_budget_mb": round(self.memory_budget / MB, 1),
+                "memory_in_use_mb": round(self._memory_in_use / MB, 1),
+                "memory_held_mb": round(self._memory_held / MB, 1),
+                "cpu_slots": self.cpu_slots,
+                "running": self._running,
+                "queued": len(self._queue),
+                **self._counts,
+            }
+
+
+# Global instance
+admission_controller = AdmissionController()
@@ -1,13 +1,30 @@
+import numpy as np
 import pandas as pd
 from typing import Dict, Any, Optional
 from pathlib import Path
 from app.utils.preprocessing import preprocess_dataframe
 from app.chart_generation import chart_service
 from app.utils.logger import get_logger
+from app.utils.metrics import track_stage
+from app.utils.compact import row_lengths, encode_matrix, round_values
+from app.utils.result_store import result_store
+from app.utils.hll import HLLSketchMatrix, hash_users, DEFAULT_PRECISION
 
 
 logger = get_logger(__name__)
 
+# Rows hashed into the HyperLogLog sketches at a time in approximate mode
+SKETCH_CHUNK_ROWS = 1_000_000
+# Users are sampled by hash bucket, so the same users are picked on every run
+SAMPLE_BUCKETS = 10_000
+# z for the 95% confidence intervals of sampled retention rates
+CONFIDENCE_Z = 1.96
+# Segments beyond the largest top_k (by distinct users) are merged into one bucket
+DEFAULT_SEGMENT_TOP_K = 10
+OTHER_SEGMENT = "(other)"
+# Rows without a segment value get their own bucket instead of being dropped
+MISSING_SEGMENT = "(missing)"
+
 class CohortAnalysisService:
     """Service for performing cohort analysis with different time intervals"""
 
@@ -25,11 +42,26 @@ class CohortAnalysisService:
         event_col: str,
         interval: str = 'monthly',
         revenue_col: Optional[str] = None,
-        preprocessing: Optional[Dict[str, Any]] = None
+        preprocessing: Optional[Dict[str, Any]] = None,
+        output_format: str = 'nested',
+        job_id: Optional[str] = None,
+        approximate: bool = False,
+        hll_precision: int = DEFAULT_PRECISION,
+        sample_rate: Optional[float] = None,
+        segment_col: Optional[str] = None,
+        segment_top_k: int = DEFAULT_SEGMENT_TOP_K,
+        heatmap_options: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         logger.info("Starting cohort analysis.")
+        full_rows = len(df)
+        if sample_rate is not None:
+            df = self._sample_users(df, user_id_col, sample_rate)
+        sampled_rows = len(df)
+
         # Apply preprocessing if config is provided
-        df = preprocess_dataframe(df, preprocessing.dict() if hasattr(preprocessing, "dict") else preprocessing)
+        with track_stage("preprocess", rows=len(df)) as stage:
+            df = preprocess_dataframe(df, preprocessing.dict() if hasattr(preprocessing, "dict") else preprocessing)
+            stage.rows = len(df)
 
         # Create a copy and rename columns for consistency with notebook
         df_analysis = df.copy()
@@ -51,6 +83,16 @@ class CohortAnalysisService:
             logger.error(f"Event column '{event_col}' not found in data")
             raise ValueError(f"Event column '{event_col}' not found in data")
 
+        if segment_col is not None:
+            if segment_col not in df_analysis.columns:
+                logger.error(f"Segment column '{segment_col}' not found in data")
+                raise ValueError(f"Segment column '{segment_col}' not found in data")
+            if segment_col in (user_id_col, cohort_grouping_col, event_col):
+                raise ValueError("Segment column must differ from the user, cohort and event columns")
+            if segment_top_k < 1:
+                raise ValueError("Segment top-K must be at least 1")
+        chart_service.check_options(heatmap_options)
+
         # Handle different column mappings to avoid duplicate key issues
         column_mapping = {user_id_col: 'CustomerID'}
 
@@ -71,22 +113,271 @@ class CohortAnalysisService:
 
         # Convert date columns to datetime
         try:
-            if 'InvoiceDate' in df_analysis.columns:
-                df_analysis['InvoiceDate'] = pd.to_datetime(df_analysis['InvoiceDate'], errors='coerce')
-            else:
-                df_analysis['CohortDate'] = pd.to_datetime(df_analysis['CohortDate'], errors='coerce')
-                df_analysis['EventDate'] = pd.to_datetime(df_analysis['EventDate'], errors='coerce')
-                # For analysis, we'll use EventDate as InvoiceDate for consistency
-                df_analysis['InvoiceDate'] = df_analysis['EventDate']
+            with track_stage("date_parse", rows=len(df_analysis)):
+                if 'InvoiceDate' in df_analysis.columns:
+                    df_analysis['InvoiceDate'] = pd.to_datetime(df_analysis['InvoiceDate'], errors='coerce')
+                else:
+                    df_analysis['CohortDate'] = pd.to_datetime(df_analysis['CohortDate'], errors='coerce')
+                    df_analysis['EventDate'] = pd.to_datetime(df_analysis['EventDate'], errors='coerce')
+                    # For analysis, we'll use EventDate as InvoiceDate for consistency
+                    df_analysis['InvoiceDate'] = df_analysis['EventDate']
         except Exception as e:
             logger.error(f"Error converting dates to datetime: {str(e)}")
             raise ValueError(f"Error converting dates to datetime: {str(e)}")
 
+        with track_stage("aggregate", rows=len(df_analysis)):
+            cohort_pivot, cohort_sizes, retention, revenue_table, approximation = self._aggregate(
+                df, df_analysis, cohort_grouping_col, event_col, interval, revenue_col,
+                approximate=approximate, hll_precision=hll_precision
+            )
+
+        segments = None
+        if segment_col is not None:
+            with track_stage("aggregate", rows=len(df_analysis)):
+                segments = self._segment_results(
+                    df_analysis, segment_col, segment_top_k, cohort_grouping_col == event_col, interval, output_format
+                )
+
+        totalRows = df.shape[0]
+        total_revenue = None
+        if revenue_col and revenue_col in df.columns:
+            try:
+                total_revenue = pd.to_numeric(df[revenue_col], errors='coerce').sum()
+            except Exception as e:
+                logger.warning(f"Could not calculate total revenue: {str(e)}")
+                total_revenue = None
+
+        profile = self._dataset_profile(df, df_analysis, total_revenue)
+
+        preview = None
+        if sample_rate is not None:
+            # Intervals come from the sampled counts; counts and sums are scaled up to estimates
+            preview = self._preview_intervals(retention, cohort_pivot, interval, output_format)
+            scale = 1.0 / sample_rate
+            totalRows = int(round(totalRows * full_rows / max(sampled_rows, 1)))
+            cohort_pivot = (cohort_pivot * scale).round().astype(np.int64)
+            cohort_sizes = cohort_pivot[0]
+            if revenue_table is not None:
+                revenue_table = revenue_table * scale
+            if total_revenue is not None:
+                total_revenue = total_revenue * scale
+            profile.update(
+                row_count=totalRows,
+                unique_users=int(round(profile['unique_users'] * scale)),
+                revenue_total=total_revenue
+            )
+            preview['sample_rate'] = sample_rate
+            preview['sampled_rows'] = sampled_rows
+
+        logger.info(f"Total rows after preprocessing: {totalRows}")
+        result = self._finalize(
+            totalRows, interval, cohort_pivot, cohort_sizes, retention, revenue_table, total_revenue, output_format, job_id,
+            heatmap_options,
+            # Previews only get a heatmap from the fast renderers
+            heatmap=preview is None or (heatmap_options or {}).get("renderer", "matplotlib") != "matplotlib"
+        )
+        result['profile'] = profile
+        if preview is not None:
+            result['preview'] = preview
+        if segments is not None:
+            result['segments'] = segments
+        if approximation is not None:
+            result['approximation'] = approximation
+        return result
+
+    def perform_indexed_analysis(
+        self,
+        index,
+        interval: str = 'monthly',
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None,
+        output_format: str = 'nested',
+        job_id: Optional[str] = None,
+        heatmap_options: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Retention analysis answered from a CohortIndex instead of the raw events.
+
+        Returns the same result as perform_cohort_analysis for an unpreprocessed
+        dataset filtered to start <= event date <= end. Its 'profile' only has the
+        row count, distinct users and date range of the filtered events.
+        """
+        logger.info("Starting cohort analysis from the cohort index.")
+        chart_service.check_options(heatmap_options)
+        with track_stage("aggregate") as stage:
+            window = index.query(interval, start, end)
+            stage.rows = window['total_rows']
+            if window['total_rows'] == 0:
+                logger.error("Input DataFrame is empty")
+                raise ValueError("Input DataFrame is empty")
+            cohort_pivot, cohort_sizes, retention = self._pivot_cohorts(window['cohort_data'])
+
+        logger.info(f"Total rows after preprocessing: {window['total_rows']}")
+        result = self._finalize(
+            window['total_rows'], interval, cohort_pivot, cohort_sizes, retention, None, None, output_format, job_id, heatmap_options
+        )
+        result['profile'] = {
+            'row_count': window['total_rows'],
+            'unique_users': window['unique_users'],
+            'date_range': window['date_range']
+        }
+        return result
+
+    def _dataset_profile(self, df: pd.DataFrame, df_analysis: pd.DataFrame, total_revenue) -> Dict[str, Any]:
+        """
+        Summary of the analysed frame, taken from the columns the analysis already parsed.
+
+        Returns row_count, unique_users, date_range (first and last event),
+        revenue_total (None without a revenue column) and null_counts per column.
+        """
+        events = df_analysis['InvoiceDate']
+        return {
+            'row_count': len(df),
+            'unique_users': int(df_analysis['CustomerID'].nunique()),
+            'date_range': (events.min(), events.max()),
+            'revenue_total': float(total_revenue) if total_revenue is not None else None,
+            'null_counts': {col: int(count) for col, count in df.isna().sum().items()}
+        }
+
+    def _finalize(
+        self,
+        totalRows: int,
+        interval: str,
+        cohort_pivot: pd.DataFrame,
+        cohort_sizes: pd.Series,
+        retention: pd.DataFrame,
+        revenue_table: Optional[pd.DataFrame],
+        total_revenue,
+        output_format: str,
+        job_id: Optional[str],
+        heatmap_options: Optional[Dict[str, Any]] = None,
+        heatmap: bool = True
+    ) -> Dict[str, Any]:
+        """Format the tables, store the matrices for the job and render the heatmap (with heatmap_options, see ChartService)."""
+        with track_stage("format", rows=int(cohort_pivot.size)):
+            matrices = None
+            if output_format == 'compact' or job_id:
+                matrices = self._build_matrices(retention, cohort_sizes, interval, revenue_table, cohort_pivot)
+            if output_format == 'compact':
+                result = self._format_compact(totalRows, interval, matrices)
+            else:
+                result = self._format_results(totalRows, retention, cohort_sizes, interval, revenue_table, cohort_pivot)
+            if job_id:
+                # Keep the full matrices server-side for windowed retrieval
+                result_store.save(
+                    job_id,
+                    matrices['cohorts'],
+                    matrices['periods'],
+                    matrices['cohort_sizes'],
+                    matrices['tables'],
+                    meta={'interval': interval, 'analysis_type': matrices['analysis_type']}
+                )
+
+        heatmap_url = None
+        if heatmap:
+            with track_stage("heatmap", rows=int(retention.size)):
+                heatmap_url = chart_service.generate_retention_heatmap(retention, interval, job_id, **(heatmap_options or {}))
+        result['charts'] = {'retention_heatmap': heatmap_url}
+        result['total_revenue'] = float(total_revenue) if total_revenue is not None else None  # <-- add total_revenue to result
+        logger.info("Cohort analysis completed successfully.")
+        return result
+
+    def _aggregate(
+        self,
+        df: pd.DataFrame,
+        df_analysis: pd.DataFrame,
+        cohort_grouping_col: str,
+        event_col: str,
+        interval: str,
+        revenue_col: Optional[str] = None,
+        approximate: bool = False,
+        hll_precision: int = DEFAULT_PRECISION
+    ):
+        """
+        Assign cohort and activity periods and pivot users (and revenue) per cell.
+
+        With approximate=True distinct users per cell are estimated from
+        HyperLogLog sketches instead of counted exactly, and the sketch
+        description is returned alongside the tables (None otherwise).
+        """
+        df_clean = self._assign_periods(df_analysis, cohort_grouping_col == event_col, interval)
+
+        if df_clean.empty:
+            logger.error("No valid data after cleaning. Please check your data quality and date formats.")
+            raise ValueError("No valid data after cleaning. Please check your data quality and date formats.")
+
+        if 'CustomerID' not in df_clean.columns:
+            logger.error("CustomerID column missing after data processing.")
+            raise ValueError("CustomerID column missing after data processing.")
+
+        df_clean = df_clean[df_clean['PeriodIndex'] >= 0]
+        if not approximate or revenue_col:
+            # Sketches ignore duplicates, but revenue is summed over the deduplicated rows.
+            # Period cohorts are compared by ordinal; hashing Period objects boxes every row.
+            cohort_keys = df_clean['CohortPeriod']
+            if isinstance(cohort_keys.dtype, pd.PeriodDtype):
+                cohort_keys = pd.Series(cohort_keys.array.asi8, index=df_clean.index)
+            duplicated = pd.DataFrame({
+                'CustomerID': df_clean['CustomerID'],
+                'CohortPeriod': cohort_keys,
+                'PeriodIndex': df_clean['PeriodIndex']
+            }).duplicated()
+            df_clean = df_clean[~duplicated.to_numpy()]
+
+        revenue = None
+        approximation = None
+        if revenue_col and revenue_col in df.columns:
+            revenue = pd.to_numeric(df_clean[revenue_col], errors='coerce')
+            if not revenue.notna().any():
+                logger.warning(f"No valid revenue data found in column '{revenue_col}'; revenue analysis skipped")
+                revenue = None
+        keys = [df_clean['CohortPeriod'], df_clean['PeriodIndex']]
+
+        if approximate:
+            sketch = HLLSketchMatrix(hll_precision)
+            for start in range(0, len(df_clean), SKETCH_CHUNK_ROWS):
+                chunk = df_clean.iloc[start:start + SKETCH_CHUNK_ROWS]
+                # Rows without a user still create their cell, as in the exact count below
+                known = chunk['CustomerID'].notna().to_numpy()
+                sketch.add(chunk['CohortPeriod'], chunk['PeriodIndex'], hash_users(chunk['CustomerID']), known)
+            cohort_data = sketch.cohort_data()
+            approximation = sketch.describe()
+            cell_revenue = revenue.groupby(keys).sum() if revenue is not None else None
+        else:
+            # One grouped pass for users and revenue. Rows are unique per
+            # (user, cohort, period) at this point, so counting IDs equals nunique.
+            cells = pd.DataFrame({'CustomerID': df_clean['CustomerID']})
+            aggregations = {'CustomerID': ('CustomerID', 'count')}
+            if revenue is not None:
+                cells['Revenue'] = revenue
+                aggregations['Revenue'] = ('Revenue', 'sum')
+            cells = cells.groupby(keys).agg(**aggregations)
+            cohort_data = cells['CustomerID'].reset_index()
+            cell_revenue = cells['Revenue'] if revenue is not None else None
+        cohort_pivot, cohort_sizes, retention = self._pivot_cohorts(cohort_data)
+
+        revenue_table = None
+        if cell_revenue is not None:
+            # Aligned with cohort_pivot; cells without revenue are 0
+            revenue_table = cell_revenue.unstack(fill_value=0).reindex(
+                index=cohort_pivot.index, columns=cohort_pivot.columns, fill_value=0
+            ).astype(float)
+
+        return cohort_pivot, cohort_sizes, retention, revenue_table, approximation
+
+    def _assign_periods(self, df_analysis: pd.DataFrame, self_cohort: bool, interval: str, user_keys=('CustomerID',)) -> pd.DataFrame:
+        """
+        Add CohortPeriod, ActivityPeriod and PeriodIndex and drop rows without them.
+
+        With self_cohort the cohort is the first event of each user_keys group
+        (the user, or the user within a segment).
+        """
+        user_keys = list(user_keys)
         # Perform cohort analysis based on interval
         try:
             if interval == 'daily':
-                if cohort_grouping_col == event_col:
-                    df_analysis['CohortPeriod'] = df_analysis.groupby('CustomerID')['InvoiceDate'].transform('min').dt.date
+                if self_cohort:
+                    df_analysis['CohortPeriod'] = df_analysis.groupby(user_keys)['InvoiceDate'].transform('min').dt.date
                 else:
                     df_analysis['CohortPeriod'] = df_analysis['CohortDate'].dt.date
                 df_analysis['ActivityPeriod'] = df_analysis['InvoiceDate'].dt.date
@@ -96,8 +387,8 @@ class CohortAnalysisService:
                 df_clean['PeriodIndex'] = (df_clean['ActivityPeriod'] - df_clean['CohortPeriod']).dt.days
 
             elif interval == 'weekly':
-                if cohort_grouping_col == event_col:
-                    df_analysis['CohortPeriod'] = df_analysis.groupby('CustomerID')['InvoiceDate'].transform('min').dt.to_period('W').dt.start_time
+                if self_cohort:
+                    df_analysis['CohortPeriod'] = df_analysis.groupby(user_keys)['InvoiceDate'].transform('min').dt.to_period('W').dt.start_time
                 else:
                     df_analysis['CohortPeriod'] = df_analysis['CohortDate'].dt.to_period('W').dt.start_time
                 df_analysis['ActivityPeriod'] = df_analysis['InvoiceDate'].dt.to_period('W').dt.start_time
@@ -105,31 +396,31 @@ class CohortAnalysisService:
                 df_clean['PeriodIndex'] = ((df_clean['ActivityPeriod'] - df_clean['CohortPeriod']).dt.days / 7).astype(int)
 
             elif interval == 'monthly':
-                if cohort_grouping_col == event_col:
-                    df_analysis['CohortPeriod'] = df_analysis.groupby('CustomerID')['InvoiceDate'].transform('min').dt.to_period('M')
+                if self_cohort:
+                    df_analysis['CohortPeriod'] = df_analysis.groupby(user_keys)['InvoiceDate'].transform('min').dt.to_period('M')
                 else:
                     df_analysis['CohortPeriod'] = df_analysis['CohortDate'].dt.to_period('M')
                 df_analysis['ActivityPeriod'] = df_analysis['InvoiceDate'].dt.to_period('M')
                 df_clean = df_analysis.dropna(subset=['CohortPeriod', 'ActivityPeriod'])
-                df_clean['PeriodIndex'] = (df_clean['ActivityPeriod'] - df_clean['CohortPeriod']).apply(lambda x: x.n)
+                df_clean['PeriodIndex'] = df_clean['ActivityPeriod'].array.asi8 - df_clean['CohortPeriod'].array.asi8
 
             elif interval == 'quarterly':
-                if cohort_grouping_col == event_col:
-                    df_analysis['CohortPeriod'] = df_analysis.groupby('CustomerID')['InvoiceDate'].transform('min').dt.to_period('Q')
+                if self_cohort:
+                    df_analysis['CohortPeriod'] = df_analysis.groupby(user_keys)['InvoiceDate'].transform('min').dt.to_period('Q')
                 else:
                     df_analysis['CohortPeriod'] = df_analysis['CohortDate'].dt.to_period('Q')
                 df_analysis['ActivityPeriod'] = df_analysis['InvoiceDate'].dt.to_period('Q')
                 df_clean = df_analysis.dropna(subset=['CohortPeriod', 'ActivityPeriod'])
-                df_clean['PeriodIndex'] = (df_clean['ActivityPeriod'] - df_clean['CohortPeriod']).apply(lambda x: x.n)
+                df_clean['PeriodIndex'] = df_clean['ActivityPeriod'].array.asi8 - df_clean['CohortPeriod'].array.asi8
             
             elif interval == 'yearly':
-                if cohort_grouping_col == event_col:
-                    df_analysis['CohortPeriod'] = df_analysis.groupby('CustomerID')['InvoiceDate'].transform('min').dt.to_period('Y')
+                if self_cohort:
+                    df_analysis['CohortPeriod'] = df_analysis.groupby(user_keys)['InvoiceDate'].transform('min').dt.to_period('Y')
                 else:
                     df_analysis['CohortPeriod'] = df_analysis['CohortDate'].dt.to_period('Y')
                 df_analysis['ActivityPeriod'] = df_analysis['InvoiceDate'].dt.to_period('Y')
                 df_clean = df_analysis.dropna(subset=['CohortPeriod', 'ActivityPeriod'])
-                df_clean['PeriodIndex'] = (df_clean['ActivityPeriod'] - df_clean['CohortPeriod']).apply(lambda x: x.n)
+                df_clean['PeriodIndex'] = df_clean['ActivityPeriod'].array.asi8 - df_clean['CohortPeriod'].array.asi8
 
             else:
                 logger.error("Interval must be 'daily', 'weekly', 'monthly', 'quarterly' or 'yearly'")
@@ -138,20 +429,10 @@ class CohortAnalysisService:
         except Exception as e:
             logger.error(f"Error during {interval} cohort calculation: {str(e)}")
             raise ValueError(f"Error during {interval} cohort calculation: {str(e)}")
+        return df_clean
 
-        if df_clean.empty:
-            logger.error("No valid data after cleaning. Please check your data quality and date formats.")
-            raise ValueError("No valid data after cleaning. Please check your data quality and date formats.")
-
-        if 'CustomerID' not in df_clean.columns:
-            logger.error("CustomerID column missing after data processing.")
-            raise ValueError("CustomerID column missing after data processing.")
-
-        df_clean = df_clean[df_clean['PeriodIndex'] >= 0]
-        df_clean = df_clean.drop_duplicates(subset=['CustomerID', 'CohortPeriod', 'PeriodIndex'])
-
-        cohort_data = df_clean.groupby(['CohortPeriod', 'PeriodIndex'])['CustomerID'].nunique().reset_index()
-
+    def _pivot_cohorts(self, cohort_data: pd.DataFrame):
+        """Pivot per-cell user counts into the cohort x period matrix and retention rates."""
         if cohort_data.empty:
             logger.error("No cohort data generated. Please check your data and ensure it has valid dates and user IDs.")
             raise ValueError("No cohort data generated. Please check your data and ensure it has valid dates and user IDs.")
@@ -193,86 +474,131 @@ class CohortAnalysisService:
 
         cohort_sizes = cohort_pivot[0]
         retention = cohort_pivot.divide(cohort_sizes, axis=0)
+        return cohort_pivot, cohort_sizes, retention
 
-        revenue_table = None
-        if revenue_col and revenue_col in df.columns:
+    def _segment_results(
+        self,
+        df_analysis: pd.DataFrame,
+        segment_col: str,
+        top_k: int,
+        self_cohort: bool,
+        interval: str,
+        output_format: str
+    ) -> Dict[str, Any]:
+        """
+        Retention tables per segment value, all computed in one grouped pass.
+
+        Each segment's table equals running the analysis on the rows with that
+        segment value. Segments are ranked by distinct users; those beyond the
+        top_k are merged into OTHER_SEGMENT. Rows without a segment value go to
+        MISSING_SEGMENT, which is not ranked and never counts towards top_k.
+        """
+        segment = df_analysis[segment_col]
+        pairs = df_analysis.loc[segment.notna(), [segment_col, 'CustomerID']].dropna().drop_duplicates()
+        users_per_segment = pairs[segment_col].value_counts()
+        labels = segment.where(segment.isin(users_per_segment.index[:top_k]), OTHER_SEGMENT)
+        codes, values = pd.factorize(labels.where(segment.notna(), MISSING_SEGMENT))
+
+        keep = codes >= 0
+        columns = ['CustomerID', 'InvoiceDate'] + (['CohortDate'] if 'CohortDate' in df_analysis.columns else [])
+        frame = df_analysis.loc[keep, columns].copy()
+        frame['Segment'] = codes[keep]
+        rows = np.bincount(codes[keep], minlength=len(values))
+        users = frame[['Segment', 'CustomerID']].dropna().drop_duplicates()['Segment'].value_counts()
+
+        # Shared factorized segment codes: one period assignment and one groupby for every segment
+        seg_clean = self._assign_periods(frame, self_cohort, interval, user_keys=('Segment', 'CustomerID'))
+        seg_clean = seg_clean[seg_clean['PeriodIndex'] >= 0]
+        counts = seg_clean.groupby(['Segment', 'CohortPeriod', 'PeriodIndex'])['CustomerID'].nunique().reset_index()
+
+        tables = []
+        for code, cell_counts in counts.groupby('Segment'):
+            label = values[code]
             try:
-                df_clean[revenue_col] = pd.to_numeric(df_clean[revenue_col], errors='coerce')
-                df_revenue = df_clean.dropna(subset=[revenue_col])
-                if df_revenue.empty:
-                    logger.warning(f"No valid revenue data found in column '{revenue_col}'")
-                    raise ValueError(f"No valid revenue data found in column '{revenue_col}'")
-                revenue_data = df_revenue.groupby(['CohortPeriod', 'PeriodIndex'])[revenue_col].sum().reset_index()
-                if revenue_data.empty:
-                    logger.warning("No revenue data could be aggregated")
-                    raise ValueError("No revenue data could be aggregated")
-                revenue_table = revenue_data.pivot_table(
-                    index='CohortPeriod',
-                    columns='PeriodIndex',
-                    values=revenue_col,
-                    aggfunc='sum',
-                    fill_value=0
-                )
+                cohort_pivot, cohort_sizes, retention = self._pivot_cohorts(cell_counts.drop(columns='Segment'))
             except ValueError as e:
-                if "duplicate" in str(e).lower():
-                    logger.warning("Duplicate keys found in revenue_data, aggregating before pivot.")
-                    revenue_data_agg = revenue_data.groupby(['CohortPeriod', 'PeriodIndex'])[revenue_col].sum().reset_index()
-                    revenue_table = revenue_data_agg.pivot_table(
-                        index='CohortPeriod',
-                        columns='PeriodIndex',
-                        values=revenue_col,
-                        aggfunc='first',
-                        fill_value=0
-                    )
-                else:
-                    logger.warning(f"Revenue analysis skipped due to error: {str(e)}")
-                    revenue_table = None
-            except Exception as e:
-                logger.error(f"Unexpected error in revenue analysis: {str(e)}")
-                revenue_table = None
-
-        totalRows = df.shape[0]
-        total_revenue = None
-        if revenue_col and revenue_col in df.columns:
-            try:
-                total_revenue = pd.to_numeric(df[revenue_col], errors='coerce').sum()
-            except Exception as e:
-                logger.warning(f"Could not calculate total revenue: {str(e)}")
-                total_revenue = None
+                logger.warning(f"Segment '{label}' skipped: {str(e)}")
+                continue
+            if output_format == 'compact':
+                matrices = self._build_matrices(retention, cohort_sizes, interval, None, cohort_pivot)
+                table = self._format_compact(int(rows[code]), interval, matrices)
+            else:
+                table = self._format_results(int(rows[code]), retention, cohort_sizes, interval, None, cohort_pivot)
+            table['segment'] = label.item() if hasattr(label, 'item') else label
+            table['users'] = int(users.get(code, 0))
+            tables.append(table)
+        # Largest segments first, then the merged and missing buckets
+        tables.sort(key=lambda t: (t['segment'] == MISSING_SEGMENT, t['segment'] == OTHER_SEGMENT, -t['users']))
+
+        return {
+            'column': segment_col,
+            'top_k': top_k,
+            'segment_count': int(len(users_per_segment)),
+            'truncated': bool(len(users_per_segment) > top_k),
+            'values': tables
+        }
 
-        logger.info(f"Total rows after preprocessing: {totalRows}")
-        result = self._format_results(totalRows, retention, cohort_sizes, interval, revenue_table, cohort_pivot)
+    def _sample_users(self, df: pd.DataFrame, user_id_col: str, sample_rate: float) -> pd.DataFrame:
+        """
+        Rows of a deterministic sample of users.
 
-        heatmap_url = chart_service.generate_retention_heatmap(retention, interval)
-        result['charts'] = {'retention_heatmap': heatmap_url}
-        result['total_revenue'] = float(total_revenue) if total_revenue is not None else None  # <-- add total_revenue to result
-        logger.info("Cohort analysis completed successfully.")
-        return result
+        Whole users are kept or dropped by hash bucket, so every sampled user
+        keeps all of their events and cohorts stay internally consistent.
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError("Sample rate must be greater than 0 and at most 1")
+        if user_id_col not in df.columns:
+            logger.error(f"User ID column '{user_id_col}' not found in data")
+            raise ValueError(f"User ID column '{user_id_col}' not found in data")
+        buckets = hash_users(df[user_id_col]) % np.uint64(SAMPLE_BUCKETS)
+        sampled = df[buckets < np.uint64(round(sample_rate * SAMPLE_BUCKETS))]
+        logger.info(f"Sampled {len(sampled)} of {len(df)} rows ({sample_rate:.2%} of users)")
+        return sampled
+
+    def _preview_intervals(self, retention: pd.DataFrame, cohort_pivot: pd.DataFrame, interval: str, output_format: str) -> Dict[str, Any]:
+        """95% Wilson score intervals of the sampled retention rates, laid out like retention_table."""
+        counts = cohort_pivot.to_numpy(dtype=float)
+        sizes = counts[:, :1]
+        rates = np.nan_to_num(retention.to_numpy(dtype=float), nan=0.0)
+        z2 = CONFIDENCE_Z ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominator = 1 + z2 / sizes
+            center = (rates + z2 / (2 * sizes)) / denominator
+            half = CONFIDENCE_Z * np.sqrt(rates * (1 - rates) / sizes + z2 / (4 * sizes ** 2)) / denominator
+        lower = np.clip(np.round(center - half, 4), 0.0, 1.0)
+        upper = np.clip(np.round(center + half, 4), 0.0, 1.0)
+
+        intervals: Dict[str, Any] = {'confidence_level': 0.95, 'sampled_users': int(counts[:, 0].sum())}
+        if output_format == 'compact':
+            lengths = row_lengths(counts)
+            intervals['retention_lower'] = encode_matrix(lower, lengths)
+            intervals['retention_upper'] = encode_matrix(upper, lengths)
+            return intervals
+        # Same cells as the nested retention_table: only periods with retained users
+        nested = {}
+        for i, cohort in enumerate(retention.index):
+            nested[self._cohort_label(cohort, interval)] = {
+                str(period): [float(lower[i, j]), float(upper[i, j])]
+                for j, period in enumerate(retention.columns)
+                if rates[i, j] > 0
+            }
+        intervals['retention_intervals'] = nested
+        return intervals
 
     def _format_results(self, totalRows: int, retention: pd.DataFrame, cohort_sizes: pd.Series, interval: str, revenue_table: Optional[pd.DataFrame] = None, cohort_pivot: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
         retention_dict = {}
         cohort_sizes_dict = {}
 
-        for cohort in retention.index:
-            if interval == 'daily':
-                cohort_name = cohort.strftime('%Y-%m-%d') if hasattr(cohort, 'strftime') else str(cohort)
-            elif interval == 'weekly':
-                # cohort is a Period object, get its start_time and format as ISO date or custom string
-                if hasattr(cohort, 'start_time'):
-                    cohort_name = cohort.start_time.strftime('%Y-%m-%d')
-                else:
-                    cohort_name = str(cohort)
-            elif interval in ['monthly', 'quarterly']:
-                cohort_name = cohort.strftime('%Y-%m') if hasattr(cohort, 'strftime') else str(cohort)
-            else:
-                cohort_name = str(cohort)
-
-            retention_dict[cohort_name] = {}
-            for period in retention.columns:
-                retention_rate = retention.loc[cohort, period]
-                if not pd.isna(retention_rate) and retention_rate > 0:
-                    retention_dict[cohort_name][str(period)] = float(retention_rate)
-            cohort_sizes_dict[cohort_name] = int(cohort_sizes[cohort])
+        rates = retention.to_numpy(dtype=float)
+        sizes = cohort_sizes.reindex(retention.index).to_numpy()
+        periods = [str(period) for period in retention.columns]
+        for i, cohort in enumerate(retention.index):
+            cohort_name = self._cohort_label(cohort, interval)
+            retention_dict[cohort_name] = {
+                period: rate for period, rate in zip(periods, rates[i].tolist())
+                if not np.isnan(rate) and rate > 0
+            }
+            cohort_sizes_dict[cohort_name] = int(sizes[i])
 
         revenue_dict = None
         arpu_dict = None
@@ -282,38 +608,17 @@ class CohortAnalysisService:
             revenue_dict = {}
             arpu_dict = {}
             ltv_dict = {}
-            cohorts_to_process = cohort_pivot.index if cohort_pivot is not None else revenue_table.index
-            for cohort in cohorts_to_process:
-                if interval == 'daily':
-                    cohort_name = cohort.strftime('%Y-%m-%d') if hasattr(cohort, 'strftime') else str(cohort)
-                elif interval == 'weekly':
+            revenue, arpu, ltv = self._revenue_matrices(revenue_table, cohort_pivot)
+            frame = cohort_pivot if cohort_pivot is not None else revenue_table
+            periods = [str(period) for period in frame.columns]
+            for i, cohort in enumerate(frame.index):
+                if interval == 'weekly':
                     cohort_name = cohort.strftime('%Y-W%U') if hasattr(cohort, 'strftime') else str(cohort)
-                elif interval in ['monthly', 'quarterly']:
-                    cohort_name = cohort.strftime('%Y-%m') if hasattr(cohort, 'strftime') else str(cohort)
                 else:
-                    cohort_name = str(cohort)
-                revenue_dict[cohort_name] = {}
-                arpu_dict[cohort_name] = {}
-                ltv_dict[cohort_name] = {}
-                cumulative_revenue = 0
-                periods_to_process = cohort_pivot.columns if cohort_pivot is not None else revenue_table.columns
-                for period in periods_to_process:
-                    if cohort in revenue_table.index and period in revenue_table.columns:
-                        revenue_value = revenue_table.loc[cohort, period]
-                    else:
-                        revenue_value = 0
-                    revenue_dict[cohort_name][str(period)] = round(float(revenue_value), 2)
-                    if cohort_pivot is not None and cohort in cohort_pivot.index and period in cohort_pivot.columns:
-                        user_count = cohort_pivot.loc[cohort, period]
-                        if user_count > 0:
-                            arpu_value = revenue_value / user_count
-                            arpu_dict[cohort_name][str(period)] = round(float(arpu_value), 2)
-                        else:
-                            arpu_dict[cohort_name][str(period)] = 0.0
-                    else:
-                        arpu_dict[cohort_name][str(period)] = 0.0
-                    cumulative_revenue += revenue_value
-                    ltv_dict[cohort_name][str(period)] = round(float(cumulative_revenue), 2)
+                    cohort_name = self._cohort_label(cohort, interval)
+                revenue_dict[cohort_name] = dict(zip(periods, [round(v, 2) for v in revenue[i].tolist()]))
+                arpu_dict[cohort_name] = dict(zip(periods, [round(v, 2) for v in arpu[i].tolist()]))
+                ltv_dict[cohort_name] = dict(zip(periods, [round(v, 2) for v in ltv[i].tolist()]))
 
         result = {
             'totalRows': totalRows,
@@ -331,6 +636,88 @@ class CohortAnalysisService:
             result['ltv_table'] = ltv_dict
         return result
 
+    def _revenue_matrices(self, revenue_table: pd.DataFrame, cohort_pivot: Optional[pd.DataFrame] = None):
+        """Revenue, ARPU (revenue per active user, 0 without users) and cumulative LTV arrays."""
+        if cohort_pivot is not None:
+            revenue_table = revenue_table.reindex(index=cohort_pivot.index, columns=cohort_pivot.columns, fill_value=0)
+        revenue = revenue_table.to_numpy(dtype=float)
+        if cohort_pivot is None:
+            arpu = np.zeros_like(revenue)
+        else:
+            counts = cohort_pivot.to_numpy(dtype=float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                arpu = np.where(counts > 0, revenue / counts, 0.0)
+        return revenue, arpu, np.cumsum(revenue, axis=1)
+
+    def _cohort_label(self, cohort, interval: str) -> str:
+        """Cohort label as used by the nested retention table."""
+        if interval == 'daily':
+            return cohort.strftime('%Y-%m-%d') if hasattr(cohort, 'strftime') else str(cohort)
+        if interval == 'weekly':
+            return cohort.start_time.strftime('%Y-%m-%d') if hasattr(cohort, 'start_time') else str(cohort)
+        if interval in ['monthly', 'quarterly']:
+            return cohort.strftime('%Y-%m') if hasattr(cohort, 'strftime') else str(cohort)
+        return str(cohort)
+
+    def _build_matrices(self, retention: pd.DataFrame, cohort_sizes: pd.Series, interval: str, revenue_table: Optional[pd.DataFrame] = None, cohort_pivot: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
+        """
+        Dense cohort x period matrices for every table, NaN past each cohort's last observed period.
+
+        Rows end where row_lengths cuts them. LTV is cumulative, so clients
+        forward-fill it past the end of a row.
+        """
+        counts = cohort_pivot.to_numpy(dtype=float)
+        lengths = row_lengths(counts)
+        beyond = np.arange(counts.shape[1]) >= lengths[:, None]
+
+        def masked(matrix: np.ndarray, digits: Optional[int] = None) -> np.ndarray:
+            matrix = np.nan_to_num(matrix.astype(float), nan=0.0)
+            if digits is not None:
+                matrix = round_values(matrix, digits)
+            matrix[beyond] = np.nan
+            return matrix
+
+        tables = {'retention_table': masked(retention.to_numpy(dtype=float))}
+        analysis_type = 'retention'
+        if revenue_table is not None:
+            revenue, arpu, ltv = self._revenue_matrices(revenue_table, cohort_pivot)
+            tables['revenue_table'] = masked(revenue, 2)
+            tables['arpu_table'] = masked(arpu, 2)
+            tables['ltv_table'] = masked(ltv, 2)
+            analysis_type = 'revenue'
+
+        return {
+            'cohorts': [self._cohort_label(c, interval) for c in retention.index],
+            'periods': [int(p) for p in retention.columns],
+            'row_lengths': lengths,
+            'cohort_sizes': [int(v) for v in cohort_sizes.to_numpy()],
+            'tables': tables,
+            'analysis_type': analysis_type
+        }
+
+    def _format_compact(self, totalRows: int, interval: str, matrices: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Columnar alternative to _format_results.
+
+        Cohort and period labels are sent once. Every table is a flat row-major
+        list holding the first row_lengths[i] periods of cohort i (zeros inside
+        a row are kept, trailing unobserved periods are dropped).
+        """
+        lengths = matrices['row_lengths']
+        tables = {}
+        for name, matrix in matrices['tables'].items():
+            tables[name] = encode_matrix(matrix, lengths)
+        return {
+            'format': 'compact',
+            'totalRows': totalRows,
+            'interval': interval,
+            'analysis_type': matrices['analysis_type'],
+            'cohorts': matrices['cohorts'],
+            'periods': matrices['periods'],
+            'row_lengths': lengths.tolist(),
+            'cohort_sizes': matrices['cohort_sizes'],
+            'tables': tables
+        }
+
 # Create global instance
 cohort_service = CohortAnalysisService()
-
@@ -1,54 +1,162 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
+import struct
+import uuid
+import zlib
 import numpy as np
 from datetime import datetime
 from pathlib import Path
+from typing import Optional, Dict, Any, List
+from xml.sax.saxutils import escape
 import pandas as pd
 from app.utils.logger import get_logger
+from app.utils.storage_manager import storage_manager
 
 logger = get_logger(__name__)
 
+RENDERERS = ("matplotlib", "png", "svg")
+ANNOTATE_POLICIES = ("always", "never", "auto")
+# Accepted DPI and figure sizes (inches)
+DPI_RANGE = (10, 600)
+SIZE_RANGE = (1.0, 40.0)
+# Raster images are width*dpi x height*dpi pixels; larger ones are refused (the default chart is ~10M)
+MAX_PIXELS = 25_000_000
+# Smallest cell (points) a "12.3%" label fits into under the "auto" annotation policy
+LABEL_CELL_POINTS = (32.0, 12.0)
+# ColorBrewer YlOrRd, the colours matplotlib's "YlOrRd" colormap interpolates between
+YLORRD = np.array([
+    [255, 255, 204], [255, 237, 160], [254, 217, 118], [254, 178, 76], [253, 141, 60],
+    [252, 78, 42], [227, 26, 28], [189, 0, 38], [128, 0, 38],
+], dtype=float)
+
+
+def _plotting():
+    """matplotlib's Figure and seaborn, imported on first use; they dominate the app's import time."""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    import seaborn as sns
+    return Figure, sns
+
+
+def _coerce_rates(frame: pd.DataFrame) -> pd.DataFrame:
+    """Retention cells as floats: '12.5%' -> 0.125, numbers and numeric strings as is, blanks and anything else NaN."""
+    flat = pd.Series(frame.to_numpy(dtype=object).ravel())
+    percent = np.zeros(len(flat), dtype=bool)
+    # The .str accessor needs at least one string among the values
+    if pd.api.types.infer_dtype(flat, skipna=True) in ("string", "mixed", "mixed-integer"):
+        is_percent = flat.str.endswith('%', na=False)
+        flat = flat.mask(is_percent, flat.str.replace('%', '', regex=False))
+        percent = is_percent.to_numpy()
+    values = pd.to_numeric(flat, errors='coerce').to_numpy(dtype=float, copy=True)
+    values[percent] /= 100
+    return pd.DataFrame(values.reshape(frame.shape), index=frame.index, columns=frame.columns)
+
+
+def _colors(values: np.ndarray) -> np.ndarray:
+    """Rates -> YlOrRd RGB (0-255 floats) scaled between their min and max like seaborn; NaN and infinite cells white."""
+    valid = np.isfinite(values)
+    scaled = np.zeros_like(values)
+    if valid.any():
+        low, high = values[valid].min(), values[valid].max()
+        if high > low:
+            scaled = np.where(valid, (values - low) / (high - low), 0.0)
+    stops = np.linspace(0, 1, len(YLORRD))
+    rgb = np.stack([np.interp(scaled, stops, YLORRD[:, channel]) for channel in range(3)], axis=-1)
+    rgb[~valid] = 255
+    return rgb
+
+
+def _dark_text(rgb: np.ndarray) -> np.ndarray:
+    """Whether dark text reads better than white on each colour (seaborn's relative luminance rule)."""
+    c = rgb / 255
+    linear = np.where(c <= 0.03928, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    return linear @ np.array([0.2126, 0.7152, 0.0722]) > 0.408
+
+
+def _png_bytes(pixels: np.ndarray) -> bytes:
+    """Encode an (height, width, 3) uint8 array as an RGB PNG."""
+    height, width, _ = pixels.shape
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    # Leading zero byte of every scanline: filter type None
+    scanlines[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _fits_labels(cell_width: float, cell_height: float) -> bool:
+    return cell_width >= LABEL_CELL_POINTS[0] and cell_height >= LABEL_CELL_POINTS[1]
+
+
 class ChartService:
     def __init__(self):
         self.static_dir = Path("static")
         self.charts_dir = self.static_dir / "charts"
         self.charts_dir.mkdir(parents=True, exist_ok=True)
 
-    def generate_retention_heatmap(self, retention: pd.DataFrame, interval: str) -> str:
+    @staticmethod
+    def check_options(options: Optional[Dict[str, Any]]) -> None:
+        """Raise ValueError for heatmap options generate_retention_heatmap() would reject."""
+        options = options or {}
+        if options.get("renderer", "matplotlib") not in RENDERERS:
+            raise ValueError(f"Heatmap renderer must be one of {', '.join(RENDERERS)}")
+        if options.get("annotate", "always") not in ANNOTATE_POLICIES:
+            raise ValueError(f"Heatmap annotation policy must be one of {', '.join(ANNOTATE_POLICIES)}")
+        if not DPI_RANGE[0] <= options.get("dpi", 300) <= DPI_RANGE[1]:
+            raise ValueError(f"Heatmap DPI must be between {DPI_RANGE[0]} and {DPI_RANGE[1]}")
+        for name in ("width", "height"):
+            if name in options and not SIZE_RANGE[0] <= options[name] <= SIZE_RANGE[1]:
+                raise ValueError(f"Heatmap {name} must be between {SIZE_RANGE[0]:g} and {SIZE_RANGE[1]:g} inches")
+        if options.get("renderer", "matplotlib") != "svg":
+            dpi = options.get("dpi", 300)
+            pixels = options.get("width", 14) * dpi * options.get("height", 8) * dpi
+            if pixels > MAX_PIXELS:
+                raise ValueError(f"Heatmap of {pixels / 1e6:.0f}M pixels exceeds the limit of {MAX_PIXELS / 1e6:.0f}M; lower dpi or size")
+
+    def generate_retention_heatmap(
+        self,
+        retention: pd.DataFrame,
+        interval: str,
+        job_id: Optional[str] = None,
+        renderer: str = "matplotlib",
+        dpi: int = 300,
+        width: float = 14,
+        height: float = 8,
+        annotate: str = "always"
+    ) -> str:
         """
         Generate retention heatmap and save as image file
 
         Parameters:
         retention: DataFrame with retention rates (numeric values 0-1)
         interval: Time interval for labeling
+        job_id: Job the image belongs to; it is kept until the job has exported it
+        renderer: "matplotlib" (seaborn chart), "png" (cells painted straight to pixels, no text)
+            or "svg" (vector chart with labels); the latter two don't load matplotlib
+        dpi, width, height: resolution and figure size in inches (SVG ignores dpi)
+        annotate: "always", "never" or "auto" (only when the cells are large enough for their value)
 
         Returns:
         URL path to the generated heatmap image
         """
         try:
             logger.info("Generating retention heatmap.")
+            self.check_options({"renderer": renderer, "annotate": annotate, "dpi": dpi, "width": width, "height": height})
             retention_plot = retention.copy()
 
             if retention_plot.empty:
                 logger.warning("Retention DataFrame is empty. No heatmap generated.")
                 return None
 
-            if retention_plot.dtypes.iloc[0] == 'object':
-                for col in retention_plot.columns:
-                    for idx in retention_plot.index:
-                        value = retention_plot.loc[idx, col]
-                        if isinstance(value, str) and value.endswith('%'):
-                            retention_plot.loc[idx, col] = float(value.replace('%', '')) / 100
-                        elif value == "" or pd.isna(value):
-                            retention_plot.loc[idx, col] = np.nan
-                        elif isinstance(value, str):
-                            try:
-                                retention_plot.loc[idx, col] = float(value)
-                            except:
-                                retention_plot.loc[idx, col] = np.nan
-                retention_plot = retention_plot.astype(float)
+            if (retention_plot.dtypes == 'object').any():
+                retention_plot = _coerce_rates(retention_plot)
+            retention_plot = retention_plot.astype(float)
 
             max_cohorts = 15
             max_periods = 12
@@ -81,40 +189,152 @@ class ChartService:
             elif interval in ['monthly', 'quarterly']:
                 retention_plot.index = retention_plot.index.strftime('%Y-%m')
 
-            plt.figure(figsize=(14, 8))
-            mask = retention_plot.isna()
-            sns.heatmap(
-                retention_plot,
-                annot=True,
-                fmt=".1%",
-                cmap="YlOrRd",
-                cbar_kws={'label': 'Retention Rate'},
-                mask=mask,
-                linewidths=0.5,
-                linecolor='white'
-            )
-
-            plt.title(f'{interval.title()} Cohort Retention Heatmap', fontsize=16, fontweight='bold')
-            plt.xlabel(f'{interval.title()} Period', fontsize=12)
-            plt.ylabel('Cohort', fontsize=12)
-            plt.xticks(rotation=45)
-            plt.yticks(rotation=0)
-            plt.tight_layout()
-
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"retention_heatmap_{interval}_{timestamp}.png"
+            extension = "svg" if renderer == "svg" else "png"
+            # Previews and exact results of one job can render within the same second
+            filename = f"retention_heatmap_{interval}_{timestamp}_{uuid.uuid4().hex[:8]}.{extension}"
             filepath = self.charts_dir / filename
 
-            plt.savefig(filepath, dpi=300, bbox_inches='tight', facecolor='white')
-            plt.close()
+            if renderer == "png":
+                filepath.write_bytes(self._render_png(retention_plot, dpi, width, height))
+            elif renderer == "svg":
+                filepath.write_text(self._render_svg(retention_plot, interval, width, height, annotate), encoding="utf-8")
+            else:
+                self._render_matplotlib(retention_plot, interval, filepath, dpi, width, height, annotate)
+            storage_manager.register(filepath, job_id)
 
             logger.info(f"Retention heatmap saved to {filepath}")
             return f"/static/charts/{filename}"
 
         except Exception as e:
             logger.error(f"Error generating retention heatmap: {e}")
-            plt.close()
             return None
 
+    @staticmethod
+    def _render_matplotlib(
+        retention_plot: pd.DataFrame,
+        interval: str,
+        filepath: Path,
+        dpi: int,
+        width: float,
+        height: float,
+        annotate: str
+    ) -> None:
+        # A Figure of its own instead of pyplot's global current figure, which concurrent jobs would share
+        Figure, sns = _plotting()
+        cohorts, periods = retention_plot.shape
+        if annotate == "auto":
+            # Roughly the share of the figure left to the cells once labels and the colour bar are placed
+            annot = _fits_labels(width * 0.75 * 72 / periods, height * 0.75 * 72 / cohorts)
+        else:
+            annot = annotate == "always"
+        fig = Figure(figsize=(width, height))
+        ax = fig.subplots()
+        mask = retention_plot.isna()
+        sns.heatmap(
+            retention_plot,
+            annot=annot,
+            fmt=".1%",
+            cmap="YlOrRd",
+            cbar_kws={'label': 'Retention Rate'},
+            mask=mask,
+            linewidths=0.5,
+            linecolor='white',
+            ax=ax
+        )
+
+        ax.set_title(f'{interval.title()} Cohort Retention Heatmap', fontsize=16, fontweight='bold')
+        ax.set_xlabel(f'{interval.title()} Period', fontsize=12)
+        ax.set_ylabel('Cohort', fontsize=12)
+        ax.tick_params(axis='x', labelrotation=45)
+        ax.tick_params(axis='y', labelrotation=0)
+        fig.tight_layout()
+        fig.savefig(filepath, dpi=dpi, bbox_inches='tight', facecolor='white')
+
+    @staticmethod
+    def _render_png(retention_plot: pd.DataFrame, dpi: int, width: float, height: float) -> bytes:
+        """Paint each cell as a block of pixels filling the image, with white grid lines between blocks."""
+        rgb = _colors(retention_plot.to_numpy()).round().astype(np.uint8)
+        cohorts, periods = retention_plot.shape
+        pixels_x, pixels_y = max(periods, round(width * dpi)), max(cohorts, round(height * dpi))
+        # Cell of every pixel column and row
+        column = np.arange(pixels_x) * periods // pixels_x
+        row = np.arange(pixels_y) * cohorts // pixels_y
+        pixels = rgb[row[:, None], column[None, :]]
+        if pixels_x >= 8 * periods and pixels_y >= 8 * cohorts:
+            pixels[:, np.flatnonzero(np.diff(column)) + 1] = 255
+            pixels[np.flatnonzero(np.diff(row)) + 1, :] = 255
+        return _png_bytes(pixels)
+
+    @staticmethod
+    def _render_svg(retention_plot: pd.DataFrame, interval: str, width: float, height: float, annotate: str) -> str:
+        """The chart as SVG markup in points: title, cohort and period labels, cells, values and a colour bar."""
+        values = retention_plot.to_numpy()
+        rgb = _colors(values)
+        dark = _dark_text(rgb)
+        cohorts, periods = values.shape
+        total_width, total_height = width * 72, height * 72
+        left = 40 + 6 * max(len(str(label)) for label in retention_plot.index)
+        top, right, bottom = 40, 80, 70
+        cell_width = max(total_width - left - right, periods) / periods
+        cell_height = max(total_height - top - bottom, cohorts) / cohorts
+        annot = annotate == "always" or (annotate == "auto" and _fits_labels(cell_width, cell_height))
+        plot_right, plot_bottom = left + cell_width * periods, top + cell_height * cohorts
+        title = escape(interval.title())
+
+        parts: List[str] = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:g}in" height="{height:g}in" '
+            f'viewBox="0 0 {total_width:g} {total_height:g}" font-family="DejaVu Sans, Arial, sans-serif">',
+            '<defs><linearGradient id="cmap" x1="0" y1="1" x2="0" y2="0">'
+            + "".join(
+                f'<stop offset="{i / (len(YLORRD) - 1):.3f}" stop-color="rgb({r:g},{g:g},{b:g})"/>'
+                for i, (r, g, b) in enumerate(YLORRD)
+            )
+            + '</linearGradient></defs>',
+            f'<rect width="{total_width:g}" height="{total_height:g}" fill="white"/>',
+            f'<text x="{(left + plot_right) / 2:.1f}" y="24" font-size="16" font-weight="bold" text-anchor="middle">'
+            f'{title} Cohort Retention Heatmap</text>',
+        ]
+        for i, label in enumerate(retention_plot.index):
+            y = top + cell_height * (i + 0.5)
+            parts.append(f'<text x="{left - 6:.1f}" y="{y:.1f}" font-size="10" text-anchor="end" dominant-baseline="middle">{escape(str(label))}</text>')
+        for j, label in enumerate(retention_plot.columns):
+            x = left + cell_width * (j + 0.5)
+            parts.append(
+                f'<text x="{x:.1f}" y="{plot_bottom + 12:.1f}" font-size="10" text-anchor="end" '
+                f'transform="rotate(-45 {x:.1f} {plot_bottom + 12:.1f})">{escape(str(label))}</text>'
+            )
+        for i in range(cohorts):
+            for j in range(periods):
+                if not np.isfinite(values[i, j]):
+                    continue
+                x, y = left + cell_width * j, top + cell_height * i
+                r, g, b = rgb[i, j]
+                parts.append(
+                    f'<rect x="{x:.1f}" y="{y:.1f}" width="{cell_width:.1f}" height="{cell_height:.1f}" '
+                    f'fill="rgb({r:.0f},{g:.0f},{b:.0f})" stroke="white" stroke-width="0.5"/>'
+                )
+                if annot:
+                    parts.append(
+                        f'<text x="{x + cell_width / 2:.1f}" y="{y + cell_height / 2:.1f}" font-size="10" text-anchor="middle" '
+                        f'dominant-baseline="middle" fill="{"#262626" if dark[i, j] else "white"}">{values[i, j]:.1%}</text>'
+                    )
+
+        valid = values[np.isfinite(values)]
+        low, high = (valid.min(), valid.max()) if valid.size else (0.0, 0.0)
+        bar_x = plot_right + 12
+        parts += [
+            f'<rect x="{bar_x:.1f}" y="{top}" width="14" height="{plot_bottom - top:.1f}" fill="url(#cmap)"/>',
+            f'<text x="{bar_x + 18:.1f}" y="{top + 4}" font-size="9">{high:.0%}</text>',
+            f'<text x="{bar_x + 18:.1f}" y="{plot_bottom:.1f}" font-size="9">{low:.0%}</text>',
+            f'<text x="{bar_x + 52:.1f}" y="{(top + plot_bottom) / 2:.1f}" font-size="10" text-anchor="middle" '
+            f'transform="rotate(-90 {bar_x + 52:.1f} {(top + plot_bottom) / 2:.1f})">Retention Rate</text>',
+            f'<text x="{(left + plot_right) / 2:.1f}" y="{total_height - 8:.1f}" font-size="12" text-anchor="middle">{title} Period</text>',
+            f'<text x="14" y="{(top + plot_bottom) / 2:.1f}" font-size="12" text-anchor="middle" '
+            f'transform="rotate(-90 14 {(top + plot_bottom) / 2:.1f})">Cohort</text>',
+            '</svg>',
+        ]
+        return "\n".join(parts)
+
 # Global instance
 chart_service = ChartService()
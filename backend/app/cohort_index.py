@@ -0,0 +1,522 @@
+# Per-dataset index of distinct users per (cohort day, activity day) cell
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple, Iterable, List, Set, Callable
+import numpy as np
+import pandas as pd
+from app.utils.logger import get_logger
+from app.utils.single_flight import SingleFlight
+from app.utils.storage_manager import storage_manager, AREAS
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; builds are then only shared within the process
+    fcntl = None
+
+logger = get_logger(__name__)
+
+COHORT_INDEX_CACHE_SIZE = int(os.getenv("COHORT_INDEX_CACHE_SIZE", "8"))
+# Persist built indexes under cache/cohort_index/ and memory-map them, so every worker process shares one copy
+COHORT_INDEX_SHARED = os.getenv("COHORT_INDEX_SHARED", "1").lower() in ("1", "true", "yes")
+NS_PER_DAY = 86_400 * 10**9
+NAT = np.iinfo(np.int64).min
+# Cohort day of rows whose cohort date is missing; they count as users but never fill a cell
+NO_COHORT = np.iinfo(np.int64).min
+# User code of rows without a user; with a separate cohort column they still open their cell, as in the engine
+NO_USER = -1
+# Bumped whenever the persisted arrays change meaning; older indexes on disk are rebuilt
+INDEX_FORMAT = 2
+
+_PERIOD_FREQ = {'monthly': 'M', 'quarterly': 'Q', 'yearly': 'Y'}
+
+
+def _epoch_ns(series: pd.Series) -> np.ndarray:
+    """Naive datetime column -> int64 nanoseconds since the epoch (NaT -> NAT)."""
+    if not pd.api.types.is_datetime64_dtype(series):
+        raise ValueError(f"Column '{series.name}' is not a timezone-naive datetime column")
+    return series.to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+
+def _period_keys(days: np.ndarray, interval: str) -> np.ndarray:
+    """Days since the epoch -> ordinal of the containing period."""
+    if interval == 'daily':
+        return days
+    if interval == 'weekly':
+        # 1970-01-01 was a Thursday; weeks start on Monday like to_period('W')
+        return days - (days + 3) % 7
+    months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    if interval == 'monthly':
+        return months
+    if interval == 'quarterly':
+        return months // 3
+    if interval == 'yearly':
+        return months // 12
+    raise ValueError("Interval must be 'daily', 'weekly', 'monthly', 'quarterly' or 'yearly'")
+
+
+def _period_labels(keys: np.ndarray, interval: str):
+    """Period ordinals -> the CohortPeriod values the engine produces for the interval."""
+    if interval in ('daily', 'weekly'):
+        return pd.to_datetime(keys, unit='D')
+    return pd.PeriodIndex.from_ordinals(keys, freq=_PERIOD_FREQ[interval])
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """Exclusive lock held across the worker processes of the host; closing the file releases it."""
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class CohortIndex:
+    """
+    Distinct-user index of one dataset for a fixed (user, cohort, event) column choice.
+
+    Rows are reduced to unique (activity day, cohort day, user) triples sorted by
+    activity day, so every (cohort day, activity day) cell holds a sorted posting
+    list of user codes and any activity-day window is one contiguous slice. Cohort
+    and period counts for a date window and any interval at least a day wide are
+    answered from that slice without touching the events again.
+    """
+
+    # Arrays written by save(); the scalars and column choice go to meta.json
+    ARRAYS = (
+        "activity", "cohort", "user", "midnight", "day_offsets", "nat_users",
+        "day_rows", "day_midnight_rows", "day_min_ns", "day_max_ns",
+    )
+
+    def __init__(self, df: pd.DataFrame, user_col: str, cohort_col: str, event_col: str):
+        self._setup(user_col, cohort_col, event_col, list(df.columns), set(df.select_dtypes(include=[np.number]).columns))
+        self._index([df])
+
+    @classmethod
+    def from_chunks(
+        cls,
+        chunks: Iterable[pd.DataFrame],
+        user_col: str,
+        cohort_col: str,
+        event_col: str,
+        columns: List[str],
+        numeric_columns: Set[str]
+    ) -> "CohortIndex":
+        """
+        Build the index from consecutive row chunks of the dataset (with parsed date columns).
+
+        Only one chunk and the deduplicated entries so far are held at a time; the
+        result equals the index of the concatenated chunks. columns and
+        numeric_columns describe the whole dataset, which the chunks may not carry.
+        """
+        index = cls.__new__(cls)
+        index._setup(user_col, cohort_col, event_col, columns, numeric_columns)
+        index._index(chunks)
+        return index
+
+    def _setup(self, user_col: str, cohort_col: str, event_col: str, columns: List[str], numeric_columns: Set[str]) -> None:
+        self.user_col = user_col
+        self.cohort_col = cohort_col
+        self.event_col = event_col
+        self.self_cohort = cohort_col == event_col
+        self.columns = columns
+        self.numeric_columns = numeric_columns
+
+    @staticmethod
+    def _unique_triples(activity, cohort, user, at_midnight):
+        # Sort so midnight rows come first inside each triple, then keep one row per triple
+        order = np.lexsort((~at_midnight, user, cohort, activity))
+        activity, cohort, user, at_midnight = activity[order], cohort[order], user[order], at_midnight[order]
+        first = np.ones(len(activity), dtype=bool)
+        first[1:] = (activity[1:] != activity[:-1]) | (cohort[1:] != cohort[:-1]) | (user[1:] != user[:-1])
+        return activity[first], cohort[first], user[first], at_midnight[first]
+
+    def _index(self, chunks: Iterable[pd.DataFrame]) -> None:
+        uniques = None
+        total_rows = 0
+        self.nat_rows = 0
+        nat_users, day_stats, parts = [], [], []
+        for df in chunks:
+            users, chunk_uniques = pd.factorize(df[self.user_col])
+            if uniques is None:
+                uniques = pd.Index(chunk_uniques)
+            else:
+                # Users new in this chunk get the next codes, so codes follow first appearance like one factorize
+                position = uniques.get_indexer(chunk_uniques)
+                new = position < 0
+                if new.any():
+                    position[new] = np.arange(len(uniques), len(uniques) + int(new.sum()))
+                    uniques = uniques.append(pd.Index(chunk_uniques[new]))
+                # Missing users (code -1) pick the appended NO_USER, also when the chunk has no users at all
+                users = np.append(position, NO_USER)[users]
+            total_rows += len(df)
+
+            event_ns = _epoch_ns(df[self.event_col])
+            has_event = event_ns != NAT
+            event_day = np.where(has_event, event_ns, 0) // NS_PER_DAY
+            midnight = np.where(has_event, event_ns, 0) % NS_PER_DAY == 0
+
+            # Rows without an event date only survive when no date filter is applied
+            self.nat_rows += int((~has_event).sum())
+            nat_users.append(users[~has_event & (users >= 0)])
+            if has_event.any():
+                day_stats.append(pd.DataFrame({
+                    'day': event_day[has_event],
+                    'midnight': midnight[has_event],
+                    'ns': event_ns[has_event]
+                }).groupby('day').agg(
+                    rows=('ns', 'size'), midnight_rows=('midnight', 'sum'), min=('ns', 'min'), max=('ns', 'max')
+                ))
+
+            # The engine assigns self-cohorts per user, so rows without one only count with a cohort column
+            keep = has_event & (users != NO_USER) if self.self_cohort else has_event
+            activity = event_day[keep]
+            user = users[keep].astype(np.int64)
+            if self.self_cohort:
+                cohort = np.zeros_like(activity)
+            else:
+                cohort_ns = _epoch_ns(df[self.cohort_col])[keep]
+                cohort = np.where(cohort_ns != NAT, cohort_ns // NS_PER_DAY, NO_COHORT)
+            parts.append(self._unique_triples(activity, cohort, user, midnight[keep]))
+
+        if not day_stats:
+            raise ValueError(f"No valid dates in column '{self.event_col}'")
+        self.n_users = len(uniques)
+        self.nat_users = np.unique(np.concatenate(nat_users))
+
+        stats = pd.concat(day_stats).groupby(level=0).agg({'rows': 'sum', 'midnight_rows': 'sum', 'min': 'min', 'max': 'max'})
+        self.first_day = int(stats.index.min())
+        self.last_day = int(stats.index.max())
+        n_days = self.last_day - self.first_day + 1
+        offsets = stats.index.to_numpy() - self.first_day
+        self.day_rows = np.zeros(n_days, dtype=np.int64)
+        self.day_midnight_rows = np.zeros(n_days, dtype=np.int64)
+        self.day_min_ns = np.zeros(n_days, dtype=np.int64)
+        self.day_max_ns = np.zeros(n_days, dtype=np.int64)
+        self.day_rows[offsets] = stats['rows'].to_numpy()
+        self.day_midnight_rows[offsets] = stats['midnight_rows'].to_numpy()
+        self.day_min_ns[offsets] = stats['min'].to_numpy()
+        self.day_max_ns[offsets] = stats['max'].to_numpy()
+
+        if len(parts) == 1:
+            self.activity, self.cohort, self.user, self.midnight = parts[0]
+        else:
+            # A triple seen in several chunks keeps a midnight flag if any chunk had one
+            merged = [np.concatenate(arrays) for arrays in zip(*parts)]
+            parts.clear()
+            self.activity, self.cohort, self.user, self.midnight = self._unique_triples(*merged)
+        # self.midnight: whether the triple has a row exactly at midnight (needed for end dates at 00:00)
+        self.day_offsets = np.searchsorted(self.activity, np.arange(self.first_day, self.last_day + 2))
+        logger.info(
+            f"Built cohort index: {total_rows} rows -> {len(self.activity)} (day, cohort, user) entries "
+            f"over {n_days} days and {self.n_users} users"
+        )
+
+    def save(self, directory: Path) -> None:
+        """Write the index as .npy files plus meta.json, replacing directory atomically."""
+        tmp_dir = directory.with_name(directory.name + ".tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        for name in self.ARRAYS:
+            np.save(tmp_dir / f"{name}.npy", getattr(self, name))
+        meta = {
+            "user_col": self.user_col,
+            "cohort_col": self.cohort_col,
+            "event_col": self.event_col,
+            "columns": self.columns,
+            "numeric_columns": sorted(self.numeric_columns, key=str),
+            "n_users": self.n_users,
+            "nat_rows": self.nat_rows,
+            "first_day": self.first_day,
+            "last_day": self.last_day,
+            "format": INDEX_FORMAT,
+        }
+        (tmp_dir / "meta.json").write_text(json.dumps(meta))
+        shutil.rmtree(directory, ignore_errors=True)
+        tmp_dir.rename(directory)
+
+    @classmethod
+    def load(cls, directory: Path) -> "CohortIndex":
+        """
+        Open an index written by save().
+
+        The arrays are read-only memory maps, so processes opening the same index
+        share its pages through the page cache instead of each holding a copy.
+        """
+        meta = json.loads((directory / "meta.json").read_text())
+        if meta.get("format") != INDEX_FORMAT:
+            raise ValueError(f"index format {meta.get('format')} is not {INDEX_FORMAT}")
+        index = cls.__new__(cls)
+        index._setup(meta["user_col"], meta["cohort_col"], meta["event_col"], meta["columns"], set(meta["numeric_columns"]))
+        for name in ("n_users", "nat_rows", "first_day", "last_day"):
+            setattr(index, name, meta[name])
+        for name in cls.ARRAYS:
+            setattr(index, name, np.load(directory / f"{name}.npy", mmap_mode="r"))
+        return index
+
+    @staticmethod
+    def supports_window(start: Optional[pd.Timestamp], end: Optional[pd.Timestamp]) -> bool:
+        """Only day-aligned, timezone-naive bounds map onto whole index days."""
+        for bound in (start, end):
+            if bound is None:
+                continue
+            if bound.tzinfo is not None or bound != bound.normalize():
+                return False
+        return True
+
+    def query(
+        self,
+        interval: str,
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None
+    ) -> Dict[str, Any]:
+        """
+        Cohort counts and dataset summary for events with start <= event date <= end.
+
+        Returns the engine's aggregated cohort data (CohortPeriod, PeriodIndex,
+        CustomerID user counts) together with total_rows, unique_users and
+        date_range of the filtered events.
+        """
+        lo = self.first_day if start is None else max(self.first_day, int(start.value // NS_PER_DAY))
+        hi = self.last_day if end is None else min(self.last_day, int(end.value // NS_PER_DAY))
+        # An end date at midnight only admits that day's rows stamped exactly 00:00
+        end_day = int(end.value // NS_PER_DAY) if end is not None else None
+        clipped = end_day is not None and end_day == hi
+
+        total_rows, date_range = 0, (None, None)
+        activity = cohort = user = np.empty(0, dtype=np.int64)
+        if lo <= hi:
+            days = slice(lo - self.first_day, hi - self.first_day + 1)
+            rows = self.day_rows[days].copy()
+            mins = self.day_min_ns[days].copy()
+            maxs = self.day_max_ns[days].copy()
+            if clipped:
+                rows[-1] = self.day_midnight_rows[hi - self.first_day]
+                mins[-1] = maxs[-1] = end_day * NS_PER_DAY
+            total_rows = int(rows.sum())
+            present = np.flatnonzero(rows)
+            if present.size:
+                date_range = (pd.Timestamp(int(mins[present[0]])), pd.Timestamp(int(maxs[present[-1]])))
+
+            entries = slice(self.day_offsets[days.start], self.day_offsets[days.stop])
+            activity, cohort, user = self.activity[entries], self.cohort[entries], self.user[entries]
+            if clipped:
+                keep = (activity != end_day) | self.midnight[entries]
+                activity, cohort, user = activity[keep], cohort[keep], user[keep]
+
+        seen = np.zeros(self.n_users, dtype=bool)
+        seen[user[user != NO_USER]] = True
+        if start is None and end is None:
+            total_rows += self.nat_rows
+            seen[self.nat_users] = True
+
+        if self.self_cohort:
+            # Cohort = first active day of the user inside the window
+            first_day = np.full(self.n_users, np.iinfo(np.int64).max)
+            np.minimum.at(first_day, user, activity)
+            cohort = first_day[user]
+        else:
+            valid = cohort != NO_COHORT
+            activity, cohort, user = activity[valid], cohort[valid], user[valid]
+
+        cohort_keys = _period_keys(cohort, interval)
+        period_index = _period_keys(activity, interval) - cohort_keys
+        if interval == 'weekly':
+            period_index = period_index // 7
+        valid = period_index >= 0
+        cells = pd.DataFrame({
+            'CohortPeriod': cohort_keys[valid],
+            'PeriodIndex': period_index[valid],
+            'CustomerID': user[valid]
+        }).drop_duplicates()
+        # Cells reached only by rows without a user are kept with 0 users
+        known = (cells['CustomerID'] != NO_USER).rename('CustomerID')
+        cohort_data = known.groupby([cells['CohortPeriod'], cells['PeriodIndex']]).sum().reset_index()
+        cohort_data['CohortPeriod'] = _period_labels(cohort_data['CohortPeriod'].to_numpy(), interval)
+
+        return {
+            'cohort_data': cohort_data,
+            'total_rows': total_rows,
+            'unique_users': int(seen.sum()),
+            'date_range': date_range,
+        }
+
+
+class CohortIndexCache:
+    """
+    LRU cache of cohort indexes keyed by dataset file and column choice.
+
+    Indexes are built off the request path on a single background thread, from
+    the DataFrame of the first eligible analysis of a dataset. With a shared
+    directory, a built index is persisted there and reopened memory-mapped;
+    every worker process looks there before building, and builds under a file
+    lock of the key, so each index is built once per host and its pages are
+    shared by all workers.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = COHORT_INDEX_CACHE_SIZE,
+        directory: Optional[str] = AREAS["cohort_index"][0] if COHORT_INDEX_SHARED else None
+    ):
+        self.max_entries = max_entries
+        self.directory = Path(directory) if directory else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, CohortIndex]" = OrderedDict()
+        self._building = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cohort-index")
+        self._chunked_builds = SingleFlight()
+
+    @staticmethod
+    def key(file_path: str, user_col: str, cohort_col: str, event_col: str) -> Optional[Tuple]:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, user_col, cohort_col, event_col)
+
+    def _path(self, key: Tuple) -> Optional[Path]:
+        if self.directory is None:
+            return None
+        return self.directory / hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+    def get(self, key: Optional[Tuple]) -> Optional[CohortIndex]:
+        if key is None or self.max_entries <= 0:
+            return None
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+        if index is not None:
+            path = self._path(key)
+            if path is not None:
+                storage_manager.touch(path)
+            return index
+        # Built by another worker, or dropped from this worker's LRU
+        index = self._open(key)
+        if index is not None:
+            self._store(key, index)
+        return index
+
+    def _open(self, key: Tuple) -> Optional[CohortIndex]:
+        """The persisted index of key, memory-mapped, else None."""
+        path = self._path(key)
+        if path is None or not (path / "meta.json").exists():
+            return None
+        try:
+            index = CohortIndex.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            # Evicted while opening, or written by an incompatible version
+            logger.warning(f"Persisted cohort index not opened: {str(e)}")
+            return None
+        storage_manager.touch(path)
+        return index
+
+    def _build_shared(self, key: Tuple, build: Callable[[], CohortIndex]) -> CohortIndex:
+        """build() the index of key unless a worker persisted it already; returns the memory-mapped copy where possible."""
+        path = self._path(key)
+        if path is None:
+            return build()
+        with _file_lock(path.with_name(path.name + ".lock")):
+            index = self._open(key)
+            if index is not None:
+                logger.info("Opened the cohort index persisted by another worker")
+                return index
+            index = build()
+            try:
+                index.save(path)
+            except OSError as e:
+                logger.warning(f"Cohort index not persisted: {str(e)}")
+                return index
+            storage_manager.register(path)
+            # Swap the private arrays for the shared mapping
+            return self._open(key) or index
+
+    def wants_frame(self, key: Optional[Tuple]) -> bool:
+        """Whether an unfiltered frame of the dataset should be handed to build_async()."""
+        if key is None or self.max_entries <= 0:
+            return False
+        with self._lock:
+            return key not in self._entries and key not in self._building
+
+    def _claim(self, key: Optional[Tuple]) -> bool:
+        if key is None or self.max_entries <= 0:
+            return False
+        with self._lock:
+            if key in self._entries or key in self._building:
+                return False
+            self._building.add(key)
+            return True
+
+    def build_async(self, key: Optional[Tuple], df: pd.DataFrame) -> None:
+        if self._claim(key):
+            self._executor.submit(self._build, key, df)
+
+    def build(self, key: Optional[Tuple], df: pd.DataFrame) -> None:
+        """Build the index on the calling thread (unless it exists or is being built)."""
+        if self._claim(key):
+            self._build(key, df)
+
+    def build_chunked(
+        self,
+        key: Tuple,
+        chunks: Callable[[], Iterable[pd.DataFrame]],
+        columns: List[str],
+        numeric_columns: Set[str]
+    ) -> CohortIndex:
+        """
+        The index of key, built on the calling thread from chunks() unless it is cached.
+
+        For datasets too large to load whole: only one chunk is in memory at a
+        time. Concurrent callers for the same key share one build; errors propagate.
+        """
+        index = self.get(key)
+        if index is not None:
+            return index
+
+        def build():
+            index = self._build_shared(
+                key,
+                lambda: CohortIndex.from_chunks(chunks(), *key[3:], columns=columns, numeric_columns=numeric_columns)
+            )
+            self._store(key, index)
+            return index
+
+        index, _ = self._chunked_builds.do(key, build)
+        return index
+
+    def _build(self, key: Tuple, df: pd.DataFrame) -> None:
+        index = None
+        try:
+            index = self._build_shared(key, lambda: CohortIndex(df, *key[3:]))
+        except Exception as e:
+            logger.warning(f"Cohort index not built: {str(e)}")
+        with self._lock:
+            self._building.discard(key)
+            if index is not None:
+                self._put(key, index)
+
+    def _store(self, key: Tuple, index: CohortIndex) -> None:
+        with self._lock:
+            self._put(key, index)
+
+    def _put(self, key: Tuple, index: CohortIndex) -> None:
+        # Caller holds the lock
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = index
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+# Global instance
+cohort_index_cache = CohortIndexCache()
@@ -0,0 +1,146 @@
+# Per-dataset profile (row count, per-column stats) collected from analysis passes,
+# and the column schema inferred from a sample of each uploaded file
+import os
+import threading
+import orjson
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+from app.utils.logger import get_logger
+from app.utils.safe_iso import safe_iso
+from app.utils.schema_inference import infer_schema
+
+logger = get_logger(__name__)
+
+DATASET_PROFILE_CACHE_SIZE = int(os.getenv("DATASET_PROFILE_CACHE_SIZE", "32"))
+
+
+def dataset_key(file_path: str) -> Optional[Tuple]:
+    """Identity of a dataset file; changes whenever the file is replaced or rewritten."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+
+
+class DatasetProfileCache:
+    """
+    LRU cache of dataset profiles keyed by dataset_key().
+
+    Profiles are merged from the engine's profile of each analysis that covered
+    the whole dataset (no date filter, sampling or row-changing preprocessing),
+    so every analysed column contributes its stats once and later requests read
+    them without rescanning the file.
+    """
+
+    def __init__(self, max_entries: int = DATASET_PROFILE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+
+    def get(self, key: Optional[Tuple]) -> Optional[Dict[str, Any]]:
+        if key is None or self.max_entries <= 0:
+            return None
+        with self._lock:
+            profile = self._entries.get(key)
+            if profile is None:
+                return None
+            self._entries.move_to_end(key)
+            return {'row_count': profile['row_count'], 'columns': {c: dict(s) for c, s in profile['columns'].items()}}
+
+    def update(
+        self,
+        key: Optional[Tuple],
+        profile: Dict[str, Any],
+        user_col: str,
+        event_col: str,
+        revenue_col: Optional[str] = None
+    ) -> None:
+        """Merge an engine profile (see CohortAnalysisService) into the dataset's cached profile."""
+        if key is None or self.max_entries <= 0:
+            return
+        columns = {col: {'null_count': count} for col, count in profile['null_counts'].items()}
+        columns.setdefault(user_col, {})['unique_count'] = profile['unique_users']
+        start, end = profile['date_range']
+        columns.setdefault(event_col, {}).update(min=safe_iso(start), max=safe_iso(end))
+        if revenue_col and profile.get('revenue_total') is not None:
+            columns.setdefault(revenue_col, {})['sum'] = profile['revenue_total']
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None or cached['row_count'] != profile['row_count']:
+                cached = self._entries[key] = {'row_count': profile['row_count'], 'columns': {}}
+            for col, stats in columns.items():
+                cached['columns'].setdefault(col, {}).update(stats)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ColumnSchemaStore:
+    """
+    Inferred column schema (see schema_inference.infer_schema) of uploaded files.
+
+    Schemas are inferred once per file version, written next to the file as
+    <file>.schema.json and kept in a small LRU, so lookups never touch the data.
+    """
+
+    SUFFIX = ".schema.json"
+
+    def __init__(self, max_entries: int = DATASET_PROFILE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+
+    def _remember(self, key: Tuple, schema: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = schema
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def cached(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """Schema of the current file version from memory or its sidecar, without inferring it."""
+        key = dataset_key(file_path)
+        if key is None:
+            return None
+        with self._lock:
+            schema = self._entries.get(key)
+            if schema is not None:
+                self._entries.move_to_end(key)
+                return schema
+        try:
+            with open(file_path + self.SUFFIX, "rb") as f:
+                schema = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+        # The sidecar describes an older version of the file
+        if schema.get('source') != {'mtime_ns': key[1], 'size': key[2]}:
+            return None
+        self._remember(key, schema)
+        return schema
+
+    def get(self, file_path: str) -> Dict[str, Any]:
+        """Schema of the file, inferring and persisting it on first use."""
+        schema = self.cached(file_path)
+        if schema is not None:
+            return schema
+        key = dataset_key(file_path)
+        if key is None:
+            raise FileNotFoundError(file_path)
+        schema = {'source': {'mtime_ns': key[1], 'size': key[2]}, **infer_schema(file_path)}
+        tmp_path = f"{file_path}{self.SUFFIX}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(orjson.dumps(schema))
+            os.replace(tmp_path, file_path + self.SUFFIX)
+        except OSError as e:
+            logger.warning(f"Could not write schema sidecar for {file_path}: {str(e)}")
+        logger.info(f"Inferred schema of {file_path} from {schema['sample_rows']} sampled rows")
+        self._remember(key, schema)
+        return schema
+
+
+# Global instances
+dataset_profiles = DatasetProfileCache()
+column_schemas = ColumnSchemaStore()
@@ -0,0 +1,122 @@
+# TTL cache of database schema reflection (tables, columns and their types) per connection URL
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+DB_SCHEMA_TTL_SECONDS = float(os.getenv("DB_SCHEMA_TTL_SECONDS", "300"))
+DB_SCHEMA_CACHE_SIZE = int(os.getenv("DB_SCHEMA_CACHE_SIZE", "16"))
+
+COLUMNS_QUERY = (
+    "SELECT table_name, column_name, data_type FROM information_schema.columns "
+    "WHERE table_schema='public' ORDER BY table_name, ordinal_position"
+)
+
+
+class DBSchemaCache:
+    """
+    Reflected schemas of databases, keyed by connection URL.
+
+    Columns and types of every table are fetched with one information_schema.columns
+    query and served from memory until the entry is older than ttl_seconds or is
+    invalidated. Engines are kept per URL so refreshes reuse the connection pool;
+    URLs are user-supplied, so only the max_urls most recently used are kept and
+    the engines of the others are disposed.
+    """
+
+    def __init__(self, ttl_seconds: float = DB_SCHEMA_TTL_SECONDS, max_urls: int = DB_SCHEMA_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_urls = max(1, max_urls)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._engines: "OrderedDict[str, Any]" = OrderedDict()
+
+    def _evict_locked(self) -> List[Any]:
+        """Drop least recently used URLs beyond max_urls; returns their engines to dispose outside the lock."""
+        evicted = []
+        while len(self._entries) > self.max_urls:
+            self._entries.popitem(last=False)
+        while len(self._engines) > self.max_urls:
+            url, engine = self._engines.popitem(last=False)
+            self._entries.pop(url, None)
+            evicted.append(engine)
+        return evicted
+
+    @staticmethod
+    def _dispose(engines: List[Any]) -> None:
+        for engine in engines:
+            engine.dispose()
+
+    def engine(self, db_url: str):
+        # Imported here so workers that never browse a database don't pay for SQLAlchemy at startup
+        import sqlalchemy # type: ignore
+        with self._lock:
+            engine = self._engines.get(db_url)
+            if engine is None:
+                engine = self._engines[db_url] = sqlalchemy.create_engine(db_url)
+            self._engines.move_to_end(db_url)
+            evicted = self._evict_locked()
+        self._dispose(evicted)
+        return engine
+
+    def _reflect(self, db_url: str) -> Dict[str, List[Dict[str, str]]]:
+        import sqlalchemy # type: ignore
+        engine = self.engine(db_url)
+        tables: Dict[str, List[Dict[str, str]]] = {}
+        with engine.connect() as conn:
+            try:
+                rows = conn.execute(sqlalchemy.text(COLUMNS_QUERY)).fetchall()
+            except sqlalchemy.exc.DBAPIError:
+                rows = None
+            if rows is not None:
+                for table_name, column_name, data_type in rows:
+                    tables.setdefault(table_name, []).append({"name": column_name, "type": data_type})
+                return tables
+        # Databases without information_schema (e.g. SQLite): reflect table by table
+        inspector = sqlalchemy.inspect(engine)
+        for table_name in inspector.get_table_names():
+            tables[table_name] = [
+                {"name": column["name"], "type": str(column["type"])}
+                for column in inspector.get_columns(table_name)
+            ]
+        return tables
+
+    def get(self, db_url: str) -> Dict[str, List[Dict[str, str]]]:
+        """{table: [{name, type}, ...]} for the database, reflected at most once per TTL."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(db_url)
+            if entry is not None and now - entry["fetched_at"] < self.ttl_seconds:
+                self._entries.move_to_end(db_url)
+                if db_url in self._engines:
+                    self._engines.move_to_end(db_url)
+                return entry["tables"]
+        logger.info("Reflecting database schema")
+        tables = self._reflect(db_url)
+        with self._lock:
+            self._entries[db_url] = {"fetched_at": now, "tables": tables}
+            self._entries.move_to_end(db_url)
+            evicted = self._evict_locked()
+        self._dispose(evicted)
+        return tables
+
+    def invalidate(self, db_url: Optional[str] = None) -> int:
+        """Drop the cached schema (and engine) of db_url, or of every database; returns how many were dropped."""
+        with self._lock:
+            urls = [db_url] if db_url is not None else list(set(self._entries) | set(self._engines))
+            dropped, engines = 0, []
+            for url in urls:
+                dropped += self._entries.pop(url, None) is not None
+                engine = self._engines.pop(url, None)
+                if engine is not None:
+                    engines.append(engine)
+        self._dispose(engines)
+        return dropped
+
+
+# Global instance
+db_schema_cache = DBSchemaCache()
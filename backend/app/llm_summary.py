@@ -1,37 +1,208 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
-import requests
-from typing import List
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from typing import List, Dict, Any, Optional
 from app.utils.logger import get_logger
+from app.utils.compact import decode_table
 
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+GROQ_MODEL = "llama-3.1-8b-instant"
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "3"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "30"))
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "4"))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "256"))
+# ~6000 tokens; the digest is shrunk until it fits
+MAX_DIGEST_CHARS = 23500
 logger = get_logger(__name__)
 
-def build_prompt(analysis_results: dict) -> str:
+# Pooled HTTP client shared by all insight requests, created on first use
+_session = None
+_session_lock = threading.Lock()
+
+
+def _http_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            adapter = HTTPAdapter(
+                pool_connections=LLM_WORKERS,
+                pool_maxsize=LLM_WORKERS,
+                max_retries=Retry(total=2, read=0, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504), allowed_methods=None),
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+# Background workers so insight generation never blocks an analysis response
+insights_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm-insights")
+
+
+class InsightsCache:
+    """Thread-safe LRU cache of insights keyed by the digest hash."""
+
+    def __init__(self, max_entries: int = LLM_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, List[str]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return list(self._entries[key])
+
+    def put(self, key: str, insights: List[str]) -> None:
+        with self._lock:
+            self._entries[key] = list(insights)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+insights_cache = InsightsCache()
+
+
+def _table_frame(table: Optional[Dict[str, Dict[str, float]]]) -> Optional[pd.DataFrame]:
+    """Nested {cohort: {period: value}} dict -> DataFrame with integer period columns."""
+    if not table:
+        return None
+    frame = pd.DataFrame.from_dict(table, orient="index")
+    if frame.empty:
+        return None
+    frame.columns = [int(c) for c in frame.columns]
+    return frame[sorted(frame.columns)]
+
+
+def _result_frame(cohort_results: Dict[str, Any], name: str) -> Optional[pd.DataFrame]:
+    if cohort_results.get("format") == "compact":
+        return decode_table(cohort_results, name)
+    return _table_frame(cohort_results.get(name))
+
+
+def _rounded(values, digits: int = 4) -> List[Optional[float]]:
+    return [None if pd.isna(v) else round(float(v), digits) for v in values]
+
+
+def _digest_sections(data: Dict[str, Any], max_periods: int, top_n: int) -> Dict[str, Any]:
+    cohort_results = data.get("cohort_analysis") or {}
+    digest: Dict[str, Any] = {
+        "dataset": {
+            "total_rows": data.get("total_rows"),
+            "unique_users": data.get("unique_users"),
+            "date_range": data.get("date_range"),
+            "cohort_interval": data.get("cohort_interval"),
+            "analysis_metric": data.get("analysis_metric"),
+            "total_revenue": data.get("total_revenue"),
+        }
+    }
+
+    if cohort_results.get("format") == "compact":
+        sizes = pd.Series(cohort_results.get("cohort_sizes") or [], index=cohort_results.get("cohorts"), dtype=float)
+    else:
+        sizes = pd.Series(cohort_results.get("cohort_sizes") or {}, dtype=float)
+    if not sizes.empty:
+        digest["cohort_sizes"] = {
+            "cohorts": int(sizes.size),
+            "min": int(sizes.min()),
+            "median": float(sizes.median()),
+            "max": int(sizes.max()),
+            "largest": {k: int(v) for k, v in sizes.nlargest(top_n).items()},
+            "first": sizes.index[0],
+            "last": sizes.index[-1],
+        }
+
+    retention = _result_frame(cohort_results, "retention_table")
+    if retention is not None:
+        periods = retention.iloc[:, :max_periods]
+        section = {
+            "periods": int(retention.shape[1]),
+            "mean_by_period": _rounded(periods.mean()),
+            "median_by_period": _rounded(periods.median()),
+            "cohorts_observed_by_period": [int(v) for v in periods.count()],
+        }
+        if 1 in retention.columns:
+            first_period = retention[1].dropna()
+            section["best_period_1"] = dict(zip(first_period.nlargest(top_n).index, _rounded(first_period.nlargest(top_n))))
+            section["worst_period_1"] = dict(zip(first_period.nsmallest(top_n).index, _rounded(first_period.nsmallest(top_n))))
+        digest["retention"] = section
+
+    revenue = _result_frame(cohort_results, "revenue_table")
+    if revenue is not None:
+        section = {"total_by_period": _rounded(revenue.iloc[:, :max_periods].sum(), 2)}
+        arpu = _result_frame(cohort_results, "arpu_table")
+        if arpu is not None:
+            section["mean_arpu_by_period"] = _rounded(arpu.iloc[:, :max_periods].mean(), 2)
+        ltv = _result_frame(cohort_results, "ltv_table")
+        if ltv is not None:
+            final_ltv = ltv.ffill(axis=1).iloc[:, -1]
+            section["highest_ltv_cohorts"] = dict(zip(final_ltv.nlargest(top_n).index, _rounded(final_ltv.nlargest(top_n), 2)))
+        digest["revenue"] = section
+    return digest
+
+
+def build_digest(analysis_results: Dict[str, Any], max_chars: int = MAX_DIGEST_CHARS) -> Dict[str, Any]:
+    """
+    Summarise analysis results into a compact statistical digest for the prompt.
+
+    Instead of cutting raw JSON mid-table, per-period aggregates and top/bottom
+    cohorts are computed, and the level of detail is reduced until the JSON
+    form fits within max_chars.
+    """
+    max_periods, top_n = 36, 5
+    while True:
+        digest = _digest_sections(analysis_results, max_periods, top_n)
+        if len(json.dumps(digest, default=str)) <= max_chars or max_periods <= 1:
+            return digest
+        max_periods = max(1, max_periods // 2)
+        top_n = max(1, top_n - 1)
+
+
+def digest_key(digest: Dict[str, Any]) -> str:
+    payload = json.dumps({"model": GROQ_MODEL, "digest": digest}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def build_prompt(digest_json: str) -> str:
     return (
-        "You are a data analyst. Given the following cohort analysis results, "
+        "You are a data analyst. Given the following statistical digest of cohort analysis results, "
         "draw 3 to 5 key observations or insights (go to 5 only if the dataset is sufficient). "
         "Be concise and focus on actionable findings. Do not print anything else just the points and try to make it one or two liner. "
-        "Here is the data (truncated to fit within 6000 tokens):\n"
-        f"{analysis_results}\n"
+        "Here is the digest (per-period aggregates and notable cohorts):\n"
+        f"{digest_json}\n"
         "List the insights as bullet points."
     )
 
-def get_llm_insights(analysis_results: dict) -> List[str]:
+
+def cached_llm_insights(digest: Dict[str, Any]) -> Optional[List[str]]:
+    return insights_cache.get(digest_key(digest))
+
+
+def get_llm_insights(digest: Dict[str, Any]) -> List[str]:
+    """Blocking call to the LLM for a digest built by build_digest(); results are cached."""
+    key = digest_key(digest)
+    cached = insights_cache.get(key)
+    if cached is not None:
+        logger.info("LLM insights served from cache.")
+        return cached
     if not GROQ_API_KEY:
         logger.error("GROQ API key not configured")
         raise RuntimeError("GROQ API key not configured")
-    # Truncate the analysis_results to fit within 6000 tokens (approx 24000 chars)
-    import json
-    max_chars = 23500  # ~6000 tokens
-    analysis_json = json.dumps(analysis_results)
-    if len(analysis_json) > max_chars:
-        analysis_json = analysis_json[:max_chars] + "...(truncated)"
-    prompt = build_prompt(analysis_json)
+    prompt = build_prompt(json.dumps(digest, default=str))
     payload = {
-        "model": "llama-3.1-8b-instant",
+        "model": GROQ_MODEL,
         "messages": [
             {"role": "user", "content": prompt}
         ],
@@ -43,12 +214,16 @@ def get_llm_insights(analysis_results: dict) -> List[str]:
         "Content-Type": "application/json"
     }
     logger.info("Sending request to GROQ API for LLM insights.")
-    response = requests.post(GROQ_API_URL, json=payload, headers=headers)
+    response = _http_session().post(
+        GROQ_API_URL, json=payload, headers=headers, timeout=(LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT)
+    )
     if response.status_code != 200:
         logger.error(f"GROQ API error: {response.text}")
         raise RuntimeError(f"GROQ API error: {response.text}")
     data = response.json()
     content = data["choices"][0]["message"]["content"]
     insights = [line.strip("-• ") for line in content.splitlines() if line]
+    insights_cache.put(key, insights)
     logger.info("LLM insights received successfully.")
     return insights
+
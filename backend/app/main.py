@@ -1,25 +1,56 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Query, FastAPI # type: ignore
+from fastapi import APIRouter, UploadFile, File, HTTPException, Query, FastAPI, Header, Request # type: ignore
 import pandas as pd
-import sqlalchemy # type: ignore
 from app.utils.file_handler import file_handler
 from app.utils.supabase_handler import save_tables_to_csvs, create_zip_with_csvs_and_heatmap
-from app.supabase_client import upload_zip_and_get_url, save_job, update_job, get_job
+from app.supabase_client import upload_zip_and_get_url, save_job, update_job, get_job, save_job_profile, get_job_profile, update_job_insights, check_job_store
 import os
 from app.models.upload import UploadResponse
 import uuid
 from fastapi.staticfiles import StaticFiles # type: ignore # type: ignore
 # from app.routers import uploadRouter
 from fastapi.middleware.cors import CORSMiddleware # type: ignore
+from fastapi.middleware.gzip import GZipMiddleware # type: ignore
 from pathlib import Path
 from app.utils.logger import get_logger
 from app.utils.safe_iso import safe_iso
-from app.models.analyze import AnalysisRequest
+from app.models.analyze import AnalysisRequest, BatchAnalysisRequest
+from pydantic import ValidationError
 from app.analysis import cohort_service
-from app.llm_summary import get_llm_insights
+from app.llm_summary import get_llm_insights, build_digest, cached_llm_insights, insights_executor
+from app.utils.metrics import track_stage, request_timings, metrics_registry
 from fastapi import BackgroundTasks
+from fastapi.responses import PlainTextResponse, Response # type: ignore
+from app.utils.profiling import RequestProfiler, should_profile, has_profile_token, profiling_slot
+from app.utils.compact import encode_response, decode_table, nested_layout
+from app.utils.result_store import result_store
+from app.utils.single_flight import SingleFlight
+from app.utils.storage_manager import storage_manager
+from app.cohort_index import cohort_index_cache, CohortIndex
+from app.warmup import dataset_warmup
+from app.admission import (
+    admission_controller, AdmissionRejected, JobCost, ADMISSION_CHUNK_ROWS, PRIORITY_PREVIEW, PRIORITY_INTERACTIVE,
+    PRIORITY_BATCH, PRIORITY_WARMUP, estimate_rows, estimate_cost, chunked_cost, indexed_cost, batch_cost,
+    default_cost
+)
+from app.db_schema import db_schema_cache
+from app.dataset_profile import dataset_profiles, dataset_key, column_schemas
+from app.utils.file_readers import CSV_ENCODINGS, COLUMNAR_FORMATS, SUPPORTED_EXTENSIONS, file_extension, is_csv, read_csv_bytes, read_columnar, iter_frames
+from fastapi.concurrency import run_in_threadpool
+import json
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from contextlib import asynccontextmanager, contextmanager
 
 from typing import Optional
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep uploads, exports, results and charts within their quotas while serving
+    storage_manager.start()
+    yield
+    storage_manager.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 
 # Setup CORS middleware
@@ -30,7 +61,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compress large responses (cohort matrices are highly repetitive)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 logger = get_logger(__name__)
+# Preview requests return the sampled result if it is ready within this many seconds
+PREVIEW_BUDGET_SECONDS = float(os.getenv("PREVIEW_BUDGET_SECONDS", "3"))
+preview_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PREVIEW_WORKERS", "2")), thread_name_prefix="analysis-preview")
+# Identical analyses running at the same time share one computation (and job)
+analysis_flights = SingleFlight()
+# Configs of one /api/analysis/batch request run concurrently on these threads
+BATCH_MAX_CONFIGS = int(os.getenv("BATCH_MAX_CONFIGS", "50"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="analysis-batch")
 # Create static directory if it doesn't exist
 static_dir = Path("static")
 static_dir.mkdir(exist_ok=True)
@@ -45,14 +87,28 @@ logger.info("Static files mounted at /static")
 @app.post("/api/upload", response_model=UploadResponse)
 async def upload_file(file: UploadFile = File(...)):
     # Generate a random filename to avoid overwriting existing files
-    ext = os.path.splitext(file.filename)[1]
+    ext = file_extension(file.filename)
     random_filename = f"{uuid.uuid4().hex}{ext}"
     file.filename = random_filename  # Set the new filename before saving
 
     logger.info(f"Uploading file: {file.filename}")
     filename = await file_handler.save_file(file)
     logger.info(f"File uploaded successfully: {filename}")
-    
+
+    # Profile a sample now so /api/schema and the loader never have to
+    try:
+        schema = await run_in_threadpool(column_schemas.get, str(file_handler.upload_dir / filename))
+    except Exception as e:
+        logger.warning(f"Could not profile columns of {filename}: {str(e)}")
+    else:
+        # Use the idle time until the first analysis to load and index the likely columns
+        dataset_warmup.schedule(
+            dataset_key(f"uploads/{filename}"),
+            lambda checkpoint: warm_dataset(filename, schema, checkpoint)
+        )
+    # Registered after profiling so the schema sidecar counts towards the upload's size
+    storage_manager.register(file_handler.upload_dir / filename)
+
     return UploadResponse(
         filename=filename,
         message="File uploaded successfully"
@@ -70,19 +126,24 @@ def get_schema(
 
     # DB URL: fetch tables and columns
     if db_url:
+        column_types = []
         try:
             logger.info(f"Fetching schema from DB URL: {db_url}")
-            engine = sqlalchemy.create_engine(db_url)
-            with engine.connect() as conn:
-                result = conn.execute(sqlalchemy.text("SELECT table_name FROM information_schema.tables WHERE table_schema='public'"))
-                tables = [row[0] for row in result]
-                if table:
+            # Reflected once per DB_SCHEMA_TTL_SECONDS; browsing tables reads the cache
+            schema = db_schema_cache.get(db_url)
+            tables = sorted(schema)
+            if table in schema:
+                column_types = schema[table]
+                columns = [column["name"] for column in column_types]
+            elif table:
+                # Tables outside the reflected schema (e.g. schema-qualified names)
+                with db_schema_cache.engine(db_url).connect() as conn:
                     df = pd.read_sql_query(f"SELECT * FROM {table} LIMIT 1", conn)
-                    columns = list(df.columns)
+                columns = list(df.columns)
         except Exception as e:
             logger.error(f"Error connecting to database: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error connecting to database: {str(e)}")
-        return {"tables": tables, "columns": columns}
+        return {"tables": tables, "columns": columns, "column_types": column_types}
 
     # File: fetch tables and columns
     if filename:
@@ -90,25 +151,25 @@ def get_schema(
             logger.error(f"File not found: {filename}")
             raise HTTPException(status_code=404, detail="File not found")
         file_path = file_handler.upload_dir / filename
-        ext = os.path.splitext(filename)[1].lower()
+        storage_manager.touch(file_path)
 
-        if ext == ".csv":
+        if file_extension(filename) in SUPPORTED_EXTENSIONS:
             try:
-                logger.info(f"Reading CSV file for columns: {filename}")
-                encodings = ['utf-8', 'latin1', 'cp1252', 'iso-8859-1', 'utf-8-sig']
-                for encoding in encodings:
-                    try:
-                        df = pd.read_csv(file_path, encoding=encoding)
-                        break
-                    except UnicodeDecodeError:
-                        continue
-                else:
-                    raise HTTPException(status_code=400, detail="Unable to read CSV file. Please check the file encoding.")
-                columns = list(df.columns)
+                # Inferred at upload; files uploaded before profiling existed are sampled once here
+                schema = column_schemas.get(str(file_path))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
             except Exception as e:
-                logger.error(f"Error reading CSV: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Error reading CSV: {str(e)}")
-            return {"tables": [], "columns": columns}
+                logger.error(f"Error reading file: {str(e)}")
+                raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
+            return {
+                "tables": [],
+                "columns": [column["name"] for column in schema["columns"]],
+                "column_profiles": schema["columns"],
+                "candidates": schema["candidates"],
+                # Row count and column stats gathered by earlier analyses of this file, if any
+                "profile": dataset_profiles.get(dataset_key(str(file_path)))
+            }
         else:
             logger.error("Unsupported file type for schema extraction")
             raise HTTPException(status_code=400, detail="Unsupported file type")
@@ -116,74 +177,263 @@ def get_schema(
     logger.error("Must provide either filename or db_url")
     raise HTTPException(status_code=400, detail="Must provide either filename or db_url")
 
-def zip_and_upload_task(job_id, tables, chart_data, output_dir, zip_name, supabase_zip_path):
-    csv_paths = save_tables_to_csvs(tables, output_dir)
-    heatmap_file_path = None
-    for v in chart_data.values():
-        heatmap_file_path = v
-    zip_path = create_zip_with_csvs_and_heatmap(csv_paths, heatmap_file_path)
-    download_url = upload_zip_and_get_url(zip_path, supabase_zip_path)
-    update_job(job_id, "ready", download_url)
+@app.post("/api/schema/invalidate")
+def invalidate_schema(db_url: Optional[str] = Query(None, description="Database URL; omit to drop every cached schema")):
+    """Drop cached database schemas so the next /api/schema call reflects the database again."""
+    return {"invalidated": db_schema_cache.invalidate(db_url)}
 
-@app.post("/api/analysis")
-def analyze_data(payload: AnalysisRequest, background_tasks: BackgroundTasks):
+@app.get("/api/admission")
+def admission_status():
+    """Memory budget and CPU slots of this worker's admission control, and the jobs running and queued."""
+    return admission_controller.stats()
+
+@app.get("/api/storage")
+def storage_usage():
+    """Bytes, quota, artifact count and pinned artifacts of each working directory."""
+    return storage_manager.usage()
+
+@app.post("/api/storage/sweep")
+def storage_sweep():
+    """Evict expired and over-quota artifacts now instead of at the next background sweep."""
+    return {"evicted": storage_manager.sweep(), "usage": storage_manager.usage()}
+
+@app.post("/api/warmup/cancel")
+def cancel_warmup(filename: Optional[str] = Query(None, description="Uploaded file; omit to cancel every pending warm-up")):
+    """Cancel speculative upload warm-ups that haven't finished yet."""
+    key = dataset_key(f"uploads/{filename}") if filename else None
+    if filename and key is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return {"cancelled": dataset_warmup.cancel(key)}
+
+def zip_and_upload_task(job_id, tables, chart_data, output_dir, zip_name, supabase_zip_path, load_analysis_data=None):
     try:
-        job_id = uuid.uuid4().hex
-        save_job(job_id, "processing")
-        logger.info("____________PROCESS STARTED____________")
-        logger.info(f"Running analysis")
-        logger.info(f"Payload: {payload}")
-        df = None
-        logger.info(f"Selected table for analysis: {payload.selectedTable}")
-
-        # --- Handle DB URL case ---
-        if payload.dbUrl:
-            try:
+        with track_stage("export") as stage:
+            if load_analysis_data is not None:
+                # Index-served analyses never loaded the events; read them now, off the request path
+                tables = {"analysis_data": load_analysis_data(), **tables}
+            # Streamed tables (chunked analyses) are written chunk by chunk and not counted here
+            stage.rows = sum(len(t) for t in tables.values() if isinstance(t, pd.DataFrame))
+            csv_paths = save_tables_to_csvs(tables, output_dir)
+            storage_manager.register(output_dir, job_id)
+            heatmap_file_path = None
+            for v in chart_data.values():
+                heatmap_file_path = v
+            zip_path = create_zip_with_csvs_and_heatmap(csv_paths, heatmap_file_path)
+            storage_manager.register(zip_path, job_id)
+            download_url = upload_zip_and_get_url(zip_path, supabase_zip_path)
+        update_job(job_id, "ready", download_url)
+    finally:
+        # The export was the job's last use of its upload and artifacts
+        storage_manager.release(job_id)
+
+def llm_insights_task(job_id, digest):
+    try:
+        with track_stage("llm"):
+            insights = get_llm_insights(digest)
+        update_job_insights(job_id, "ready", insights)
+    except Exception as e:
+        logger.warning(f"LLM summary failed: {str(e)}")
+        update_job_insights(job_id, "failed", [])
+
+def load_dataframe(payload: AnalysisRequest, columns: Optional[list] = None, window=None) -> pd.DataFrame:
+    """
+    Load the analysis source (database table/query or uploaded file) into a DataFrame.
+
+    For Parquet and Feather uploads only the given columns are read, and with a
+    (start, end) window rows outside it are skipped (Parquet prunes whole row groups).
+    """
+    df = None
+    # --- Handle DB URL case ---
+    if payload.dbUrl:
+        try:
+            with track_stage("load") as stage:
+                # Only database sources need SQLAlchemy; keep it out of worker startup
+                import sqlalchemy # type: ignore
                 engine = sqlalchemy.create_engine(payload.dbUrl)
                 with engine.connect() as conn:
-                    if payload.sqlQuery:
+                    if getattr(payload, "sqlQuery", None):
                         df = pd.read_sql_query(payload.sqlQuery, conn)
                     elif getattr(payload, "selectedTable", None):
                         df = pd.read_sql_table(payload.selectedTable, conn)
                     else:
                         logger.error("No SQL query or table specified for DB URL")
                         raise HTTPException(status_code=400, detail="No SQL query or table specified for DB URL")
-            except Exception as e:
-                logger.error(f"Error loading data from database: {str(e)}")
-                raise HTTPException(status_code=400, detail=f"Error loading data from database: {str(e)}")
-        else:
-            # --- Handle file upload case ---
-            file_path = f"uploads/{payload.filename}"
-            if not os.path.exists(file_path):
-                logger.error(f"File not found: {file_path}")
-                raise HTTPException(status_code=404, detail="File not found")
-
-            ext = os.path.splitext(payload.filename)[1].lower()
-
-            if ext == ".csv":
-                # --- Handle CSV file upload case ---
-                encodings = ['utf-8', 'latin1', 'cp1252', 'iso-8859-1', 'utf-8-sig']
-                for encoding in encodings:
-                    try:
-                        df = pd.read_csv(file_path, encoding=encoding)
-                        break
-                    except UnicodeDecodeError:
-                        continue
-
-                if df is None:
-                    logger.error("Unable to read CSV file. Please check the file encoding.")
-                    raise HTTPException(status_code=400, detail="Unable to read CSV file. Please check the file encoding.")
+                stage.rows = len(df)
+        except Exception as e:
+            logger.error(f"Error loading data from database: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Error loading data from database: {str(e)}")
+        return df
 
-            else:
-                logger.error("Unsupported file type for analysis")
-                raise HTTPException(status_code=400, detail="Unsupported file type for analysis")
+    # --- Handle file upload case ---
+    file_path = f"uploads/{payload.filename}"
+    if not os.path.exists(file_path):
+        logger.error(f"File not found: {file_path}")
+        raise HTTPException(status_code=404, detail="File not found")
+    storage_manager.touch(file_path)
+
+    ext = file_extension(payload.filename)
+
+    if is_csv(ext):
+        # --- Handle CSV file upload case (plain, .csv.gz or .csv.zst) ---
+        # Read the bytes once so encoding fallbacks don't hit the disk again;
+        # compressed files stay compressed in memory and are inflated while parsing
+        with track_stage("load"):
+            with open(file_path, "rb") as f:
+                raw = f.read()
+        with track_stage("decode") as stage:
+            encodings = list(CSV_ENCODINGS)
+            schema = column_schemas.cached(file_path)
+            if schema and schema.get("encoding"):
+                # Start with the encoding the upload-time sample decoded with
+                encodings.sort(key=lambda encoding: encoding != schema["encoding"])
+            df, _ = read_csv_bytes(raw, ext, encodings)
+            stage.rows = len(df) if df is not None else 0
+
+        if df is None:
+            logger.error("Unable to read CSV file. Please check the file encoding.")
+            raise HTTPException(status_code=400, detail="Unable to read CSV file. Please check the file encoding.")
+
+    elif ext in COLUMNAR_FORMATS:
+        # --- Handle Parquet/Feather upload case ---
+        start, end = window if window is not None else (None, None)
+        try:
+            with track_stage("load") as stage:
+                df = read_columnar(file_path, ext, columns=columns, date_column=payload.eventColumn, start=start, end=end)
+                stage.rows = len(df)
+        except Exception as e:
+            logger.error(f"Error reading {ext} file: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Error reading {ext} file: {str(e)}")
+
+    else:
+        logger.error("Unsupported file type for analysis")
+        raise HTTPException(status_code=400, detail="Unsupported file type for analysis")
+    return df
+
+def upload_date_formats(payload: AnalysisRequest) -> dict:
+    """Date formats inferred at upload per column of an uploaded CSV (empty for other sources)."""
+    if payload.dbUrl or not payload.filename:
+        return {}
+    schema = column_schemas.cached(f"uploads/{payload.filename}")
+    if not schema:
+        return {}
+    return {column["name"]: column["date_format"] for column in schema["columns"] if column["date_format"]}
+
+def parse_dates(values: pd.Series, date_format: Optional[str] = None) -> pd.Series:
+    """pd.to_datetime with the inferred format, falling back to inference when the sample's format doesn't fit."""
+    if date_format is not None:
+        try:
+            return pd.to_datetime(values, format=date_format)
+        except (ValueError, TypeError):
+            pass
+    return pd.to_datetime(values)
 
-        # --- Preprocessing, filtering, cohort analysis, summary, etc. ---
+def prepare_dataframe(payload: AnalysisRequest, index_key=None) -> pd.DataFrame:
+    """Load the source, apply outlier handling, parse dates and apply the date and column filters."""
+    # Data cleaning: capping or removing outliers
+    preprocessing = payload.preprocessing or {}
+    data_cleaning = preprocessing.dataCleaning if preprocessing else {}
+    cleaning = getattr(data_cleaning, "capping", False) or getattr(data_cleaning, "remove", False)
 
-        # Data cleaning: capping or removing outliers
-        preprocessing = payload.preprocessing or {}
-        data_cleaning = preprocessing.dataCleaning if preprocessing else {}
+    # Columnar files can skip unused columns and out-of-window rows while reading, unless
+    # the outlier caps (computed over every row and numeric column) or a pending index need them
+    warmed = warm_frame(payload)
+    if warmed is not None:
+        df, parsed = warmed
+    else:
+        columns, window = None, None
+        if not cleaning and not cohort_index_cache.wants_frame(index_key):
+            schema = column_schemas.cached(f"uploads/{payload.filename}") if payload.filename and not payload.dbUrl else None
+            if payload.columns and schema:
+                columns = analysis_columns(payload, [column["name"] for column in schema["columns"]])
+            if payload.startDate or payload.endDate:
+                window = (
+                    pd.to_datetime(payload.startDate) if payload.startDate else None,
+                    pd.to_datetime(payload.endDate) if payload.endDate else None
+                )
+        df, parsed = load_dataframe(payload, columns, window), frozenset()
 
+    # --- Preprocessing, filtering, cohort analysis, summary, etc. ---
+    df = clean_outliers(df, data_cleaning)
+    date_columns = [col for col in (payload.cohortGrouping, payload.eventColumn) if col not in parsed]
+    parse_date_columns(df, date_columns, upload_date_formats(payload))
+
+    if index_key is not None and not cleaning:
+        # Index the unfiltered events so later date/interval changes skip the raw data
+        cohort_index_cache.build_async(index_key, df)
+    return filter_frame(df, payload)
+
+def warm_frame(payload: AnalysisRequest):
+    """
+    (df, date columns already parsed) from the upload's warm-up, else None.
+
+    df is a shallow copy, so callers may assign columns without touching the
+    warmed frame. Without a warmed frame the caller loads the file itself, and a
+    warm-up of the dataset that is still pending would only repeat that work.
+    """
+    if payload.dbUrl or not payload.filename:
+        return None
+    key = dataset_key(f"uploads/{payload.filename}")
+    warmed = dataset_warmup.frame(key)
+    if warmed is None:
+        dataset_warmup.cancel(key)
+        return None
+    logger.info("Using the warmed-up frame of the dataset")
+    df, parsed = warmed
+    return df.copy(deep=False), parsed
+
+def warm_dataset(filename: str, schema: dict, checkpoint) -> None:
+    """
+    Speculative warm-up of an upload, run by dataset_warmup.
+
+    Loads the file, parses the likely timestamp column and builds the cohort
+    index (factorized users, per-day aggregation) for the likely user-ID and
+    timestamp columns, so the first analysis starts from warm state. Datasets
+    too large to load whole are only indexed, chunk by chunk. The work is
+    admitted at the lowest priority like any job; when the queue turns it
+    away the warm-up is skipped.
+    """
+    candidates = schema.get("candidates") or {}
+    if not candidates.get("user_id") or not candidates.get("timestamp"):
+        return
+    timestamp_col = candidates["timestamp"][0]
+    payload = AnalysisRequest(
+        filename=filename,
+        userId=candidates["user_id"][0],
+        cohortGrouping=timestamp_col,
+        eventColumn=timestamp_col,
+        analysisMetric="retention",
+        cohortInterval="daily",
+        columns=[]
+    )
+    key = dataset_key(f"uploads/{filename}")
+    checkpoint()
+    cost = analysis_cost(payload, use_index=False)
+    try:
+        if admission_controller.oversized(cost):
+            # Too large to hold a warmed frame; index it chunk by chunk like the analyses will
+            chunked = chunked_index_build(payload, cost.rows)
+            if chunked is not None:
+                with admission_controller.admit(chunked[0], PRIORITY_WARMUP):
+                    checkpoint(wait=False)
+                    if chunked[1]() is not None:
+                        logger.info(f"Warmed up {filename} through the chunked path")
+            return
+        with admission_controller.admit(cost, PRIORITY_WARMUP):
+            checkpoint(wait=False)
+            df = load_dataframe(payload)
+            checkpoint(wait=False)
+            parse_date_columns(df, [timestamp_col], upload_date_formats(payload))
+            checkpoint(wait=False)
+            cohort_index_cache.build(cohort_index_key(payload), df)
+    except AdmissionRejected as e:
+        logger.info(f"Warm-up of {filename} skipped: {str(e)}")
+        return
+    dataset_warmup.store_frame(key, df, [timestamp_col])
+    logger.info(f"Warmed up {filename} for user column '{payload.userId}' and timestamp column '{timestamp_col}'")
+
+def clean_outliers(df: pd.DataFrame, data_cleaning) -> pd.DataFrame:
+    """Cap numeric columns at their 99th percentile, or drop rows above it (dataCleaning capping/remove)."""
+    with track_stage("preprocess", rows=len(df)) as stage:
         if getattr(data_cleaning, "capping", False):
             # Cap outliers at 99th percentile for all numerical columns
             for col in df.select_dtypes(include="number").columns:
@@ -197,31 +447,300 @@ def analyze_data(payload: AnalysisRequest, background_tasks: BackgroundTasks):
                 cap = df[col].quantile(0.99)
                 mask &= df[col] <= cap
             df = df[mask]
+        stage.rows = len(df)
+    return df
 
-        for col in [payload.cohortGrouping, payload.eventColumn]:
+def parse_date_columns(df: pd.DataFrame, columns, date_formats: dict) -> None:
+    """Parse the given columns of df to datetimes in place."""
+    with track_stage("date_parse", rows=len(df)):
+        for col in columns:
             if col in df.columns:
                 try:
-                    df[col] = pd.to_datetime(df[col])
+                    df[col] = parse_dates(df[col], date_formats.get(col))
                 except Exception as e:
                     logger.error(f"Error parsing dates in {col}: {str(e)}")
                     raise HTTPException(status_code=400, detail=f"Error parsing dates in {col}: {str(e)}")
 
-        if payload.startDate:
-            start_date = pd.to_datetime(payload.startDate)
-            df = df[df[payload.eventColumn] >= start_date]
-        if payload.endDate:
-            end_date = pd.to_datetime(payload.endDate)
-            df = df[df[payload.eventColumn] <= end_date]
-
-        if payload.columns:
-            required_cols = [payload.userId, payload.cohortGrouping, payload.eventColumn]
-            if payload.revenueColumn:
-                required_cols.append(payload.revenueColumn)
-            all_cols = list(set(payload.columns + required_cols))
-            available_cols = [col for col in all_cols if col in df.columns]
-            df = df[available_cols]
+def filter_frame(df: pd.DataFrame, payload: AnalysisRequest) -> pd.DataFrame:
+    """Apply the request's date window and column selection to a loaded, date-parsed frame."""
+    if payload.startDate:
+        start_date = pd.to_datetime(payload.startDate)
+        df = df[df[payload.eventColumn] >= start_date]
+    if payload.endDate:
+        end_date = pd.to_datetime(payload.endDate)
+        df = df[df[payload.eventColumn] <= end_date]
+
+    if payload.columns:
+        df = df[analysis_columns(payload, df.columns)]
+    return df
+
+def analysis_columns(payload: AnalysisRequest, columns) -> list:
+    """Columns kept for the analysis: the requested ones plus those the analysis needs."""
+    if not payload.columns:
+        return list(columns)
+    required_cols = [payload.userId, payload.cohortGrouping, payload.eventColumn]
+    if payload.revenueColumn:
+        required_cols.append(payload.revenueColumn)
+    if payload.segmentColumn:
+        required_cols.append(payload.segmentColumn)
+    all_cols = list(set(payload.columns + required_cols))
+    return [col for col in all_cols if col in columns]
+
+def cohort_index_key(payload: AnalysisRequest):
+    """Cohort index cache key for uploaded file sources, None for anything else."""
+    if payload.dbUrl or not payload.filename or file_extension(payload.filename) not in SUPPORTED_EXTENSIONS:
+        return None
+    return cohort_index_cache.key(f"uploads/{payload.filename}", payload.userId, payload.cohortGrouping, payload.eventColumn)
+
+def indexed_window(payload: AnalysisRequest, columns, numeric_columns):
+    """
+    (start, end) bounds when a cohort index of the dataset (columns, numeric_columns) can answer the request exactly, else None.
+
+    The index holds distinct users only, so revenue and segmented analyses and any preprocessing
+    that changes rows or values are served from the raw events.
+    """
+    if payload.analysisMetric == "revenue" or payload.segmentColumn:
+        return None
+    preprocessing = payload.preprocessing
+    if preprocessing:
+        if preprocessing.nullHandling or preprocessing.typeConversion:
+            return None
+        data_cleaning = preprocessing.dataCleaning
+        if getattr(data_cleaning, "capping", False) or getattr(data_cleaning, "remove", False):
+            return None
+        # Truthy dataCleaning makes the engine drop z-score outliers of numeric columns
+        if data_cleaning and set(numeric_columns).intersection(analysis_columns(payload, columns)):
+            return None
+    try:
+        start = pd.to_datetime(payload.startDate) if payload.startDate else None
+        end = pd.to_datetime(payload.endDate) if payload.endDate else None
+    except Exception:
+        return None
+    if not CohortIndex.supports_window(start, end):
+        return None
+    return start, end
+
+def schema_column_types(schema: Optional[dict]) -> dict:
+    """Inferred type per column of an upload schema, in file order."""
+    return {column["name"]: column["inferred_type"] for column in schema["columns"]} if schema else {}
+
+def analysis_cost(payload: AnalysisRequest, use_index: bool = True) -> JobCost:
+    """
+    Estimated memory and CPU of the analysis, from the upload's size, schema and profiled row count.
+
+    With use_index, a request the cached cohort index can answer costs only the index query.
+    """
+    if payload.dbUrl or not payload.filename:
+        return default_cost()
+    file_path = f"uploads/{payload.filename}"
+    key = dataset_key(file_path)
+    if key is None:
+        return default_cost()
+    index = cohort_index_cache.get(cohort_index_key(payload)) if use_index else None
+    if index is not None and indexed_window(payload, index.columns, index.numeric_columns) is not None:
+        return indexed_cost(len(index.user))
+    ext = file_extension(payload.filename)
+    schema = column_schemas.cached(file_path)
+    profile = dataset_profiles.get(key)
+    rows = estimate_rows(key[2], ext, schema, profile["row_count"] if profile else None)
+    types = schema_column_types(schema)
+    names = list(types) or [payload.userId, payload.cohortGrouping, payload.eventColumn]
+    if ext in COLUMNAR_FORMATS and payload.columns:
+        # Columnar loads skip the columns the analysis doesn't use
+        names = analysis_columns(payload, names)
+    return estimate_cost(rows, [types.get(name, "string") for name in names], key[2] if is_csv(ext) else 0)
+
+def chunked_index_build(payload: AnalysisRequest, rows: int):
+    """
+    (cost, build) of the upload's cohort index from row chunks, or None when the request can't be served from one.
 
+    The chunked path of analyses too large to load whole: only the user and date
+    columns are read, one chunk at a time. build() returns the index, or None
+    when the data can't be indexed (e.g. timezone-aware dates).
+    """
+    key = cohort_index_key(payload)
+    file_path = f"uploads/{payload.filename}"
+    schema = column_schemas.cached(file_path) if key is not None else None
+    if schema is None:
+        return None
+    types = schema_column_types(schema)
+    columns = list(types)
+    numeric_columns = {name for name, inferred in types.items() if inferred in ("integer", "float")}
+    if indexed_window(payload, columns, numeric_columns) is None:
+        return None
+    ext = file_extension(payload.filename)
+    date_columns = list(dict.fromkeys((payload.cohortGrouping, payload.eventColumn)))
+    read_columns = list(dict.fromkeys([payload.userId, *date_columns]))
+    date_formats = upload_date_formats(payload)
+
+    def chunks():
+        for chunk in iter_frames(file_path, ext, read_columns, ADMISSION_CHUNK_ROWS, schema.get("encoding")):
+            for col in date_columns:
+                chunk[col] = parse_dates(chunk[col], date_formats.get(col))
+            yield chunk
+
+    def build() -> Optional[CohortIndex]:
         try:
+            with track_stage("load"):
+                return cohort_index_cache.build_chunked(key, chunks, columns, numeric_columns)
+        except Exception as e:
+            logger.warning(f"Chunked cohort index of {payload.filename} not built: {str(e)}")
+            return None
+
+    return chunked_cost(rows, [types.get(col, "string") for col in read_columns]), build
+
+def iter_analysis_frames(payload: AnalysisRequest):
+    """The analysed events of an upload in date-parsed, filtered row chunks, for exporting datasets too large to load whole."""
+    file_path = f"uploads/{payload.filename}"
+    schema = column_schemas.cached(file_path) or {}
+    names = list(schema_column_types(schema))
+    columns = analysis_columns(payload, names) if payload.columns and names else None
+    # As many cells per chunk as the index build reads (user and two date columns), however wide the table
+    chunk_rows = max(1000, ADMISSION_CHUNK_ROWS * 3 // max(len(columns or names), 3))
+    date_formats = upload_date_formats(payload)
+    for chunk in iter_frames(file_path, file_extension(payload.filename), columns, chunk_rows, schema.get("encoding")):
+        for col in dict.fromkeys((payload.cohortGrouping, payload.eventColumn)):
+            if col in chunk.columns:
+                chunk[col] = parse_dates(chunk[col], date_formats.get(col))
+        yield filter_frame(chunk, payload)
+
+@contextmanager
+def admitted(cost: JobCost, priority: int):
+    """Hold the job's admission for the block; a job turned away by the queue gets 503 Service Unavailable."""
+    try:
+        with admission_controller.admit(cost, priority):
+            yield
+    except AdmissionRejected as e:
+        logger.warning(f"Analysis not admitted: {str(e)}", extra=cost.as_dict())
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+def _admitted_analysis(payload: AnalysisRequest, background_tasks: BackgroundTasks, job_id: str):
+    """
+    Run the analysis once admission control lets its estimated cost in.
+
+    Jobs too large for their share of the memory budget take the chunked path
+    (a cohort index built chunk by chunk) when the request can be served from an
+    index; any other oversized job holds the whole budget, i.e. runs alone.
+    """
+    cost = analysis_cost(payload)
+    if admission_controller.oversized(cost):
+        chunked = chunked_index_build(payload, cost.rows)
+        # Narrow datasets may cost as much to index as to load
+        if chunked is not None and chunked[0].memory_bytes < cost.memory_bytes:
+            chunked_job_cost, build = chunked
+            with admitted(chunked_job_cost, PRIORITY_INTERACTIVE):
+                index = build()
+                if index is not None:
+                    logger.info("Oversized analysis takes the chunked path", extra=cost.as_dict())
+                    return _run_analysis(payload, background_tasks, job_id, index=index)
+        logger.info("Oversized analysis runs alone", extra=cost.as_dict())
+    with admitted(cost, PRIORITY_INTERACTIVE):
+        return _run_analysis(payload, background_tasks, job_id)
+
+@app.post("/api/analysis")
+def analyze_data(
+    payload: AnalysisRequest,
+    background_tasks: BackgroundTasks,
+    request: Request,
+    x_profile: Optional[str] = Header(None, description="Set to the server's PROFILE_TOKEN to profile this request")
+):
+    metrics_registry.count_request("/api/analysis")
+    job_id = uuid.uuid4().hex
+    if payload.preview:
+        # Sampled result within the latency budget; the exact one follows via /api/analysis-result
+        return _encode_analysis_response(payload, request, _run_preview(payload, job_id))
+    if should_profile(x_profile):
+        with profiling_slot() as profiled:
+            if profiled:
+                return _profiled_analysis(payload, background_tasks, request, job_id)
+        logger.warning(f"Another request is being profiled; job {job_id} runs unprofiled")
+
+    def run():
+        with dataset_warmup.foreground(), request_timings() as timings:
+            response = _admitted_analysis(payload, background_tasks, job_id)
+        response["timings"] = timings.as_dict()
+        return response
+
+    response, shared = analysis_flights.do(analysis_flight_key(payload), run)
+    if shared:
+        logger.info(f"Joined the in-flight analysis of job {response['job_id']}")
+        response = {**response, "coalesced": True}
+    return _encode_analysis_response(payload, request, response)
+
+def _profiled_analysis(payload: AnalysisRequest, background_tasks: BackgroundTasks, request: Request, job_id: str):
+    """Run the analysis under RequestProfiler and save its profile; the caller holds the profiling slot."""
+    logger.info(f"Profiling analysis request for job {job_id}")
+    profiler = RequestProfiler()
+    try:
+        with dataset_warmup.foreground(), request_timings() as timings, profiler:
+            response = _admitted_analysis(payload, background_tasks, job_id)
+    finally:
+        # Keep the profile even when the analysis failed; that's often the interesting case
+        try:
+            save_job_profile(job_id, profiler.pstats_bytes(), profiler.collapsed_stacks())
+        except Exception as e:
+            logger.warning(f"Could not save profile for job {job_id}: {str(e)}")
+    response["timings"] = timings.as_dict()
+    response["profile"] = {
+        "pstats": f"/api/analysis-profile?job_id={job_id}&format=pstats",
+        "collapsed": f"/api/analysis-profile?job_id={job_id}&format=collapsed",
+    }
+    return _encode_analysis_response(payload, request, response)
+
+def analysis_flight_key(payload: AnalysisRequest) -> tuple:
+    """Dataset identity plus the canonical request parameters; equal keys produce equal responses."""
+    if payload.dbUrl:
+        dataset = (payload.dbUrl, payload.selectedTable)
+    else:
+        # Path, mtime and size, so a replaced upload never joins a run over the old file
+        dataset = dataset_key(f"uploads/{payload.filename}") or payload.filename
+    params = json.dumps(payload.model_dump(exclude={"filename"}), sort_keys=True, default=str)
+    return dataset, params
+
+class DeferredTasks:
+    """BackgroundTasks stand-in for jobs that already run off the request path."""
+
+    def __init__(self):
+        self.tasks = []
+
+    def add_task(self, func, *args, **kwargs):
+        self.tasks.append((func, args, kwargs))
+
+    def run(self):
+        for func, args, kwargs in self.tasks:
+            func(*args, **kwargs)
+
+def _run_preview(payload: AnalysisRequest, job_id: str) -> dict:
+    save_job(job_id, "processing")
+    preview = Future()
+    preview_executor.submit(_admitted_preview_job, payload, job_id, preview)
+    try:
+        return preview.result(timeout=PREVIEW_BUDGET_SECONDS)
+    except FuturesTimeoutError:
+        logger.info(f"Preview of job {job_id} missed the {PREVIEW_BUDGET_SECONDS}s budget")
+        return {
+            "job_id": job_id,
+            "data": None,
+            "preview": None,
+            "result": f"/api/analysis-result?job_id={job_id}"
+        }
+
+def _admitted_preview_job(payload: AnalysisRequest, job_id: str, preview: Future):
+    """preview_job() once admission control lets it in; both of its phases share the loaded frame and the admission."""
+    try:
+        with admitted(analysis_cost(payload, use_index=False), PRIORITY_PREVIEW):
+            preview_job(payload, job_id, preview)
+    except HTTPException as e:
+        update_job(job_id, "failed")
+        preview.set_exception(e)
+
+def preview_job(payload: AnalysisRequest, job_id: str, preview: Future):
+    """Compute the sampled preview, hand it to the waiting request, then run the exact analysis on the same frame."""
+    if payload.filename and not payload.dbUrl:
+        storage_manager.pin(job_id, f"uploads/{payload.filename}")
+    try:
+        with dataset_warmup.foreground(), request_timings() as timings:
+            df = prepare_dataframe(payload, cohort_index_key(payload))
             cohort_results = cohort_service.perform_cohort_analysis(
                 df=df,
                 user_id_col=payload.userId,
@@ -229,103 +748,345 @@ def analyze_data(payload: AnalysisRequest, background_tasks: BackgroundTasks):
                 event_col=payload.eventColumn,
                 interval=payload.cohortInterval,
                 revenue_col=payload.revenueColumn if payload.analysisMetric == "revenue" else None,
-                preprocessing=payload.preprocessing
+                preprocessing=payload.preprocessing,
+                output_format=payload.responseFormat,
+                sample_rate=payload.previewSampleRate,
+                segment_col=payload.segmentColumn,
+                segment_top_k=payload.segmentTopK,
+                heatmap_options=payload.heatmap.model_dump() if payload.heatmap else None
             )
-        except Exception as e:
+    except Exception as e:
+        update_job(job_id, "failed")
+        storage_manager.release(job_id)
+        if isinstance(e, HTTPException):
+            preview.set_exception(e)
+        elif isinstance(e, ValueError):
             logger.error(f"Cohort analysis failed: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Cohort analysis failed: {str(e)}")
+            preview.set_exception(HTTPException(status_code=400, detail=f"Cohort analysis failed: {str(e)}"))
+        else:
+            logger.exception(f"Analysis preview failed: {str(e)}")
+            preview.set_exception(HTTPException(status_code=500, detail="Internal server error"))
+        return
 
-        # Always re-parse datetime columns after type conversion/preprocessing
-        for col in [payload.cohortGrouping, payload.eventColumn]:
-            if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
-                try:
-                    df[col] = pd.to_datetime(df[col])
-                except Exception as e:
-                    logger.error(f"Error parsing dates in {col} after type conversion: {str(e)}")
-                    raise HTTPException(status_code=400, detail=f"Error parsing dates in {col} after type conversion: {str(e)}")
+    sample = cohort_results.pop("preview")
+    profile = cohort_results.pop("profile")
+    preview.set_result({
+        "job_id": job_id,
+        "data": build_response_data(payload, profile, list(df.columns), cohort_results),
+        "chart_data": {},
+        "preview": sample,
+        "timings": timings.as_dict(),
+        "result": f"/api/analysis-result?job_id={job_id}"
+    })
 
-        # Prepare the response in the required format
-        
+    tasks = DeferredTasks()
+    try:
+        with dataset_warmup.foreground(), request_timings() as timings:
+            response = _run_analysis(payload, tasks, job_id, df=df)
+        response["timings"] = timings.as_dict()
+        result_store.save_response(job_id, response)
+    except Exception as e:
+        logger.error(f"Exact analysis of preview job {job_id} failed: {str(e)}")
+        update_job(job_id, "failed")
+        storage_manager.release(job_id)
+        return
+    # Export last, so the job only turns ready once the exact result can be fetched
+    tasks.run()
 
-        data = {
-            "total_rows":  cohort_results.get('totalRows'),
-            "columns": list(df.columns),
-            "date_range": {
-                "start": safe_iso(df[payload.eventColumn].min()) if len(df) > 0 else None,
-                "end": safe_iso(df[payload.eventColumn].max()) if len(df) > 0 else None
-            },
-            "unique_users": df[payload.userId].nunique() if payload.userId in df.columns else 0,
-            "cohort_interval": payload.cohortInterval,
-            "analysis_metric": payload.analysisMetric,
-            "cohort_analysis": cohort_results,
-            "analysis_type": None,
-            "note": None,
-            "total_revenue": None
-        }
+@app.post("/api/analysis/batch")
+def analyze_batch(batch: BatchAnalysisRequest, background_tasks: BackgroundTasks, request: Request):
+    """
+    Run several analysis configs against one dataset.
 
-        if payload.analysisMetric == "retention":
-            data["analysis_type"] = "retention"
-            data["note"] = f"Retention analysis completed with {payload.cohortInterval} cohorts"
-        elif payload.analysisMetric == "revenue":
-            if payload.revenueColumn and payload.revenueColumn in df.columns:
-                total_revenue = df[payload.revenueColumn].sum() if pd.api.types.is_numeric_dtype(df[payload.revenueColumn]) else 0
-                data["total_revenue"] = float(total_revenue)
-                data["analysis_type"] = "revenue"
-                data["note"] = f"Revenue analysis completed with {payload.cohortInterval} cohorts"
-            else:
-                data["note"] = "Revenue column not found or not specified"
-        elif payload.analysisMetric == "engagement":
-            data["analysis_type"] = "engagement"
-            data["note"] = f"Engagement analysis completed with {payload.cohortInterval} cohorts"
+    The dataset is loaded once, outlier handling runs once per distinct dataCleaning
+    setting and every date column is parsed once; the configs then only filter the
+    shared frame and run concurrently. Each config is its own job with its own
+    result; a failing config doesn't fail the batch.
+    """
+    metrics_registry.count_request("/api/analysis/batch")
+    try:
+        configs = batch.analysis_requests()
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=json.loads(e.json()))
+    if not configs:
+        raise HTTPException(status_code=400, detail="Batch contains no configs")
+    if len(configs) > BATCH_MAX_CONFIGS:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {BATCH_MAX_CONFIGS} configs")
+    if any(config.preview for config in configs):
+        raise HTTPException(status_code=400, detail="Preview is not supported in batch requests")
+
+    # One admission for the batch: the shared frame plus the configs that run at once
+    cost = batch_cost(analysis_cost(configs[0], use_index=False), len(configs), BATCH_WORKERS)
+    with dataset_warmup.foreground(), request_timings() as timings, admitted(cost, PRIORITY_BATCH):
+        frames = prepare_batch_frames(configs)
+        job_ids = [uuid.uuid4().hex for _ in configs]
+        for job_id in job_ids:
+            save_job(job_id, "processing")
+        futures = [
+            batch_executor.submit(_run_batch_config, config, frame, background_tasks, job_id)
+            for config, frame, job_id in zip(configs, frames, job_ids)
+        ]
+        results = [future.result() for future in futures]
+    return encode_response({"results": results, "timings": timings.as_dict()}, request.headers.get("accept"))
+
+def prepare_batch_frames(configs: list) -> list:
+    """The shared, date-parsed frame each config of a batch filters (one per dataCleaning variant)."""
+    warmed = warm_frame(configs[0])
+    df, parsed = warmed if warmed is not None else (load_dataframe(configs[0]), frozenset())
+    date_columns = list(dict.fromkeys(
+        col for config in configs for col in (config.cohortGrouping, config.eventColumn) if col not in parsed
+    ))
+    parse_date_columns(df, date_columns, upload_date_formats(configs[0]))
+
+    variants = {}
+    frames = []
+    for config in configs:
+        data_cleaning = config.preprocessing.dataCleaning if config.preprocessing else None
+        variant = (bool(getattr(data_cleaning, "capping", False)), bool(getattr(data_cleaning, "remove", False)))
+        if variant not in variants:
+            # Capping writes to the frame; give it its own (copy-on-write) copy
+            variants[variant] = clean_outliers(df.copy(deep=False), data_cleaning) if any(variant) else df
+        if not any(variant):
+            cohort_index_cache.build_async(cohort_index_key(config), df)
+        frames.append(variants[variant])
+    return frames
+
+def _run_batch_config(config: AnalysisRequest, frame: pd.DataFrame, background_tasks: BackgroundTasks, job_id: str) -> dict:
+    try:
+        with request_timings() as timings:
+            # Engine preprocessing may write to its input; never hand it the shared frame itself
+            response = _run_analysis(config, background_tasks, job_id, df=filter_frame(frame, config).copy(deep=False))
+        response["timings"] = timings.as_dict()
+        return response
+    except HTTPException as e:
+        update_job(job_id, "failed")
+        return {"job_id": job_id, "status_code": e.status_code, "detail": e.detail}
+    except Exception as e:
+        logger.exception(f"Batch analysis config failed: {str(e)}")
+        update_job(job_id, "failed")
+        return {"job_id": job_id, "status_code": 500, "detail": "Internal server error"}
+
+def _encode_analysis_response(payload: AnalysisRequest, request: Request, response: dict):
+    """Compact results are serialized with orjson, or msgpack when the client accepts it."""
+    if payload.responseFormat != "compact":
+        return response
+    return encode_response(response, request.headers.get("accept"))
+
+def profile_key(payload: AnalysisRequest):
+    """Dataset profile cache key when the analysed frame is the whole uploaded file, else None."""
+    if payload.dbUrl or not payload.filename or payload.startDate or payload.endDate:
+        return None
+    preprocessing = payload.preprocessing
+    # Any truthy option here changes rows or values before the engine profiles them
+    if preprocessing and (preprocessing.dataCleaning or preprocessing.nullHandling or preprocessing.typeConversion):
+        return None
+    return dataset_key(f"uploads/{payload.filename}")
+
+EXPORT_TABLES = ['retention_table', 'revenue_table', 'arpu_table', 'ltv_table']
+
+def export_tables(cohort_results: dict) -> dict:
+    """Cohort tables written to the zip export, laid out the same for nested and compact results."""
+    tables = {}
+    for key in EXPORT_TABLES:
+        if cohort_results.get("format") == "compact":
+            value = decode_table(cohort_results, key)
+            if value is not None:
+                tables[key] = nested_layout(value)
+            continue
+        value = cohort_results.get(key)
+        if isinstance(value, pd.DataFrame):
+            tables[key] = value
+        elif isinstance(value, dict):
+            # Convert dict to DataFrame (handle nested dicts as well)
+            try:
+                tables[key] = pd.DataFrame(value)
+            except Exception:
+                # If value is a dict of dicts, try orient='index'
+                tables[key] = pd.DataFrame.from_dict(value, orient='index')
+    return tables
+
+def build_response_data(payload: AnalysisRequest, profile: dict, columns: list, cohort_results: dict) -> dict:
+    """The 'data' section of an analysis response, summarised from the engine's dataset profile."""
+    data = {
+        "total_rows": profile["row_count"],
+        "columns": columns,
+        "date_range": {
+            "start": safe_iso(profile["date_range"][0]),
+            "end": safe_iso(profile["date_range"][1])
+        },
+        "unique_users": profile["unique_users"],
+        "cohort_interval": payload.cohortInterval,
+        "analysis_metric": payload.analysisMetric,
+        "cohort_analysis": cohort_results,
+        "analysis_type": None,
+        "note": None,
+        "total_revenue": None
+    }
+
+    if payload.analysisMetric == "retention":
+        data["analysis_type"] = "retention"
+        data["note"] = f"Retention analysis completed with {payload.cohortInterval} cohorts"
+    elif payload.analysisMetric == "revenue":
+        # The engine already totals the revenue column while aggregating
+        if payload.revenueColumn and cohort_results.get("total_revenue") is not None:
+            data["total_revenue"] = cohort_results["total_revenue"]
+            data["analysis_type"] = "revenue"
+            data["note"] = f"Revenue analysis completed with {payload.cohortInterval} cohorts"
         else:
-            data["note"] = "Unsupported analysis metric"
+            data["note"] = "Revenue column not found or not specified"
+    elif payload.analysisMetric == "engagement":
+        data["analysis_type"] = "engagement"
+        data["note"] = f"Engagement analysis completed with {payload.cohortInterval} cohorts"
+    else:
+        data["note"] = "Unsupported analysis metric"
+    return data
+
+def _run_analysis(
+    payload: AnalysisRequest,
+    background_tasks: BackgroundTasks,
+    job_id: str,
+    df: Optional[pd.DataFrame] = None,
+    index: Optional[CohortIndex] = None
+):
+    """
+    Run the analysis; a prepared df (from a preview job or a batch) skips loading and the job registration.
+
+    An index built for the job (the chunked path) serves it instead of the cache,
+    and its export streams the events in chunks instead of loading them.
+    """
+    if payload.filename and not payload.dbUrl:
+        # Released once the export task has run, or below if the analysis fails
+        storage_manager.pin(job_id, f"uploads/{payload.filename}")
+    try:
+        if df is None:
+            save_job(job_id, "processing")
+        logger.info("Running analysis", extra={
+            "job_id": job_id,
+            "source": payload.selectedTable if payload.dbUrl else payload.filename,
+            "metric": payload.analysisMetric,
+            "interval": payload.cohortInterval,
+        })
+        # The full payload is only rendered when DEBUG is enabled
+        logger.debug("Payload: %s", payload)
+
+        prepared = df is not None
+        chunked = index is not None
+        index_key = cohort_index_key(payload)
+        if not chunked:
+            index = cohort_index_cache.get(index_key) if not prepared else None
+        window = indexed_window(payload, index.columns, index.numeric_columns) if index is not None else None
+        if window is not None:
+            logger.info("Serving analysis from the cohort index")
+            try:
+                cohort_results = cohort_service.perform_indexed_analysis(
+                    index,
+                    interval=payload.cohortInterval,
+                    start=window[0],
+                    end=window[1],
+                    output_format=payload.responseFormat,
+                    job_id=job_id,
+                    heatmap_options=payload.heatmap.model_dump() if payload.heatmap else None
+                )
+            except Exception as e:
+                logger.error(f"Cohort analysis failed: {str(e)}")
+                raise HTTPException(status_code=400, detail=f"Cohort analysis failed: {str(e)}")
+            profile = cohort_results.pop("profile")
+            columns = analysis_columns(payload, index.columns)
+        else:
+            if not prepared:
+                df = prepare_dataframe(payload, index_key)
+            try:
+                cohort_results = cohort_service.perform_cohort_analysis(
+                    df=df,
+                    user_id_col=payload.userId,
+                    cohort_grouping_col=payload.cohortGrouping,
+                    event_col=payload.eventColumn,
+                    interval=payload.cohortInterval,
+                    revenue_col=payload.revenueColumn if payload.analysisMetric == "revenue" else None,
+                    preprocessing=payload.preprocessing,
+                    output_format=payload.responseFormat,
+                    job_id=job_id,
+                    approximate=payload.approximate,
+                    hll_precision=payload.hllPrecision,
+                    segment_col=payload.segmentColumn,
+                    segment_top_k=payload.segmentTopK,
+                    heatmap_options=payload.heatmap.model_dump() if payload.heatmap else None
+                )
+            except Exception as e:
+                logger.error(f"Cohort analysis failed: {str(e)}")
+                raise HTTPException(status_code=400, detail=f"Cohort analysis failed: {str(e)}")
+
+            profile = cohort_results.pop("profile")
+            dataset_profiles.update(
+                profile_key(payload), profile, payload.userId, payload.eventColumn,
+                payload.revenueColumn if payload.analysisMetric == "revenue" else None
+            )
+            columns = list(df.columns)
+
+        data = build_response_data(payload, profile, columns, cohort_results)
 
         chart_data = cohort_results.get("charts", {})
 
         llm_observations = None
+        llm_status = "disabled"
         if payload.llm_insights:
-            try:
-                llm_observations = get_llm_insights(data)
-            except Exception as e:
-                logger.warning(f"LLM summary failed: {str(e)}")
-                llm_observations = {}
+            # Insights never block the response: serve them from cache or
+            # generate them in the background and deliver via /api/analysis-status
+            digest = build_digest(data)
+            llm_observations = cached_llm_insights(digest)
+            if llm_observations is not None:
+                llm_status = "ready"
+                update_job_insights(job_id, llm_status, llm_observations)
+            else:
+                llm_status = "pending"
+                update_job_insights(job_id, llm_status)
+                insights_executor.submit(llm_insights_task, job_id, digest)
         logger.info("Analysis completed successfully.")
         
         # Get the download url
         # Prepare tables to save (main df and cohort results as CSVs)
-        tables = {"analysis_data": df}
-        # If cohort_results has DataFrames or dicts, add them as well (convert dicts to DataFrames)
-        keys = ['retention_table', 'revenue_table', 'arpu_table', 'ltv_table']
-        for key in keys:
-            value = cohort_results.get(key)
-            if isinstance(value, pd.DataFrame):
-                tables[key] = value
-            elif isinstance(value, dict):
-                # Convert dict to DataFrame (handle nested dicts as well)
-                try:
-                    tables[key] = pd.DataFrame(value)
-                except Exception:
-                    # If value is a dict of dicts, try orient='index'
-                    tables[key] = pd.DataFrame.from_dict(value, orient='index')
-        output_dir = "output_csvs"
+        tables = {"analysis_data": df} if df is not None else {}
+        tables.update(export_tables(cohort_results))
+        # One directory per job, so concurrent exports never overwrite each other's CSVs
+        output_dir = f"output_csvs/{job_id}"
         zip_name = f"results_{job_id}.zip"
         supabase_zip_path = f"user_results/{zip_name}"
+        load_analysis_data = None
+        if chunked:
+            # Too large to load whole; the export streams the events chunk by chunk
+            load_analysis_data = lambda: iter_analysis_frames(payload)
+        elif df is None:
+            load_analysis_data = lambda: prepare_dataframe(payload)
 
         background_tasks.add_task(
             zip_and_upload_task,
-            job_id, tables, chart_data, output_dir, zip_name, supabase_zip_path
+            job_id, tables, chart_data, output_dir, zip_name, supabase_zip_path,
+            load_analysis_data=load_analysis_data
         )
 
+        if not payload.inlineTables:
+            # Matrices stay server-side; clients page through them lazily
+            for key in EXPORT_TABLES + ['cohort_sizes', 'tables']:
+                cohort_results.pop(key, None)
+
         return {
             "job_id": job_id,
             "data": data,
             "chart_data": chart_data,
             "llm_observations": llm_observations,
-            "download_url": None
+            "llm_status": llm_status,
+            "download_url": None,
+            "results": {
+                "axes": f"/api/analysis-axes?job_id={job_id}",
+                "window": f"/api/analysis-window?job_id={job_id}",
+                "overview": f"/api/analysis-overview?job_id={job_id}"
+            }
         }
     except HTTPException:
+        storage_manager.release(job_id)
         raise
     except Exception as e:
+        storage_manager.release(job_id)
         logger.exception(f"Analysis failed: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
@@ -337,5 +1098,108 @@ def analysis_status(job_id: str):
         raise HTTPException(status_code=404, detail="Job not found")
     return {
         "status": job.status,
-        "download_url": job.download_url
-    }
\ No newline at end of file
+        "download_url": job.download_url,
+        "llm_status": job.llm_status,
+        "llm_observations": json.loads(job.llm_observations) if job.llm_observations else None
+    }
+
+@app.get("/api/analysis-result")
+def analysis_result(job_id: str):
+    """Exact result of a preview request; available once the job status is ready."""
+    try:
+        body = result_store.load_response(job_id)
+    except (FileNotFoundError, ValueError):
+        raise HTTPException(status_code=404, detail="Result not available yet")
+    return Response(content=body, media_type="application/json")
+
+@app.get("/api/analysis-axes")
+def analysis_axes(job_id: str):
+    """Cohort/period labels, cohort sizes and available tables of a stored result."""
+    try:
+        return result_store.axes(job_id)
+    except (FileNotFoundError, ValueError):
+        raise HTTPException(status_code=404, detail="No stored results for job")
+
+@app.get("/api/analysis-window")
+def analysis_window(
+    job_id: str,
+    table: str = Query("retention_table", description="retention_table, revenue_table, arpu_table or ltv_table"),
+    cohort_start: int = Query(0, ge=0),
+    cohort_end: Optional[int] = Query(None, ge=0),
+    period_start: int = Query(0, ge=0),
+    period_end: Optional[int] = Query(None, ge=0)
+):
+    """Rectangular window (cohort range x period range) of a stored result matrix."""
+    try:
+        return result_store.window(job_id, table, cohort_start, cohort_end, period_start, period_end)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="No stored results for job")
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/analysis-overview")
+def analysis_overview(
+    job_id: str,
+    table: str = Query("retention_table", description="retention_table, revenue_table, arpu_table or ltv_table"),
+    max_cohorts: int = Query(100, ge=1, le=1000),
+    max_periods: int = Query(100, ge=1, le=1000)
+):
+    """Block-averaged overview of a stored result matrix."""
+    try:
+        return result_store.overview(job_id, table, max_cohorts, max_periods)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="No stored results for job")
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/analysis-profile")
+def analysis_profile(
+    job_id: str,
+    format: str = Query("collapsed", description="collapsed or pstats"),
+    x_profile: Optional[str] = Header(None, description="The server's PROFILE_TOKEN")
+):
+    """Download the saved profile of a profiled analysis request."""
+    # Profiles expose code paths and timings, so they need the same token as profiling
+    if not has_profile_token(x_profile):
+        raise HTTPException(status_code=403, detail="A valid X-Profile token is required")
+    profile = get_job_profile(job_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="No profile found for job")
+    pstats_data, collapsed = profile
+    if format == "pstats":
+        return Response(
+            content=pstats_data,
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="analysis_{job_id}.pstats"'}
+        )
+    if format == "collapsed":
+        return Response(
+            content=collapsed or "",
+            media_type="text/plain",
+            headers={"Content-Disposition": f'attachment; filename="analysis_{job_id}.collapsed.txt"'}
+        )
+    raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'pstats'")
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Expose per-stage pipeline metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics_registry.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/ready")
+def readiness():
+    """
+    Readiness probe: 200 once the job store is reachable, 503 while it isn't.
+
+    The job store, storage client and chart renderer are set up on first use
+    rather than at import, so a worker serves this within moments of starting.
+    """
+    try:
+        check_job_store()
+    except Exception as e:
+        logger.warning(f"Not ready, job store unavailable: {str(e)}")
+        raise HTTPException(status_code=503, detail=f"Job store unavailable: {str(e)}")
+    return {"status": "ready"}
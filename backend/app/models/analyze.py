@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, List, Union, Literal
+from typing import Optional, List, Union, Literal, Dict, Any
 
 class NullHandlingOptions(BaseModel):
     categorical: Optional[str] = None
@@ -14,6 +14,17 @@ class PreprocessingOptions(BaseModel):
     nullHandling: Optional[Union[bool, NullHandlingOptions]] = None
     typeConversion: bool
 
+class HeatmapOptions(BaseModel):
+    # "matplotlib" draws the annotated seaborn chart; "png" paints the cells straight to
+    # pixels (no text) and "svg" writes a labelled vector chart, both in milliseconds
+    renderer: Literal["matplotlib", "png", "svg"] = "matplotlib"
+    dpi: int = 300
+    # Figure size in inches
+    width: float = 14
+    height: float = 8
+    # "auto" annotates the cells only when they are large enough to hold their value
+    annotate: Literal["always", "never", "auto"] = "always"
+
 class AnalysisRequest(BaseModel):
     filename: Optional[str]
     userId: str
@@ -32,3 +43,42 @@ class AnalysisRequest(BaseModel):
     dbUrl: Optional[str] = None
     selectedTable: Optional[str] = None
     llm_insights: bool = True
+    # "compact" sends shared axis labels plus flat row-major matrices
+    responseFormat: Literal["nested", "compact"] = "nested"
+    # False leaves the matrices out of the response; fetch them through
+    # /api/analysis-window and /api/analysis-overview instead
+    inlineTables: bool = True
+    # Estimate distinct users per cell with HyperLogLog sketches of 2**hllPrecision registers
+    approximate: bool = False
+    hllPrecision: int = 12
+    # Return a result for a deterministic sample of users first; the exact
+    # result is fetched from /api/analysis-result once the job is ready
+    preview: bool = False
+    previewSampleRate: float = 0.02
+    # Also compute a retention table per value of this column (top segmentTopK by users, then
+    # "(other)" for the rest and "(missing)" for rows without a value)
+    segmentColumn: Optional[str] = None
+    segmentTopK: int = 10
+    # Renderer, resolution, size and cell labels of the retention heatmap; previews
+    # render one too when a fast renderer is chosen
+    heatmap: Optional[HeatmapOptions] = None
+
+class BatchAnalysisRequest(BaseModel):
+    # The dataset every config runs against; these override the same fields in a config
+    filename: Optional[str] = None
+    dataSourceType: Literal["csv", "sql", "db"] = None
+    dbUrl: Optional[str] = None
+    selectedTable: Optional[str] = None
+    # AnalysisRequest fields of each analysis (interval, metric, date range, ...)
+    configs: List[Dict[str, Any]]
+
+    def analysis_requests(self) -> List[AnalysisRequest]:
+        dataset = {
+            "filename": self.filename,
+            "dataSourceType": self.dataSourceType,
+            "dbUrl": self.dbUrl,
+            "selectedTable": self.selectedTable,
+        }
+        dataset = {key: value for key, value in dataset.items() if value is not None}
+        dataset.setdefault("filename", None)
+        return [AnalysisRequest(**{**config, **dataset}) for config in self.configs]
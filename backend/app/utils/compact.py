@@ -0,0 +1,112 @@
+# Compact columnar encoding of cohort matrices and fast response serialization
+import numpy as np
+import pandas as pd
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import Response
+from typing import Dict, Any, Optional
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+
+def row_lengths(user_counts: np.ndarray) -> np.ndarray:
+    """
+    Number of leading periods to keep per cohort row.
+
+    Cohort matrices are upper-triangular in practice: a cohort can only be
+    observed for as many periods as have elapsed since it started, so each row
+    is cut after its last period with any active users.
+    """
+    if user_counts.size == 0:
+        return np.zeros(user_counts.shape[0], dtype=np.int64)
+    observed = user_counts > 0
+    last = observed.shape[1] - np.argmax(observed[:, ::-1], axis=1)
+    return np.where(observed.any(axis=1), last, 0).astype(np.int64)
+
+
+def round_values(values: np.ndarray, digits: int) -> np.ndarray:
+    """
+    np.round(values, digits), except that values within a few ulps of a tie are
+    rounded with round(), which decides on the float's exact value; so compact
+    results match the nested format's round(v, digits) cell for cell.
+    """
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, digits)
+    scaled = values * 10.0 ** digits
+    with np.errstate(invalid="ignore"):
+        near_tie = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6 + 1e-12 * np.abs(scaled)
+    for i in zip(*np.nonzero(near_tie)):
+        rounded[i] = round(float(values[i]), digits)
+    return rounded
+
+
+def encode_matrix(matrix: np.ndarray, lengths: np.ndarray, digits: Optional[int] = None) -> list:
+    """Flatten the first lengths[i] values of every row, row-major, into one list."""
+    keep = np.arange(matrix.shape[1]) < lengths[:, None]
+    values = np.nan_to_num(matrix[keep].astype(float), nan=0.0)
+    if digits is not None:
+        values = round_values(values, digits)
+    return values.tolist()
+
+
+def decode_table(cohort_results: Dict[str, Any], name: str) -> Optional[pd.DataFrame]:
+    """
+    Rebuild a cohort x period DataFrame from a compact result, holding the values
+    the nested format reports.
+
+    Retention keeps only positive rates (others are NaN). Past the end of a row
+    there are no active users, so revenue and ARPU are 0 and the cumulative LTV
+    stays at its last value.
+    """
+    table = (cohort_results.get("tables") or {}).get(name)
+    if table is None:
+        return None
+    cohorts = cohort_results["cohorts"]
+    periods = cohort_results["periods"]
+    lengths = np.asarray(cohort_results["row_lengths"], dtype=np.int64)
+    matrix = np.full((len(cohorts), len(periods)), np.nan)
+    keep = np.arange(len(periods)) < lengths[:, None]
+    matrix[keep] = np.asarray(table, dtype=float)
+    if name == "retention_table":
+        matrix[~(matrix > 0)] = np.nan
+    elif name == "ltv_table":
+        matrix = pd.DataFrame(matrix).ffill(axis=1).fillna(0.0).to_numpy()
+    else:
+        matrix[~keep] = 0.0
+    return pd.DataFrame(matrix, index=cohorts, columns=periods)
+
+
+def nested_layout(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Lay a decoded table out as pd.DataFrame() lays out the nested {cohort: {period: value}}
+    dict: one column per cohort, one row per period with any value, in order of first appearance.
+    """
+    values = frame.T
+    present = values.notna().to_numpy()
+    rows = np.flatnonzero(present.any(axis=1))
+    first_cohort = present[rows].argmax(axis=1)
+    values = values.iloc[rows[np.argsort(first_cohort, kind="stable")]]
+    values.index = [str(period) for period in values.index]
+    return values
+
+
+def encode_response(content: Dict[str, Any], accept: Optional[str]) -> Response:
+    """Serialize with msgpack when the client asks for it, otherwise with orjson."""
+    accept = (accept or "").lower()
+    if MSGPACK_MEDIA_TYPE in accept:
+        # Imported on first use; only clients asking for msgpack need it
+        import msgpack
+        body = msgpack.packb(content, default=_msgpack_default, use_bin_type=True)
+        return Response(content=body, media_type=MSGPACK_MEDIA_TYPE)
+    if accept and "application/json" not in accept and "*/*" not in accept:
+        raise HTTPException(status_code=406, detail="Supported response types: application/json, application/msgpack")
+    body = orjson.dumps(content, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return Response(content=body, media_type="application/json")
+
+
+def _msgpack_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
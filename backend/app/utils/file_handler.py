@@ -3,6 +3,7 @@ import shutil
 from pathlib import Path
 from fastapi import UploadFile, HTTPException
 from app.utils.logger import get_logger
+from app.utils.file_readers import SUPPORTED_EXTENSIONS, file_extension
 
 # File upload and validation
 
@@ -14,16 +15,16 @@ class FileHandler:
         self.upload_dir.mkdir(exist_ok=True)
         logger.info(f"FileHandler initialized with upload directory: {self.upload_dir}")
     
-    def validate_csv(self, file: UploadFile) -> None:
-        """Validate that the file is a CSV"""
-        if not file.filename or not file.filename.endswith(".csv"):
-            logger.error("File validation failed: Only CSV files are allowed")
-            raise HTTPException(status_code=400, detail="Only CSV files are allowed")
+    def validate_file(self, file: UploadFile) -> None:
+        """Validate that the file is a CSV (optionally .gz/.zst compressed), Parquet or Feather file"""
+        if not file.filename or file_extension(file.filename) not in SUPPORTED_EXTENSIONS:
+            logger.error("File validation failed: Only CSV, CSV.GZ, CSV.ZST, Parquet and Feather files are allowed")
+            raise HTTPException(status_code=400, detail="Only CSV, CSV.GZ, CSV.ZST, Parquet and Feather files are allowed")
     
     async def save_file(self, file: UploadFile) -> str:
         """Save uploaded file and return filename"""
         try:
-            self.validate_csv(file)
+            self.validate_file(file)
         except HTTPException as e:
             logger.error(f"File validation failed: {e.detail}")
             raise
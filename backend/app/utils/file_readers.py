@@ -0,0 +1,119 @@
+# Readers for the supported upload formats: CSV (plain, gzip, zstd), Parquet and Feather
+import io
+import os
+import pandas as pd
+from typing import Iterator, List, Optional, Tuple
+
+CSV_ENCODINGS = ['utf-8', 'latin1', 'cp1252', 'iso-8859-1', 'utf-8-sig']
+# Compound extensions first so "x.csv.gz" isn't taken for a plain ".gz"
+SUPPORTED_EXTENSIONS = ('.csv.gz', '.csv.zst', '.csv', '.parquet', '.feather')
+CSV_COMPRESSION = {'.csv': None, '.csv.gz': 'gzip', '.csv.zst': 'zstd'}
+COLUMNAR_FORMATS = {'.parquet': 'parquet', '.feather': 'feather'}
+
+
+def file_extension(filename: str) -> str:
+    """Lower-cased supported extension of filename (".csv.gz" etc.), else its last extension."""
+    lowered = filename.lower()
+    for ext in SUPPORTED_EXTENSIONS:
+        if lowered.endswith(ext):
+            return ext
+    return os.path.splitext(lowered)[1]
+
+
+def is_csv(ext: str) -> bool:
+    return ext in CSV_COMPRESSION
+
+
+def read_csv_bytes(raw: bytes, ext: str = '.csv', encodings: Optional[List[str]] = None, **kwargs) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """
+    Parse a (possibly compressed) CSV held in memory, trying each encoding in turn.
+
+    Compressed input is decompressed as a stream while parsing, so the
+    uncompressed file never exists in full, on disk or in memory.
+    Returns (df, encoding), or (None, None) when no encoding fits.
+    """
+    for encoding in encodings or CSV_ENCODINGS:
+        try:
+            return pd.read_csv(io.BytesIO(raw), encoding=encoding, compression=CSV_COMPRESSION[ext], **kwargs), encoding
+        except UnicodeDecodeError:
+            continue
+    return None, None
+
+
+def _row_filter(dataset, column: Optional[str], start, end):
+    """Arrow filter for start <= column <= end, or None when it can't be pushed down exactly."""
+    if column is None or (start is None and end is None) or column not in dataset.schema.names:
+        return None
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    field_type = dataset.schema.field(column).type
+    # Only naive timestamps compare exactly like the pandas filter applied after loading
+    if not pa.types.is_timestamp(field_type) or field_type.tz is not None:
+        return None
+    expr = None
+    for bound, compare in ((start, lambda f, v: f >= v), (end, lambda f, v: f <= v)):
+        if bound is None or bound.tzinfo is not None:
+            continue
+        condition = compare(ds.field(column), pa.scalar(bound.value, type=pa.timestamp('ns')))
+        expr = condition if expr is None else expr & condition
+    return expr
+
+
+def read_columnar(
+    file_path: str,
+    ext: str,
+    columns: Optional[List[str]] = None,
+    date_column: Optional[str] = None,
+    start: Optional[pd.Timestamp] = None,
+    end: Optional[pd.Timestamp] = None
+) -> pd.DataFrame:
+    """
+    Read a Parquet or Feather file, loading only the given columns.
+
+    With date_column and start/end, rows outside [start, end] are skipped while
+    reading; for Parquet whole row groups are pruned from their min/max statistics.
+    """
+    # Imported on first use like the other pyarrow.dataset users here; it is slow to import
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(file_path, format=COLUMNAR_FORMATS[ext])
+    if columns is not None:
+        columns = [col for col in dataset.schema.names if col in columns]
+    table = dataset.to_table(columns=columns, filter=_row_filter(dataset, date_column, start, end))
+    return table.to_pandas()
+
+
+def columnar_sample(file_path: str, ext: str, max_rows: int) -> Tuple[pd.DataFrame, int]:
+    """First max_rows rows of a Parquet or Feather file and its total row count (from metadata)."""
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(file_path, format=COLUMNAR_FORMATS[ext])
+    return dataset.head(max_rows).to_pandas(), dataset.count_rows()
+
+
+def iter_frames(
+    file_path: str,
+    ext: str,
+    columns: Optional[List[str]] = None,
+    chunk_rows: int = 500_000,
+    encoding: Optional[str] = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Read a supported upload as consecutive DataFrames of at most chunk_rows rows.
+
+    Only the given columns are read and only one chunk is held at a time, so
+    files far larger than memory can be scanned. CSVs are decoded with encoding
+    (the one detected at upload) or the first of CSV_ENCODINGS.
+    """
+    if is_csv(ext):
+        reader = pd.read_csv(
+            file_path, usecols=columns, chunksize=chunk_rows,
+            encoding=encoding or CSV_ENCODINGS[0], compression=CSV_COMPRESSION[ext]
+        )
+        with reader:
+            yield from reader
+        return
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(file_path, format=COLUMNAR_FORMATS[ext])
+    if columns is not None:
+        columns = [col for col in dataset.schema.names if col in columns]
+    for batch in dataset.to_batches(columns=columns, batch_size=chunk_rows):
+        yield batch.to_pandas()
@@ -0,0 +1,227 @@
+# HyperLogLog sketches for approximate distinct users per cohort cell
+import math
+import numpy as np
+import pandas as pd
+from typing import Dict, Any, Callable, Hashable, Optional, Tuple
+
+DEFAULT_PRECISION = 12
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+# Registers reduced per block in estimates(); the float64 lookup result is 8x this
+ESTIMATE_BLOCK_REGISTERS = 1 << 20
+# Register value k contributes 2**-k to the harmonic sum; values fit in a byte
+_INVERSE_POWERS = np.ldexp(1.0, -np.arange(256))
+
+
+def relative_standard_error(precision: int) -> float:
+    return 1.04 / math.sqrt(1 << precision)
+
+
+def hash_users(users: pd.Series) -> np.ndarray:
+    """Stable 64-bit hashes of user IDs (same ID -> same hash in every chunk and process)."""
+    return pd.util.hash_pandas_object(users, index=False).to_numpy(dtype=np.uint64)
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    """Bit length of uint64 values, computed on 32-bit halves so float conversion stays exact."""
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1]).astype(np.int64)
+
+
+class HLLSketchMatrix:
+    """
+    One distinct-user sketch per (cohort, period) cell.
+
+    A cell starts sparse, as the exact set of its user hashes (16 bytes per
+    user), and is counted exactly. Once it holds more than 2**precision / 16
+    users the set would outgrow a HyperLogLog sketch, so the cell is promoted
+    to 2**precision one-byte registers. Memory per cell is therefore bounded
+    by the smaller of the two, and the many small cells of daily or weekly
+    matrices never pay for full registers.
+
+    Sketches of separate chunks or partitions combine with merge(), and
+    regroup() rolls cells up to coarser cohorts or periods; both give the
+    same sketch as a single pass over all rows.
+    """
+
+    def __init__(self, precision: int = DEFAULT_PRECISION):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(f"HyperLogLog precision must be between {MIN_PRECISION} and {MAX_PRECISION}")
+        self.precision = precision
+        self.registers_per_cell = 1 << precision
+        self.sparse_limit = self.registers_per_cell // 16
+        self._cells: Dict[Tuple[Hashable, int], int] = {}
+        # Unique (cell, hash) pairs of the sparse cells, sorted by cell then hash
+        self._sparse_cells = np.empty(0, dtype=np.int64)
+        self._sparse_hashes = np.empty(0, dtype=np.uint64)
+        # Register row of every cell (-1 while sparse); rows are allocated with spare capacity
+        self._dense_rows = np.empty(0, dtype=np.int64)
+        self._registers = np.zeros((0, self.registers_per_cell), dtype=np.uint8)
+        self._dense = 0
+
+    def __len__(self) -> int:
+        return len(self._cells)
+
+    def _cell_ids(self, keys) -> np.ndarray:
+        """Ids of the given cells, registering new cells as sparse."""
+        ids = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            cell = self._cells.get(key)
+            if cell is None:
+                cell = self._cells[key] = len(self._cells)
+            ids[i] = cell
+        if len(self._cells) > len(self._dense_rows):
+            new = np.full(len(self._cells) - len(self._dense_rows), -1, dtype=np.int64)
+            self._dense_rows = np.concatenate([self._dense_rows, new])
+        return ids
+
+    def _promote(self, cells: np.ndarray) -> None:
+        """Give register rows to the given sparse cells, growing the register matrix geometrically."""
+        needed = self._dense + len(cells)
+        if needed > len(self._registers):
+            grown = np.zeros((max(needed, 2 * len(self._registers)), self.registers_per_cell), dtype=np.uint8)
+            grown[:self._dense] = self._registers[:self._dense]
+            self._registers = grown
+        self._dense_rows[cells] = np.arange(self._dense, needed)
+        self._dense = needed
+
+    def _densify(self, cells: np.ndarray) -> None:
+        """Promote the given cells that are still sparse, moving their hashes into registers."""
+        cells = np.unique(cells)
+        cells = cells[self._dense_rows[cells] < 0]
+        if len(cells) == 0:
+            return
+        self._promote(cells)
+        moving = np.isin(self._sparse_cells, cells)
+        self._update(self._dense_rows[self._sparse_cells[moving]], self._sparse_hashes[moving])
+        self._sparse_cells, self._sparse_hashes = self._sparse_cells[~moving], self._sparse_hashes[~moving]
+
+    def _update(self, rows: np.ndarray, user_hashes: np.ndarray) -> None:
+        tail_bits = 64 - self.precision
+        buckets = (user_hashes >> np.uint64(tail_bits)).astype(np.int64)
+        tail = user_hashes & np.uint64((1 << tail_bits) - 1)
+        # Rank = position of the leftmost 1-bit in the remaining hash bits
+        ranks = (tail_bits + 1 - _bit_length(tail)).astype(np.uint8)
+        np.maximum.at(self._registers, (rows, buckets), ranks)
+
+    def add(
+        self,
+        cohorts: pd.Series,
+        periods: pd.Series,
+        user_hashes: np.ndarray,
+        known: Optional[np.ndarray] = None
+    ) -> None:
+        """
+        Add users (as hash_users() hashes) to the cells given by cohorts[i], periods[i].
+
+        Rows where known is False only create their cell, which then counts
+        zero users unless other rows add some.
+        """
+        if len(user_hashes) == 0:
+            return
+        # Factorize each axis on its own; factorizing the pairs directly is far slower
+        cohort_codes, cohort_values = pd.factorize(cohorts)
+        period_codes, period_values = pd.factorize(periods)
+        cells, codes = np.unique(cohort_codes * len(period_values) + period_codes, return_inverse=True)
+        keys = [(cohort_values[c // len(period_values)], int(period_values[c % len(period_values)])) for c in cells]
+        cell_ids = self._cell_ids(keys)[codes]
+        if known is not None:
+            cell_ids = cell_ids[known]
+            user_hashes = user_hashes[known]
+        self._insert(cell_ids, user_hashes)
+
+    def _insert(self, cell_ids: np.ndarray, user_hashes: np.ndarray) -> None:
+        """Add user hashes to existing cells, keeping sparse cells exact until they outgrow the limit."""
+        if len(user_hashes) == 0:
+            return
+        rows = self._dense_rows[cell_ids]
+        dense = rows >= 0
+        if dense.any():
+            self._update(rows[dense], user_hashes[dense])
+        if dense.all():
+            return
+
+        sparse_cells = np.concatenate([self._sparse_cells, cell_ids[~dense]])
+        sparse_hashes = np.concatenate([self._sparse_hashes, user_hashes[~dense]])
+        order = np.lexsort((sparse_hashes, sparse_cells))
+        sparse_cells, sparse_hashes = sparse_cells[order], sparse_hashes[order]
+        unique = np.ones(len(order), dtype=bool)
+        unique[1:] = (sparse_cells[1:] != sparse_cells[:-1]) | (sparse_hashes[1:] != sparse_hashes[:-1])
+        sparse_cells, sparse_hashes = sparse_cells[unique], sparse_hashes[unique]
+
+        counts = np.bincount(sparse_cells, minlength=len(self._cells))
+        promoted = np.flatnonzero(counts > self.sparse_limit)
+        if len(promoted):
+            self._promote(promoted)
+            moving = counts[sparse_cells] > self.sparse_limit
+            self._update(self._dense_rows[sparse_cells[moving]], sparse_hashes[moving])
+            sparse_cells, sparse_hashes = sparse_cells[~moving], sparse_hashes[~moving]
+        self._sparse_cells, self._sparse_hashes = sparse_cells, sparse_hashes
+
+    def _absorb(self, source: "HLLSketchMatrix", targets: np.ndarray) -> None:
+        """Union every cell i of source into cell targets[i] of this sketch."""
+        if source.precision != self.precision:
+            raise ValueError("Cannot combine HyperLogLog sketches with different precision")
+        dense = np.flatnonzero(source._dense_rows >= 0)
+        if len(dense):
+            # A cell receiving registers can no longer be counted exactly
+            self._densify(targets[dense])
+            np.maximum.at(self._registers, self._dense_rows[targets[dense]], source._registers[source._dense_rows[dense]])
+        self._insert(targets[source._sparse_cells], source._sparse_hashes)
+
+    def merge(self, other: "HLLSketchMatrix") -> "HLLSketchMatrix":
+        """Union other (e.g. the sketch of another partition) into this sketch, cell by cell."""
+        self._absorb(other, self._cell_ids(list(other._cells)))
+        return self
+
+    def regroup(self, key_map: Callable[[Hashable, int], Tuple[Hashable, int]]) -> "HLLSketchMatrix":
+        """New sketch matrix with every cell merged into the cell key_map(cohort, period)."""
+        regrouped = HLLSketchMatrix(self.precision)
+        regrouped._absorb(self, regrouped._cell_ids([key_map(*key) for key in self._cells]))
+        return regrouped
+
+    def _register_estimates(self) -> np.ndarray:
+        """HyperLogLog estimate per register row, reduced in blocks to bound temporaries."""
+        m = self.registers_per_cell
+        alpha = 0.7213 / (1 + 1.079 / m) if m >= 128 else {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        harmonic = np.empty(self._dense, dtype=np.float64)
+        zeros = np.empty(self._dense, dtype=np.int64)
+        block = max(1, ESTIMATE_BLOCK_REGISTERS // m)
+        for start in range(0, self._dense, block):
+            registers = self._registers[start:min(start + block, self._dense)]
+            harmonic[start:start + len(registers)] = _INVERSE_POWERS[registers].sum(axis=1)
+            zeros[start:start + len(registers)] = np.count_nonzero(registers == 0, axis=1)
+        raw = alpha * m * m / harmonic
+        # Linear counting is far more accurate while many registers are still empty
+        with np.errstate(divide="ignore"):
+            linear = m * np.log(m / np.maximum(zeros, 1))
+        return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+    def estimates(self) -> np.ndarray:
+        """Distinct users per cell in cell insertion order: exact for sparse cells, estimated otherwise."""
+        counts = np.bincount(self._sparse_cells, minlength=len(self._cells)).astype(np.float64)
+        dense = np.flatnonzero(self._dense_rows >= 0)
+        if len(dense):
+            counts[dense] = self._register_estimates()[self._dense_rows[dense]]
+        return counts
+
+    def cohort_data(self) -> pd.DataFrame:
+        """Estimated distinct users per cell in the engine's (CohortPeriod, PeriodIndex, CustomerID) layout."""
+        keys = list(self._cells)
+        return pd.DataFrame({
+            'CohortPeriod': [k[0] for k in keys],
+            'PeriodIndex': [k[1] for k in keys],
+            'CustomerID': np.rint(self.estimates()).astype(np.int64)
+        })
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            'method': 'hyperloglog',
+            'precision': self.precision,
+            'registers_per_cell': self.registers_per_cell,
+            'relative_standard_error': round(relative_standard_error(self.precision), 4),
+            'cells': len(self._cells),
+            'exact_cells': len(self._cells) - self._dense,
+            'sketch_bytes': int(self._registers.nbytes + self._sparse_cells.nbytes + self._sparse_hashes.nbytes)
+        }
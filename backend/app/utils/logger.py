@@ -1,39 +1,194 @@
+import atexit
+import copy
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from pathlib import Path
+from typing import Dict, Tuple, List
+import orjson
+from app.utils.metrics import metrics_registry, current_timings
 
 # Ensure logs directory exists
 LOG_DIR = Path(__file__).resolve().parent.parent.parent / "logs"
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 LOG_FILE = LOG_DIR / "app.log"
 
+# "json" writes one JSON object per record to app.log, "text" the console format
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Records waiting for the writer thread; further records are dropped, never waited for
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# INFO records let through per call site (file and line) per window
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_WINDOW_SECONDS = float(os.getenv("LOG_RATE_WINDOW_SECONDS", "1"))
+# Logging time a request may spend before its INFO records are suppressed
+LOG_REQUEST_BUDGET_MS = float(os.getenv("LOG_REQUEST_BUDGET_MS", "5"))
+
+TEXT_FORMAT = "[%(asctime)s] %(levelname)s in %(name)s: %(message)s"
+# Attributes every LogRecord has; anything else was passed with extra= and is a structured field
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "suppressed", "taskName"}
+
+
+def _fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+class TextFormatter(logging.Formatter):
+    """Console/text format with structured fields as key=value pairs and rate-limit notes."""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        text = super().formatMessage(record)
+        fields = _fields(record)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if getattr(record, "suppressed", 0):
+            text += f" ({record.suppressed} similar messages suppressed)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, thread and structured fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+            **_fields(record),
+        }
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return orjson.dumps(entry, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Suppresses INFO and DEBUG records from chatty call sites and over-budget requests.
+
+    Each call site (file and line) passes at most `limit` records per `window`
+    seconds; the number it suppressed is attached to its first record of the
+    next window. Records of a request that already spent more than
+    `budget_seconds` logging are suppressed as well. Warnings and errors
+    always pass.
+    """
+
+    def __init__(self, limit: int = LOG_RATE_LIMIT, window: float = LOG_RATE_WINDOW_SECONDS, budget_seconds: float = LOG_REQUEST_BUDGET_MS / 1000):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.budget_seconds = budget_seconds
+        self._lock = threading.Lock()
+        # (pathname, lineno) -> [window start, passed, suppressed]
+        self._sites: Dict[Tuple[str, int], List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        timings = current_timings()
+        if timings is not None and timings.log_seconds > self.budget_seconds:
+            return False
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                if site is not None and site[2]:
+                    record.suppressed = site[2]
+                site = self._sites[key] = [now, 0, 0]
+            if site[1] >= self.limit:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Hands records to the background writer without blocking the calling thread.
+
+    The message is rendered on the calling thread (its arguments may change
+    afterwards) but formatting and I/O happen on the writer. Records arriving
+    while the queue is full are dropped. The time spent here is accounted to the
+    current request and to the process metrics.
+    """
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        start = time.perf_counter()
+        outcome = "records"
+        if not self.filter(record):
+            outcome = "suppressed"
+        else:
+            try:
+                self.enqueue(self.prepare(record))
+            except queue.Full:
+                outcome = "dropped"
+        elapsed = time.perf_counter() - start
+        metrics_registry.observe_logging(elapsed, outcome)
+        timings = current_timings()
+        if timings is not None:
+            timings.log_seconds += elapsed
+            if outcome == "records":
+                timings.log_records += 1
+            elif outcome == "suppressed":
+                timings.log_suppressed += 1
+        return outcome == "records"
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.queue.put_nowait(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _build_writer() -> Tuple[BackgroundQueueHandler, QueueListener]:
+    # Console handler
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(TextFormatter(TEXT_FORMAT))
+
+    # Rotating file handler
+    fh = RotatingFileHandler(
+        LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(TEXT_FORMAT))
+
+    handler = BackgroundQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    handler.addFilter(RateLimitFilter())
+    listener = QueueListener(handler.queue, ch, fh, respect_handler_level=True)
+    listener.start()
+    # Flush what is still queued when the process exits
+    atexit.register(listener.stop)
+    return handler, listener
+
+
+_exception_formatter = logging.Formatter()
+_queue_handler, _listener = _build_writer()
+
+
 def get_logger(name: str = "cohort_analyzer") -> logging.Logger:
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
 
     # Prevent adding multiple handlers in interactive environments
     if not logger.handlers:
-        # Console handler
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch_formatter = logging.Formatter(
-            "[%(asctime)s] %(levelname)s in %(name)s: %(message)s"
-        )
-        ch.setFormatter(ch_formatter)
-        logger.addHandler(ch)
-
-        # Rotating file handler
-        fh = RotatingFileHandler(
-            LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=5, encoding="utf-8"
-        )
-        fh.setLevel(logging.INFO)
-        fh_formatter = logging.Formatter(
-            "[%(asctime)s] %(levelname)s in %(name)s: %(message)s"
-        )
-        fh.setFormatter(fh_formatter)
-        logger.addHandler(fh)
+        # Every module logger shares the one queue drained by the writer thread
+        logger.addHandler(_queue_handler)
 
     logger.propagate = False
     return logger
-
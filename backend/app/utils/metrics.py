@@ -0,0 +1,254 @@
+# Per-stage timing and memory metrics for the analysis pipeline
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Optional, List
+
+try:
+    import resource
+except ImportError:  # Windows has no resource module
+    resource = None
+
+PIPELINE_STAGES = (
+    "queue",
+    "load",
+    "decode",
+    "preprocess",
+    "date_parse",
+    "aggregate",
+    "format",
+    "heatmap",
+    "llm",
+    "export",
+)
+
+# Histogram buckets (seconds) for stage wall time
+WALL_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Return the process peak resident set size in bytes, if available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageRecord:
+    """Measurements for one execution of a pipeline stage."""
+
+    def __init__(self, stage: str, rows: Optional[int] = None):
+        self.stage = stage
+        self.rows = rows
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_delta_bytes: Optional[int] = None
+        self.failed = False
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "wall_seconds": round(self.wall_seconds, 6),
+            "cpu_seconds": round(self.cpu_seconds, 6),
+            "rows": self.rows,
+            "peak_rss_delta_bytes": self.peak_rss_delta_bytes,
+        }
+
+
+class RequestTimings:
+    """Collects the stage records of a single request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        # Time the request's own threads spent handing log records to the background writer
+        self.log_records = 0
+        self.log_suppressed = 0
+        self.log_seconds = 0.0
+
+    def add(self, record: StageRecord) -> None:
+        # A stage can run more than once per request (e.g. date parsing before
+        # and after preprocessing); accumulate instead of overwriting.
+        entry = self.stages.get(record.stage)
+        if entry is None:
+            self.stages[record.stage] = record.as_dict()
+            return
+        entry["wall_seconds"] = round(entry["wall_seconds"] + record.wall_seconds, 6)
+        entry["cpu_seconds"] = round(entry["cpu_seconds"] + record.cpu_seconds, 6)
+        if record.rows is not None:
+            entry["rows"] = max(entry["rows"] or 0, record.rows)
+        if record.peak_rss_delta_bytes is not None:
+            entry["peak_rss_delta_bytes"] = (entry["peak_rss_delta_bytes"] or 0) + record.peak_rss_delta_bytes
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "stages": self.stages,
+            "logging": {
+                "records": self.log_records,
+                "suppressed": self.log_suppressed,
+                "seconds": round(self.log_seconds, 6),
+            },
+            "total_wall_seconds": round(time.perf_counter() - self.started, 6),
+        }
+
+
+class MetricsRegistry:
+    """Process-wide aggregation of stage records, rendered as Prometheus text."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict[str, Any]] = {}
+        self._requests: Dict[str, int] = {}
+        self._logging = {"records": 0, "suppressed": 0, "dropped": 0, "seconds": 0.0}
+
+    def _stage_entry(self, stage: str) -> Dict[str, Any]:
+        entry = self._stages.get(stage)
+        if entry is None:
+            entry = {
+                "count": 0,
+                "errors": 0,
+                "wall_sum": 0.0,
+                "cpu_sum": 0.0,
+                "rows_sum": 0,
+                "rss_delta_sum": 0,
+                "rss_delta_max": 0,
+                "buckets": [0] * len(WALL_TIME_BUCKETS),
+            }
+            self._stages[stage] = entry
+        return entry
+
+    def observe(self, record: StageRecord) -> None:
+        with self._lock:
+            entry = self._stage_entry(record.stage)
+            entry["count"] += 1
+            if record.failed:
+                entry["errors"] += 1
+            entry["wall_sum"] += record.wall_seconds
+            entry["cpu_sum"] += record.cpu_seconds
+            if record.rows:
+                entry["rows_sum"] += record.rows
+            if record.peak_rss_delta_bytes:
+                entry["rss_delta_sum"] += record.peak_rss_delta_bytes
+                entry["rss_delta_max"] = max(entry["rss_delta_max"], record.peak_rss_delta_bytes)
+            for i, bound in enumerate(WALL_TIME_BUCKETS):
+                if record.wall_seconds <= bound:
+                    entry["buckets"][i] += 1
+
+    def observe_logging(self, seconds: float, outcome: str) -> None:
+        """Account one log call; outcome is 'records' (queued), 'suppressed' (rate limited) or 'dropped' (queue full)."""
+        with self._lock:
+            self._logging["seconds"] += seconds
+            self._logging[outcome] += 1
+
+    def count_request(self, endpoint: str) -> None:
+        with self._lock:
+            self._requests[endpoint] = self._requests.get(endpoint, 0) + 1
+
+    def render_prometheus(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            stages = {name: dict(entry, buckets=list(entry["buckets"])) for name, entry in self._stages.items()}
+            requests = dict(self._requests)
+            log_stats = dict(self._logging)
+
+        lines: List[str] = []
+        lines.append("# HELP cohort_requests_total Requests handled per endpoint.")
+        lines.append("# TYPE cohort_requests_total counter")
+        for endpoint, count in sorted(requests.items()):
+            lines.append(f'cohort_requests_total{{endpoint="{endpoint}"}} {count}')
+
+        lines.append("# HELP cohort_stage_wall_seconds Wall-clock time spent in each pipeline stage.")
+        lines.append("# TYPE cohort_stage_wall_seconds histogram")
+        for stage, entry in sorted(stages.items()):
+            for bound, cumulative in zip(WALL_TIME_BUCKETS, entry["buckets"]):
+                lines.append(f'cohort_stage_wall_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'cohort_stage_wall_seconds_bucket{{stage="{stage}",le="+Inf"}} {entry["count"]}')
+            lines.append(f'cohort_stage_wall_seconds_sum{{stage="{stage}"}} {entry["wall_sum"]:.6f}')
+            lines.append(f'cohort_stage_wall_seconds_count{{stage="{stage}"}} {entry["count"]}')
+
+        counters = (
+            ("cohort_stage_cpu_seconds_total", "CPU time spent in each pipeline stage.", "cpu_sum", "{:.6f}"),
+            ("cohort_stage_rows_total", "Rows processed by each pipeline stage.", "rows_sum", "{}"),
+            ("cohort_stage_peak_rss_delta_bytes_total", "Growth of the process peak RSS attributed to each stage.", "rss_delta_sum", "{}"),
+            ("cohort_stage_errors_total", "Pipeline stage executions that raised.", "errors", "{}"),
+        )
+        for name, help_text, key, fmt in counters:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for stage, entry in sorted(stages.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {fmt.format(entry[key])}')
+
+        lines.append("# HELP cohort_stage_peak_rss_delta_bytes_max Largest peak RSS growth seen for each stage.")
+        lines.append("# TYPE cohort_stage_peak_rss_delta_bytes_max gauge")
+        for stage, entry in sorted(stages.items()):
+            lines.append(f'cohort_stage_peak_rss_delta_bytes_max{{stage="{stage}"}} {entry["rss_delta_max"]}')
+
+        lines.append("# HELP cohort_log_records_total Log records by outcome (queued, suppressed by rate limits, dropped on a full queue).")
+        lines.append("# TYPE cohort_log_records_total counter")
+        for outcome, label in (("records", "queued"), ("suppressed", "suppressed"), ("dropped", "dropped")):
+            lines.append(f'cohort_log_records_total{{outcome="{label}"}} {log_stats[outcome]}')
+        lines.append("# HELP cohort_log_call_seconds_total Time calling threads spent handing records to the log writer.")
+        lines.append("# TYPE cohort_log_call_seconds_total counter")
+        lines.append(f"cohort_log_call_seconds_total {log_stats['seconds']:.6f}")
+
+        peak = peak_rss_bytes()
+        if peak is not None:
+            lines.append("# HELP cohort_process_peak_rss_bytes Peak resident set size of this process.")
+            lines.append("# TYPE cohort_process_peak_rss_bytes gauge")
+            lines.append(f"cohort_process_peak_rss_bytes {peak}")
+        return "\n".join(lines) + "\n"
+
+
+_current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("current_timings", default=None)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    """Timings of the request running on this thread (inside request_timings()), if any."""
+    return _current_timings.get()
+
+
+@contextmanager
+def request_timings():
+    """Collect stage timings for everything run inside this block."""
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+@contextmanager
+def track_stage(stage: str, rows: Optional[int] = None):
+    """
+    Measure wall time, CPU time and peak RSS growth of a pipeline stage.
+
+    The yielded record's ``rows`` can be set inside the block once the number
+    of processed rows is known. Records go to the global registry and, when
+    called inside ``request_timings()``, to the current request as well.
+    """
+    record = StageRecord(stage, rows)
+    rss_before = peak_rss_bytes()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    except BaseException:
+        record.failed = True
+        raise
+    finally:
+        record.wall_seconds = time.perf_counter() - wall_start
+        record.cpu_seconds = time.thread_time() - cpu_start
+        rss_after = peak_rss_bytes()
+        if rss_before is not None and rss_after is not None:
+            record.peak_rss_delta_bytes = rss_after - rss_before
+        metrics_registry.observe(record)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(record)
+
+
+# Global instance
+metrics_registry = MetricsRegistry()
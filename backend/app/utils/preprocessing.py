@@ -18,6 +18,7 @@ def remove_outliers(df: pd.DataFrame, z_thresh: float = 3.0) -> pd.DataFrame:
 def impute_categorical(df: pd.DataFrame, strategy: str = "most_frequent") -> pd.DataFrame:
     """Impute missing values in categorical columns."""
     cat_cols = df.select_dtypes(include=["object", "category"]).columns
+    fill_values = {}
     for col in cat_cols:
         if strategy == "most_frequent":
             fill_value = df[col].mode().iloc[0] if not df[col].mode().empty else "Unknown"
@@ -28,12 +29,15 @@ def impute_categorical(df: pd.DataFrame, strategy: str = "most_frequent") -> pd.
         else:
             fill_value = "Unknown"
         df[col] = df[col].fillna(fill_value)
-        logger.info(f"Imputed missing values in categorical column '{col}' with strategy '{strategy}' and value '{fill_value}'")
+        fill_values[col] = fill_value
+    # One record per pass rather than per column
+    logger.info(f"Imputed missing values in {len(fill_values)} categorical columns with strategy '{strategy}'", extra={"fill_values": fill_values})
     return df
 
 def impute_numerical(df: pd.DataFrame, strategy: str = "mean") -> pd.DataFrame:
     """Impute missing values in numerical columns."""
     num_cols = df.select_dtypes(include=[np.number]).columns
+    fill_values = {}
     for col in num_cols:
         if strategy == "mean":
             fill_value = df[col].mean()
@@ -44,28 +48,34 @@ def impute_numerical(df: pd.DataFrame, strategy: str = "mean") -> pd.DataFrame:
         else:
             fill_value = df[col].mean()
         df[col] = df[col].fillna(fill_value)
-        logger.info(f"Imputed missing values in numerical column '{col}' with strategy '{strategy}' and value '{fill_value}'")
+        fill_values[col] = fill_value
+    logger.info(f"Imputed missing values in {len(fill_values)} numerical columns with strategy '{strategy}'", extra={"fill_values": fill_values})
     return df
 
 def convert_types(df: pd.DataFrame) -> pd.DataFrame:
     """Convert columns to appropriate types (e.g., dates, numerics) based on heuristics."""
+    converted = {"datetime": [], "numeric": [], "unconverted": []}
     for col in df.columns:
         col_lower = col.lower()
         # Try datetime conversion only for likely date columns
         if any(x in col_lower for x in ["date", "time", "timestamp"]):
             try:
                 df[col] = pd.to_datetime(df[col], errors='raise')
-                logger.info(f"Converted column '{col}' to datetime.")
+                converted["datetime"].append(col)
                 continue
             except Exception:
-                logger.info(f"Column '{col}' could not be converted to datetime.")
+                pass
         # Try numeric conversion for columns not already numeric and not likely dates
         if not pd.api.types.is_numeric_dtype(df[col]):
             try:
                 df[col] = pd.to_numeric(df[col], errors='raise')
-                logger.info(f"Converted column '{col}' to numeric.")
+                converted["numeric"].append(col)
             except Exception:
-                logger.info(f"Column '{col}' could not be converted to numeric.")
+                converted["unconverted"].append(col)
+    logger.info(
+        f"Converted {len(converted['datetime'])} columns to datetime and {len(converted['numeric'])} to numeric",
+        extra={"converted": converted}
+    )
     return df
 
 def preprocess_dataframe(
@@ -0,0 +1,102 @@
+# Opt-in request profiling (deterministic cProfile + sampled collapsed stacks)
+import cProfile
+import hmac
+import marshal
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional, Iterator
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Admin flag: profile every analysis request regardless of headers
+PROFILE_ALL_REQUESTS = os.getenv("PROFILE_ANALYSIS", "").lower() in ("1", "true", "yes")
+# Secret a request's X-Profile header must carry to be profiled or to download a profile;
+# unset (the default) disables both
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+# cProfile can only profile one thread at a time (enable() raises ValueError on Python 3.12+
+# while another profiler is active), so one request is profiled at a time
+_profiling = threading.Lock()
+
+
+def has_profile_token(header_value: Optional[str]) -> bool:
+    """Whether the X-Profile header carries the configured PROFILE_TOKEN."""
+    if not PROFILE_TOKEN or not header_value:
+        return False
+    return hmac.compare_digest(header_value.encode(), PROFILE_TOKEN.encode())
+
+
+def should_profile(header_value: Optional[str]) -> bool:
+    """Decide whether a request opted into profiling via the X-Profile header."""
+    return PROFILE_ALL_REQUESTS or has_profile_token(header_value)
+
+
+@contextmanager
+def profiling_slot() -> Iterator[bool]:
+    """Yield whether this request may be profiled, i.e. no other request is being profiled."""
+    acquired = _profiling.acquire(blocking=False)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            _profiling.release()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class RequestProfiler:
+    """
+    Profile the calling thread with cProfile while a sampler thread records
+    its stack every SAMPLE_INTERVAL seconds.
+
+    The deterministic profile is exported as marshalled pstats (loadable with
+    ``pstats.Stats``) and the samples as collapsed stacks, the input format of
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, sample_interval: float = SAMPLE_INTERVAL):
+        self.sample_interval = sample_interval
+        self._profile = cProfile.Profile()
+        self._samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._target_ident: Optional[int] = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(self._target_ident)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self._samples[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._target_ident = threading.get_ident()
+        self._sampler = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+        self._sampler.start()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._profile.disable()
+        self._stop.set()
+        self._sampler.join()
+        return False
+
+    def pstats_bytes(self) -> bytes:
+        """Marshalled pstats data, identical to what ``dump_stats`` writes."""
+        return marshal.dumps(pstats.Stats(self._profile).stats)
+
+    def collapsed_stacks(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self._samples.most_common()) + "\n"
@@ -0,0 +1,169 @@
+# Server-side storage of cohort matrices for windowed retrieval
+import json
+import os
+import shutil
+import numpy as np
+import orjson
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+from app.utils.logger import get_logger
+from app.utils.storage_manager import storage_manager
+
+logger = get_logger(__name__)
+
+# Largest window (in cells) a single request may ask for
+MAX_WINDOW_CELLS = int(os.getenv("MAX_WINDOW_CELLS", "250000"))
+
+
+class ResultStore:
+    """
+    Persists each job's cohort matrices as .npy files under results/jobs/<job_id>/.
+
+    Matrices are dense float64 arrays (cohorts x periods) with NaN for periods a
+    cohort has not reached yet. Reads go through np.load(mmap_mode='r'), so a
+    window only touches the pages it needs.
+    """
+
+    def __init__(self, base_dir: str = "results/jobs"):
+        self.base_dir = Path(base_dir)
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+
+    def _job_dir(self, job_id: str) -> Path:
+        # job IDs are uuid hex strings; refuse anything that could escape base_dir
+        if not job_id or not job_id.isalnum():
+            raise ValueError("Invalid job id")
+        return self.base_dir / job_id
+
+    def save(
+        self,
+        job_id: str,
+        cohorts: List[str],
+        periods: List[int],
+        cohort_sizes: List[int],
+        tables: Dict[str, np.ndarray],
+        meta: Optional[Dict[str, Any]] = None
+    ) -> None:
+        job_dir = self._job_dir(job_id)
+        tmp_dir = job_dir.with_name(job_dir.name + ".tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        for name, matrix in tables.items():
+            np.save(tmp_dir / f"{name}.npy", np.ascontiguousarray(matrix, dtype=np.float64))
+        axes = {
+            "cohorts": cohorts,
+            "periods": periods,
+            "cohort_sizes": cohort_sizes,
+            "tables": sorted(tables),
+            **(meta or {}),
+        }
+        (tmp_dir / "axes.json").write_text(json.dumps(axes))
+        # Swap in atomically so readers never see a half-written result
+        shutil.rmtree(job_dir, ignore_errors=True)
+        tmp_dir.rename(job_dir)
+        storage_manager.register(job_dir, job_id)
+        logger.info(f"Stored {len(tables)} result matrices for job {job_id} ({len(cohorts)}x{len(periods)})")
+
+    def exists(self, job_id: str) -> bool:
+        return (self._job_dir(job_id) / "axes.json").exists()
+
+    def axes(self, job_id: str) -> Dict[str, Any]:
+        path = self._job_dir(job_id) / "axes.json"
+        if not path.exists():
+            raise FileNotFoundError(f"No stored results for job {job_id}")
+        storage_manager.touch(path.parent)
+        return json.loads(path.read_text())
+
+    def _matrix(self, job_id: str, table: str) -> np.ndarray:
+        axes = self.axes(job_id)
+        if table not in axes["tables"]:
+            raise KeyError(f"Table '{table}' not available for job {job_id}")
+        return np.load(self._job_dir(job_id) / f"{table}.npy", mmap_mode="r")
+
+    def window(
+        self,
+        job_id: str,
+        table: str,
+        cohort_start: int = 0,
+        cohort_end: Optional[int] = None,
+        period_start: int = 0,
+        period_end: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Rectangular slice [cohort_start:cohort_end, period_start:period_end] of a table."""
+        axes = self.axes(job_id)
+        matrix = self._matrix(job_id, table)
+        rows = slice(cohort_start, cohort_end if cohort_end is not None else matrix.shape[0])
+        cols = slice(period_start, period_end if period_end is not None else matrix.shape[1])
+        r0, r1, _ = rows.indices(matrix.shape[0])
+        c0, c1, _ = cols.indices(matrix.shape[1])
+        cells = max(0, r1 - r0) * max(0, c1 - c0)
+        if cells > MAX_WINDOW_CELLS:
+            raise ValueError(f"Window of {cells} cells exceeds the limit of {MAX_WINDOW_CELLS}")
+        block = np.asarray(matrix[r0:r1, c0:c1])
+        return {
+            "table": table,
+            "shape": list(matrix.shape),
+            "cohort_range": [r0, r1],
+            "period_range": [c0, c1],
+            "cohorts": axes["cohorts"][r0:r1],
+            "periods": axes["periods"][c0:c1],
+            "cohort_sizes": axes["cohort_sizes"][r0:r1],
+            "values": _to_json_rows(block),
+        }
+
+    def overview(self, job_id: str, table: str, max_cohorts: int = 100, max_periods: int = 100) -> Dict[str, Any]:
+        """Downsample a table to at most max_cohorts x max_periods by averaging blocks of cells."""
+        axes = self.axes(job_id)
+        matrix = np.asarray(self._matrix(job_id, table))
+        n_rows, n_cols = matrix.shape
+        row_step = max(1, -(-n_rows // max(1, max_cohorts)))
+        col_step = max(1, -(-n_cols // max(1, max_periods)))
+        out_rows = -(-n_rows // row_step)
+        out_cols = -(-n_cols // col_step)
+
+        # Pad to whole blocks with NaN and take the NaN-aware block mean
+        padded = np.full((out_rows * row_step, out_cols * col_step), np.nan)
+        padded[:n_rows, :n_cols] = matrix
+        blocks = padded.reshape(out_rows, row_step, out_cols, col_step)
+        counts = np.sum(~np.isnan(blocks), axis=(1, 3))
+        sums = np.nansum(blocks, axis=(1, 3))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+        return {
+            "table": table,
+            "shape": [n_rows, n_cols],
+            "block_size": [row_step, col_step],
+            "cohorts": axes["cohorts"][::row_step],
+            "periods": axes["periods"][::col_step],
+            "values": _to_json_rows(means),
+        }
+
+    def save_response(self, job_id: str, content: Dict[str, Any]) -> None:
+        """Store a full analysis response next to the job's matrices."""
+        job_dir = self._job_dir(job_id)
+        job_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = job_dir / "response.json.tmp"
+        tmp_path.write_bytes(orjson.dumps(content, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+        os.replace(tmp_path, job_dir / "response.json")
+        storage_manager.register(job_dir, job_id)
+
+    def load_response(self, job_id: str) -> bytes:
+        path = self._job_dir(job_id) / "response.json"
+        if not path.exists():
+            raise FileNotFoundError(f"No stored response for job {job_id}")
+        storage_manager.touch(path.parent)
+        return path.read_bytes()
+
+    def delete(self, job_id: str) -> None:
+        shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+
+
+def _to_json_rows(block: np.ndarray) -> List[List[Optional[float]]]:
+    """2D array -> nested lists with None in place of NaN."""
+    values = block.astype(object)
+    values[np.isnan(block)] = None
+    return values.tolist()
+
+
+# Global instance
+result_store = ResultStore()
@@ -0,0 +1,176 @@
+# Column type, date format and role inference from a sample of an uploaded file
+import gzip
+import io
+import os
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+from typing import Dict, Any, List, Optional, Tuple
+from app.utils.file_readers import CSV_COMPRESSION, CSV_ENCODINGS, file_extension, is_csv, read_csv_bytes, columnar_sample
+
+SCHEMA_SAMPLE_ROWS = int(os.getenv("SCHEMA_SAMPLE_ROWS", "10000"))
+# Share of non-null sample values a guessed date format must parse
+DATE_MATCH_RATIO = 0.95
+# Columns this unique in the sample are assumed to keep growing with the file
+HIGH_CARDINALITY_RATIO = 0.5
+# Fewer distinct values per sampled row than this look like categories, not user IDs
+MIN_ID_DISTINCT_RATIO = 0.01
+
+ROLE_HINTS = {
+    'user_id': ('user', 'customer', 'client', 'account', 'member', 'visitor', 'id'),
+    'timestamp': ('date', 'time', 'timestamp', 'day', 'created'),
+    'revenue': ('revenue', 'amount', 'price', 'sales', 'total', 'value', 'spend', 'payment'),
+}
+
+
+def _open_csv(file_path: str, ext: str):
+    """Binary stream of the uncompressed CSV text, decompressed on the fly."""
+    if CSV_COMPRESSION[ext] == 'gzip':
+        return gzip.open(file_path, "rb")
+    if CSV_COMPRESSION[ext] == 'zstd':
+        # Imported on first use; only .csv.zst uploads need it
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb"), closefd=True))
+    return open(file_path, "rb")
+
+
+def _stream_csv_sample(file_path: str, ext: str, max_rows: int) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """First max_rows rows parsed straight from the (decompressing) stream, which is only read as far as they go."""
+    for encoding in CSV_ENCODINGS:
+        try:
+            with _open_csv(file_path, ext) as f:
+                return pd.read_csv(f, nrows=max_rows, encoding=encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    return None, None
+
+
+def read_csv_sample(file_path: str, max_rows: int = SCHEMA_SAMPLE_ROWS, ext: str = '.csv') -> Tuple[pd.DataFrame, str, int, bool]:
+    """
+    First max_rows rows of a (possibly compressed) CSV file.
+
+    Returns (sample, encoding, sample_bytes, whole_file), sample_bytes counting
+    uncompressed bytes. The raw header and rows are read once and decoded from
+    memory with the loader's encoding fallbacks.
+    """
+    with _open_csv(file_path, ext) as f:
+        lines = []
+        for _ in range(max_rows + 1):
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+        whole_file = not f.read(1)
+    raw = b"".join(lines)
+    try:
+        sample, encoding = read_csv_bytes(raw)
+    except pd.errors.ParserError:
+        # The line cut split a quoted multi-line field; let the parser pick the rows
+        sample, encoding = _stream_csv_sample(file_path, ext, max_rows)
+    if sample is None:
+        raise ValueError("Unable to read CSV file. Please check the file encoding.")
+    return sample, encoding, len(raw), whole_file
+
+
+def _date_format(values: pd.Series) -> Optional[str]:
+    """strptime format that parses nearly all of the (non-null, text) values, else None."""
+    fmt = guess_datetime_format(str(values.iloc[0]))
+    if fmt is None:
+        return None
+    parsed = pd.to_datetime(values, format=fmt, errors='coerce')
+    return fmt if parsed.notna().mean() >= DATE_MATCH_RATIO else None
+
+
+def _hint_score(name: str, role: str) -> int:
+    lowered = str(name).lower()
+    return sum(hint in lowered for hint in ROLE_HINTS[role])
+
+
+def infer_column(series: pd.Series, total_rows: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Profile one sampled column.
+
+    total_rows is the (estimated) row count of the whole file, used to scale the
+    distinct count of high-cardinality columns; None means the sample is the file.
+    """
+    rows = len(series)
+    values = series.dropna()
+    inferred_type, date_format = 'string', None
+    if pd.api.types.is_bool_dtype(series):
+        inferred_type = 'boolean'
+    elif pd.api.types.is_integer_dtype(series):
+        inferred_type = 'integer'
+    elif pd.api.types.is_float_dtype(series):
+        # Integer columns with missing values are read as floats
+        inferred_type = 'integer' if len(values) and (values % 1 == 0).all() else 'float'
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        inferred_type = 'datetime'
+    elif len(values):
+        date_format = _date_format(values.astype(str))
+        if date_format is not None:
+            inferred_type = 'datetime'
+
+    distinct = int(values.nunique())
+    cardinality = distinct
+    if total_rows is not None and len(values) and distinct / len(values) > HIGH_CARDINALITY_RATIO:
+        cardinality = int(round(distinct * total_rows / max(rows, 1)))
+
+    roles = []
+    if inferred_type == 'datetime':
+        roles.append('timestamp')
+    if inferred_type in ('integer', 'string') and distinct > 1 and distinct >= MIN_ID_DISTINCT_RATIO * len(values):
+        roles.append('user_id')
+    if inferred_type in ('integer', 'float') and len(values) and values.min() >= 0:
+        roles.append('revenue')
+
+    return {
+        'name': series.name,
+        'inferred_type': inferred_type,
+        'dtype': str(series.dtype),
+        'date_format': date_format,
+        'null_ratio': round(float(series.isna().mean()), 4) if rows else 0.0,
+        'distinct_in_sample': distinct,
+        'cardinality_estimate': cardinality,
+        'roles': roles,
+    }
+
+
+def rank_candidates(columns: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """Column names per role, best match first (name hints, then fewer nulls, then file order)."""
+    candidates = {}
+    for role in ROLE_HINTS:
+        matches = [c for c in columns if role in c['roles']]
+        if role == 'user_id':
+            # IDs repeat across events but are rarely constant; prefer the most distinct
+            matches.sort(key=lambda c: -c['cardinality_estimate'])
+        matches.sort(key=lambda c: (-_hint_score(c['name'], role), c['null_ratio']))
+        candidates[role] = [c['name'] for c in matches]
+    return candidates
+
+
+def infer_schema(file_path: str, max_rows: int = SCHEMA_SAMPLE_ROWS) -> Dict[str, Any]:
+    """
+    Per-column profile and role candidates of an uploaded file, from its first max_rows rows.
+
+    estimated_rows is exact for Parquet/Feather (file metadata) and for files the
+    sample covers, extrapolated from the sample's share of the bytes for plain
+    CSVs and None for compressed CSVs that are only partly sampled.
+    """
+    ext = file_extension(file_path)
+    encoding = None
+    if is_csv(ext):
+        sample, encoding, sample_bytes, whole_file = read_csv_sample(file_path, max_rows, ext)
+        estimated_rows = len(sample) if whole_file else None
+        if not whole_file and sample_bytes and CSV_COMPRESSION[ext] is None:
+            estimated_rows = int(len(sample) * os.path.getsize(file_path) / sample_bytes)
+    else:
+        sample, estimated_rows = columnar_sample(file_path, ext, max_rows)
+        whole_file = len(sample) == estimated_rows
+    columns = [infer_column(sample[col], None if whole_file else estimated_rows) for col in sample.columns]
+    return {
+        'encoding': encoding,
+        'sample_rows': len(sample),
+        'sampled_whole_file': whole_file,
+        'estimated_rows': estimated_rows,
+        'columns': columns,
+        'candidates': rank_candidates(columns),
+    }
@@ -0,0 +1,45 @@
+# In-flight deduplication of identical concurrent computations
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key at a time.
+
+    A caller that arrives while a computation for its key is running waits for
+    that computation and receives its result (or exception) instead of starting
+    its own. Nothing is cached: once the computation finishes, the next caller
+    for the key starts a fresh one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Return (result, shared); shared is True when the result came from another caller's run."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,288 @@
+# Size, owner and last-access tracking of the working directories, with quota and TTL eviction
+import os
+import shutil
+import threading
+import time
+from typing import Optional, Dict, Set, Tuple
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+MB = 1024 * 1024
+
+# Byte quotas per working directory (0 disables the quota)
+UPLOADS_QUOTA_MB = float(os.getenv("UPLOADS_QUOTA_MB", "4096"))
+OUTPUT_CSVS_QUOTA_MB = float(os.getenv("OUTPUT_CSVS_QUOTA_MB", "1024"))
+RESULTS_QUOTA_MB = float(os.getenv("RESULTS_QUOTA_MB", "2048"))
+CHARTS_QUOTA_MB = float(os.getenv("CHARTS_QUOTA_MB", "512"))
+COHORT_INDEX_QUOTA_MB = float(os.getenv("COHORT_INDEX_QUOTA_MB", "2048"))
+# Artifacts not read for this long are evicted regardless of quota (0 disables the TTL)
+STORAGE_TTL_HOURS = float(os.getenv("STORAGE_TTL_HOURS", "168"))
+# Seconds between background sweeps (0 disables the sweeper; POST /api/storage/sweep still works)
+STORAGE_SWEEP_SECONDS = float(os.getenv("STORAGE_SWEEP_SECONDS", "300"))
+# Pins older than this are treated as leaked by a job that never finished
+STORAGE_PIN_MAX_SECONDS = float(os.getenv("STORAGE_PIN_MAX_SECONDS", "21600"))
+
+# area -> (directory, quota in bytes, subdirectories whose entries are artifacts of the area too)
+AREAS: Dict[str, Tuple[str, int, Tuple[str, ...]]] = {
+    "uploads": ("uploads", int(UPLOADS_QUOTA_MB * MB), ()),
+    "output_csvs": ("output_csvs", int(OUTPUT_CSVS_QUOTA_MB * MB), ()),
+    "results": ("results", int(RESULTS_QUOTA_MB * MB), ("jobs",)),
+    "charts": (os.path.join("static", "charts"), int(CHARTS_QUOTA_MB * MB), ()),
+    "cohort_index": (os.path.join("cache", "cohort_index"), int(COHORT_INDEX_QUOTA_MB * MB), ()),
+}
+# Files written next to an artifact that live and die with it (the column schema of an upload)
+COMPANION_SUFFIXES = (".schema.json",)
+# In-progress writes (result_store, schema sidecars) and build locks are never artifacts of their own
+TEMPORARY_SUFFIXES = (".tmp", ".lock")
+
+
+def _size(path: str) -> int:
+    """Bytes of a file plus its companions, or of everything below a directory."""
+    try:
+        if os.path.isdir(path):
+            total = 0
+            for root, _, files in os.walk(path):
+                for name in files:
+                    try:
+                        total += os.path.getsize(os.path.join(root, name))
+                    except OSError:
+                        pass
+            return total
+        total = os.path.getsize(path)
+    except OSError:
+        return 0
+    for suffix in COMPANION_SUFFIXES:
+        try:
+            total += os.path.getsize(path + suffix)
+        except OSError:
+            pass
+    return total
+
+
+def _remove(path: str) -> None:
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    for target in (path,) + tuple(path + suffix for suffix in COMPANION_SUFFIXES):
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+
+
+class Artifact:
+    """One tracked file or directory: its area, size, owning job and last access time."""
+
+    __slots__ = ("path", "area", "size", "job_id", "last_access")
+
+    def __init__(self, path: str, area: str, size: int, job_id: Optional[str], last_access: float):
+        self.path = path
+        self.area = area
+        self.size = size
+        self.job_id = job_id
+        self.last_access = last_access
+
+
+class StorageManager:
+    """
+    Keeps uploads/, output_csvs/, results/, static/charts/ and cache/cohort_index/ within their quotas.
+
+    Every direct entry of an area's directory (and of its listed subdirectories,
+    e.g. results/jobs/<job_id>) is an artifact, keyed by absolute path. Artifacts
+    are registered when written and touched when read; a directory scan on each
+    sweep picks up anything written elsewhere or before startup, using the file's
+    mtime as its last access. A sweep evicts artifacts idle for longer than the
+    TTL, then the least recently used ones until each area is within its quota.
+    Artifacts pinned by a running job, or owned by one, are never evicted; a job
+    pins what it reads when it starts and releases it when it ends.
+    """
+
+    def __init__(
+        self,
+        areas: Dict[str, Tuple[str, int, Tuple[str, ...]]] = AREAS,
+        ttl_seconds: float = STORAGE_TTL_HOURS * 3600,
+        sweep_seconds: float = STORAGE_SWEEP_SECONDS,
+        pin_max_seconds: float = STORAGE_PIN_MAX_SECONDS
+    ):
+        self.areas = areas
+        self.ttl_seconds = ttl_seconds
+        self.sweep_seconds = sweep_seconds
+        self.pin_max_seconds = pin_max_seconds
+        self._lock = threading.Lock()
+        self._artifacts: Dict[str, Artifact] = {}
+        # job_id -> (pinned at, absolute paths the job reads)
+        self._pins: Dict[str, Tuple[float, Set[str]]] = {}
+        self._stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+
+    def _area_of(self, path: str) -> Optional[str]:
+        parent = os.path.dirname(path)
+        for area, (directory, _, nested) in self.areas.items():
+            root = os.path.abspath(directory)
+            if parent == root or (os.path.dirname(parent) == root and os.path.basename(parent) in nested):
+                return area
+        return None
+
+    def register(self, path, job_id: Optional[str] = None) -> None:
+        """Track a freshly written artifact (or re-measure a rewritten one)."""
+        path = os.path.abspath(path)
+        area = self._area_of(path)
+        if area is None:
+            return
+        size = _size(path)
+        with self._lock:
+            known = self._artifacts.get(path)
+            owner = job_id or (known.job_id if known is not None else None)
+            self._artifacts[path] = Artifact(path, area, size, owner, time.time())
+
+    def touch(self, path) -> None:
+        """Record a read, keeping the artifact off the eviction list for longer."""
+        path = os.path.abspath(path)
+        with self._lock:
+            artifact = self._artifacts.get(path)
+            if artifact is not None:
+                artifact.last_access = time.time()
+        if artifact is None:
+            self.register(path)
+
+    def pin(self, job_id: str, *paths) -> None:
+        """Protect the job's own artifacts, and the given paths, until release(job_id)."""
+        with self._lock:
+            since, pinned = self._pins.get(job_id, (time.time(), set()))
+            pinned.update(os.path.abspath(path) for path in paths)
+            self._pins[job_id] = (since, pinned)
+
+    def release(self, job_id: str) -> None:
+        with self._lock:
+            self._pins.pop(job_id, None)
+
+    def _protected(self, now: float) -> Tuple[Set[str], Set[str]]:
+        """(pinned paths, owning job ids) of the live pins; caller holds the lock."""
+        paths: Set[str] = set()
+        jobs: Set[str] = set()
+        for job_id, (since, pinned) in list(self._pins.items()):
+            if now - since > self.pin_max_seconds:
+                logger.warning(f"Dropping storage pin of job {job_id} held for over {self.pin_max_seconds:.0f}s")
+                del self._pins[job_id]
+                continue
+            jobs.add(job_id)
+            paths |= pinned
+        return paths, jobs
+
+    def scan(self) -> None:
+        """Reconcile the index with the directories: add untracked entries, drop vanished ones."""
+        found: Dict[str, Tuple[str, float, Optional[str]]] = {}
+        for area, (directory, _, nested) in self.areas.items():
+            roots = [(os.path.abspath(directory), False)]
+            roots += [(os.path.abspath(os.path.join(directory, sub)), True) for sub in nested]
+            for root, owned_by_name in roots:
+                try:
+                    entries = list(os.scandir(root))
+                except FileNotFoundError:
+                    continue
+                names = {entry.name for entry in entries}
+                for entry in entries:
+                    if entry.name.endswith(TEMPORARY_SUFFIXES):
+                        continue
+                    if root == os.path.abspath(directory) and entry.is_dir() and entry.name in nested:
+                        continue
+                    if any(entry.name.endswith(s) and entry.name[:-len(s)] in names for s in COMPANION_SUFFIXES):
+                        continue
+                    try:
+                        mtime = entry.stat().st_mtime
+                    except OSError:
+                        continue
+                    # results/jobs/<job_id> is named after the job that owns it
+                    found[entry.path] = (area, mtime, entry.name if owned_by_name else None)
+
+        with self._lock:
+            untracked = [path for path in found if path not in self._artifacts]
+        sized = {path: _size(path) for path in untracked}
+        with self._lock:
+            # An artifact registered after the listing above isn't in found but still exists
+            for path in [path for path in self._artifacts if path not in found and not os.path.exists(path)]:
+                del self._artifacts[path]
+            for path, size in sized.items():
+                if path not in self._artifacts:
+                    area, mtime, job_id = found[path]
+                    self._artifacts[path] = Artifact(path, area, size, job_id, mtime)
+
+    def sweep(self) -> Dict[str, Dict[str, int]]:
+        """Evict expired, then least recently used, unpinned artifacts; returns evictions per area."""
+        self.scan()
+        evicted: Dict[str, Dict[str, int]] = {area: {"artifacts": 0, "bytes": 0} for area in self.areas}
+        now = time.time()
+        # Deleting under the lock means a job can't pin an artifact that is half gone
+        with self._lock:
+            pinned, jobs = self._protected(now)
+            for area, (_, quota, _) in self.areas.items():
+                artifacts = sorted(
+                    (a for a in self._artifacts.values() if a.area == area),
+                    key=lambda a: a.last_access
+                )
+                used = sum(a.size for a in artifacts)
+                for artifact in artifacts:
+                    expired = self.ttl_seconds > 0 and now - artifact.last_access > self.ttl_seconds
+                    over_quota = quota > 0 and used > quota
+                    if not (expired or over_quota):
+                        continue
+                    if artifact.path in pinned or artifact.job_id in jobs:
+                        continue
+                    _remove(artifact.path)
+                    del self._artifacts[artifact.path]
+                    used -= artifact.size
+                    evicted[area]["artifacts"] += 1
+                    evicted[area]["bytes"] += artifact.size
+                if quota > 0 and used > quota:
+                    logger.warning(f"Storage area {area} stays over quota ({used} > {quota} bytes): the rest is pinned")
+        for area, counts in evicted.items():
+            if counts["artifacts"]:
+                logger.info(f"Evicted {counts['artifacts']} artifacts ({counts['bytes']} bytes) from {area}")
+        return evicted
+
+    def usage(self) -> Dict[str, Dict[str, int]]:
+        now = time.time()
+        with self._lock:
+            pinned, jobs = self._protected(now)
+            usage = {
+                area: {"bytes": 0, "quota_bytes": quota, "artifacts": 0, "pinned": 0}
+                for area, (_, quota, _) in self.areas.items()
+            }
+            for artifact in self._artifacts.values():
+                entry = usage[artifact.area]
+                entry["bytes"] += artifact.size
+                entry["artifacts"] += 1
+                if artifact.path in pinned or artifact.job_id in jobs:
+                    entry["pinned"] += 1
+            return usage
+
+    def start(self) -> None:
+        """Start the background sweeper; its first sweep indexes what is already on disk."""
+        if self.sweep_seconds <= 0 or self._sweeper is not None:
+            return
+        self._sweeper = threading.Thread(target=self._sweep_forever, name="storage-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop(self) -> None:
+        """Stop the background sweeper, waiting for a sweep in progress; start() may run it again."""
+        sweeper = self._sweeper
+        if sweeper is None:
+            return
+        self._stop.set()
+        sweeper.join()
+        self._sweeper = None
+        self._stop = threading.Event()
+
+    def _sweep_forever(self) -> None:
+        stop = self._stop
+        while not stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning(f"Storage sweep failed: {str(e)}")
+            stop.wait(self.sweep_seconds)
+
+
+# Global instance
+storage_manager = StorageManager()
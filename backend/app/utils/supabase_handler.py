@@ -6,7 +6,7 @@ import uuid
 def save_tables_to_csvs(tables: dict, output_dir: str) -> list:
     """
     Save multiple DataFrames to CSV files.
-    :param tables: dict of {table_name: DataFrame}
+    :param tables: dict of {table_name: DataFrame or iterable of DataFrame chunks}
     :param output_dir: directory to save CSVs
     :return: list of CSV file paths
     """
@@ -14,7 +14,13 @@ def save_tables_to_csvs(tables: dict, output_dir: str) -> list:
     csv_paths = []
     for table_name, df in tables.items():
         csv_path = os.path.join(output_dir, f"{table_name}.csv")
-        df.to_csv(csv_path, index=False)
+        if isinstance(df, pd.DataFrame):
+            df.to_csv(csv_path, index=False)
+        else:
+            # Chunks are appended one at a time, so the whole table never has to fit in memory
+            with open(csv_path, "w", newline="") as f:
+                for i, chunk in enumerate(df):
+                    chunk.to_csv(f, index=False, header=i == 0)
         csv_paths.append(csv_path)
     return csv_paths
 
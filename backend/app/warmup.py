@@ -0,0 +1,156 @@
+# Speculative, low-priority warm-up of freshly uploaded datasets
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Dict, Tuple, Callable, FrozenSet
+import pandas as pd
+from app.admission import AdmissionController, admission_controller
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1").lower() in ("1", "true", "yes")
+# Parsed frames kept for the first analyses of recent uploads (0 keeps none)
+WARMUP_FRAME_CACHE_SIZE = int(os.getenv("WARMUP_FRAME_CACHE_SIZE", "2"))
+
+
+class WarmupCancelled(Exception):
+    """Raised at a warm-up checkpoint once the warm-up has been cancelled."""
+
+
+def _lower_priority() -> None:
+    # Linux schedules threads individually, so this only deprioritizes the warm-up thread
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+class DatasetWarmup:
+    """
+    Background warm-up of uploaded datasets, keyed by dataset_key().
+
+    Warm-ups run one at a time on a single low-priority thread. A warm-up is a
+    function of a checkpoint callable, which it calls between its stages: the
+    checkpoint blocks while any foreground analysis runs and raises
+    WarmupCancelled once the warm-up is cancelled, so warm-ups never compete
+    with requests for long and a stage in progress is the most that is wasted.
+    Inside an admission reservation a warm-up calls checkpoint(wait=False),
+    which only checks for cancellation: waiting there would keep budget from
+    the foreground jobs it waits for.
+    Parsed frames produced by warm-ups are kept in a small LRU for the first
+    analyses of the dataset; their memory is held against the admission
+    budget, and queued jobs that need it evict them.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = WARMUP_ENABLED,
+        max_frames: int = WARMUP_FRAME_CACHE_SIZE,
+        admission: Optional[AdmissionController] = admission_controller
+    ):
+        self.enabled = enabled
+        self.max_frames = max_frames
+        self.admission = admission
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._foreground = 0
+        self._pending: Dict[Tuple, threading.Event] = {}
+        self._frames: "OrderedDict[Tuple, Tuple[pd.DataFrame, FrozenSet[str]]]" = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warmup", initializer=_lower_priority)
+
+    @contextmanager
+    def foreground(self):
+        """Mark a foreground job as running; warm-ups wait at their next checkpoint until none is."""
+        with self._lock:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._foreground -= 1
+                if not self._foreground:
+                    self._idle.notify_all()
+
+    def schedule(self, key: Optional[Tuple], warm: Callable[[Callable[..., None]], None]) -> None:
+        if not self.enabled or key is None:
+            return
+        with self._lock:
+            if key in self._pending or key in self._frames:
+                return
+            cancelled = self._pending[key] = threading.Event()
+        self._executor.submit(self._run, key, warm, cancelled)
+
+    def _run(self, key: Tuple, warm: Callable[[Callable[..., None]], None], cancelled: threading.Event) -> None:
+        def checkpoint(wait: bool = True):
+            with self._idle:
+                while wait and self._foreground and not cancelled.is_set():
+                    self._idle.wait()
+            if cancelled.is_set():
+                raise WarmupCancelled()
+
+        try:
+            warm(checkpoint)
+        except WarmupCancelled:
+            logger.info(f"Warm-up of {key[0]} cancelled")
+        except Exception as e:
+            logger.warning(f"Warm-up of {key[0]} failed: {str(e)}")
+        finally:
+            with self._lock:
+                if self._pending.get(key) is cancelled:
+                    del self._pending[key]
+
+    def pending(self, key: Optional[Tuple]) -> bool:
+        with self._lock:
+            return key in self._pending
+
+    def cancel(self, key: Optional[Tuple] = None) -> int:
+        """Cancel the pending warm-up of key, or every pending warm-up; returns how many were cancelled."""
+        with self._idle:
+            events = list(self._pending.values()) if key is None else [self._pending.get(key)]
+            cancelled = 0
+            for event in events:
+                if event is not None and not event.is_set():
+                    event.set()
+                    cancelled += 1
+            # Wake a warm-up waiting for the foreground so it sees the cancellation
+            self._idle.notify_all()
+        return cancelled
+
+    def store_frame(self, key: Tuple, df: pd.DataFrame, parsed_columns) -> None:
+        if self.max_frames <= 0:
+            return
+        entry = (df, frozenset(parsed_columns))
+        with self._lock:
+            self._frames[key] = entry
+            self._frames.move_to_end(key)
+            dropped = []
+            while len(self._frames) > self.max_frames:
+                dropped.append(self._frames.popitem(last=False)[0])
+        # Outside our lock: the controller calls _evict() with its own lock held
+        if self.admission is not None:
+            for old in dropped:
+                self.admission.release(("warmup", old))
+            self.admission.hold(("warmup", key), int(df.memory_usage(deep=True).sum()), lambda: self._evict(key, entry))
+
+    def _evict(self, key: Tuple, entry) -> None:
+        with self._lock:
+            if self._frames.get(key) is entry:
+                del self._frames[key]
+                logger.info(f"Warmed frame of {key[0]} evicted to admit a job")
+
+    def frame(self, key: Optional[Tuple]) -> Optional[Tuple[pd.DataFrame, FrozenSet[str]]]:
+        """The warmed (df, date columns already parsed) of the dataset; never modify df itself."""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is not None:
+                self._frames.move_to_end(key)
+            return entry
+
+
+# Global instance
+dataset_warmup = DatasetWarmup()
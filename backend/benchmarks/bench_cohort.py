@@ -0,0 +1,212 @@
+"""
+Microbenchmarks for the cohort engine.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_cohort --rows 100k,1M,10M
+    python -m benchmarks.bench_cohort --rows 100k --save-baseline
+
+Every target is timed (best of --repeat runs) and, in a separate run under
+tracemalloc, its peak traced memory is recorded. Results are compared with
+benchmarks/baseline.json; the process exits with status 1 if any result is
+slower or larger than the baseline by more than the configured tolerance.
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, Any, List, Optional
+
+import pandas as pd
+
+from app.analysis import cohort_service
+from app.chart_generation import chart_service
+from app.utils.preprocessing import preprocess_dataframe
+from benchmarks.synthetic import generate_events
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baseline.json"
+INTERVALS = ["daily", "weekly", "monthly", "quarterly", "yearly"]
+METRICS = ["retention", "revenue"]
+TARGETS = ["perform_cohort_analysis", "format_results", "preprocess_dataframe", "retention_heatmap"]
+
+
+def parse_rows(value: str) -> List[int]:
+    sizes = []
+    for part in value.split(","):
+        part = part.strip().lower()
+        multiplier = 1
+        if part.endswith("k"):
+            multiplier, part = 1_000, part[:-1]
+        elif part.endswith("m"):
+            multiplier, part = 1_000_000, part[:-1]
+        sizes.append(int(float(part) * multiplier))
+    return sizes
+
+
+def format_rows(rows: int) -> str:
+    if rows % 1_000_000 == 0:
+        return f"{rows // 1_000_000}M"
+    if rows % 1_000 == 0:
+        return f"{rows // 1_000}k"
+    return str(rows)
+
+
+def measure(func: Callable[[], Any], repeat: int, memory: bool) -> Dict[str, Optional[float]]:
+    """Best-of-N wall time and (optionally) peak traced memory of func()."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak_mb = peak / (1024 * 1024)
+    return {"seconds": best, "peak_mb": peak_mb}
+
+
+def prepare_tables(df: pd.DataFrame, interval: str, revenue_col: Optional[str]):
+    """Run the engine up to (but excluding) formatting, as perform_cohort_analysis does."""
+    df_analysis = df.rename(columns={"user_id": "CustomerID", "event_date": "InvoiceDate"})
+    return cohort_service._aggregate(df, df_analysis, "event_date", "event_date", interval, revenue_col)
+
+
+def build_cases(df: pd.DataFrame, intervals: List[str], metrics: List[str], targets: List[str]):
+    """Yield (target, interval, metric, callable) for every requested combination."""
+    if "preprocess_dataframe" in targets:
+        config = {"dataCleaning": False, "nullHandling": True, "typeConversion": True}
+        yield "preprocess_dataframe", "-", "-", lambda: preprocess_dataframe(df.copy(), config)
+
+    for interval in intervals:
+        for metric in metrics:
+            revenue_col = "revenue" if metric == "revenue" else None
+            if "perform_cohort_analysis" in targets:
+                yield "perform_cohort_analysis", interval, metric, (
+                    lambda interval=interval, revenue_col=revenue_col: cohort_service.perform_cohort_analysis(
+                        df=df,
+                        user_id_col="user_id",
+                        cohort_grouping_col="event_date",
+                        event_col="event_date",
+                        interval=interval,
+                        revenue_col=revenue_col,
+                    )
+                )
+            if "format_results" in targets or "retention_heatmap" in targets:
+                cohort_pivot, cohort_sizes, retention, revenue_table, _ = prepare_tables(df, interval, revenue_col)
+                if "format_results" in targets:
+                    yield "format_results", interval, metric, (
+                        lambda a=(retention, cohort_sizes, interval, revenue_table, cohort_pivot):
+                            cohort_service._format_results(len(df), *a)
+                    )
+                # The heatmap only depends on retention, so run it once per interval
+                if "retention_heatmap" in targets and metric == metrics[0]:
+                    yield "retention_heatmap", interval, "-", (
+                        lambda retention=retention, interval=interval:
+                            chart_service.generate_retention_heatmap(retention, interval)
+                    )
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    time_tol: float,
+    mem_tol: float,
+    min_seconds: float = 0.05
+):
+    """Return a list of human readable regression messages."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        # Sub-millisecond targets are dominated by noise; require an absolute slowdown too
+        slowdown = result["seconds"] - (base.get("seconds") or 0)
+        if base.get("seconds") and result["seconds"] > base["seconds"] * (1 + time_tol) and slowdown > min_seconds:
+            regressions.append(
+                f"{key}: {result['seconds']:.3f}s vs baseline {base['seconds']:.3f}s (+{time_tol:.0%} allowed)"
+            )
+        if base.get("peak_mb") and result.get("peak_mb") and result["peak_mb"] > base["peak_mb"] * (1 + mem_tol):
+            regressions.append(
+                f"{key}: {result['peak_mb']:.1f}MB vs baseline {base['peak_mb']:.1f}MB (+{mem_tol:.0%} allowed)"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Cohort engine microbenchmarks")
+    parser.add_argument("--rows", default="100k,1M,10M", help="Comma separated row counts, e.g. 100k,1M,10M")
+    parser.add_argument("--intervals", default=",".join(INTERVALS))
+    parser.add_argument("--metrics", default=",".join(METRICS))
+    parser.add_argument("--targets", default=",".join(TARGETS))
+    parser.add_argument("--events-per-user", type=float, default=10.0)
+    parser.add_argument("--users", type=int, default=None, help="Distinct users (overrides --events-per-user)")
+    parser.add_argument("--days", type=int, default=365, help="Date span of the generated events")
+    parser.add_argument("--id-type", choices=["int", "str"], default="int")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc peak memory run")
+    parser.add_argument("--baseline", default=str(BASELINE_PATH))
+    parser.add_argument("--save-baseline", action="store_true", help="Write results into the baseline file")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="Ignore slowdowns smaller than this")
+    parser.add_argument("--output", default=None, help="Also write raw results as JSON to this path")
+    args = parser.parse_args(argv)
+
+    intervals = [i for i in args.intervals.split(",") if i]
+    metrics = [m for m in args.metrics.split(",") if m]
+    targets = [t for t in args.targets.split(",") if t]
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for rows in parse_rows(args.rows):
+        df = generate_events(
+            rows,
+            users=args.users,
+            events_per_user=args.events_per_user,
+            days=args.days,
+            revenue=True,
+            id_type=args.id_type,
+            seed=args.seed,
+        )
+        for target, interval, metric, func in build_cases(df, intervals, metrics, targets):
+            key = f"{target}|{format_rows(rows)}|{interval}|{metric}|{args.id_type}"
+            result = measure(func, args.repeat, not args.no_memory)
+            results[key] = result
+            base = baseline.get(key, {})
+            delta = ""
+            if base.get("seconds"):
+                delta = f"{(result['seconds'] / base['seconds'] - 1):+.1%}"
+            peak = f"{result['peak_mb']:.1f}MB" if result["peak_mb"] is not None else "-"
+            print(f"{key:<70} {result['seconds']:>9.3f}s {peak:>10} {delta:>8}", flush=True)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        baseline.update(results)
+        baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"Baseline written to {baseline_path}")
+        return 0
+
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.min_seconds)
+    if regressions:
+        print("\nPERFORMANCE REGRESSIONS:", file=sys.stderr)
+        for message in regressions:
+            print(f"  {message}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+Cold start benchmark for API workers.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --repeat 10 --save-baseline
+    python -m benchmarks.bench_startup --max-ready-seconds 1.0 --top 15
+
+Each repeat starts fresh interpreters in a scratch directory, with a SQLite
+job store and local result storage so no external service is needed, and
+measures:
+
+- import:  seconds to import app.main
+- ready:   seconds from launching uvicorn until /api/ready answers 200
+
+The best and median of each are printed; with --top the slowest imports of
+app.main (python -X importtime, cumulative) are listed as well. Medians are
+compared with benchmarks/startup_baseline.json, recorded on the same machine
+with --save-baseline; the process exits with status 1 if either is slower
+than the baseline by more than the tolerance, or if the median time to ready
+exceeds --max-ready-seconds when that is given.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+BASELINE_PATH = Path(__file__).resolve().parent / "startup_baseline.json"
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import app.main; print(time.perf_counter() - start)"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def worker_env(workdir: Path) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": str(BACKEND_DIR) + os.pathsep + env.get("PYTHONPATH", ""),
+        "SUPABASE_DB_URL": f"sqlite:///{workdir / 'jobs.db'}",
+        "STORAGE_BACKEND": "local",
+        "LOCAL_STORAGE_DIR": str(workdir / "storage"),
+    })
+    return env
+
+
+def measure_import(workdir: Path) -> float:
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=workdir, env=worker_env(workdir), capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def measure_ready(workdir: Path, timeout: float) -> float:
+    port = free_port()
+    command = [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+    ]
+    start = time.perf_counter()
+    server = subprocess.Popen(command, cwd=workdir, env=worker_env(workdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/ready", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with status {server.returncode} before becoming ready")
+            time.sleep(0.01)
+        raise RuntimeError(f"Server did not become ready within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def slowest_imports(workdir: Path, top: int) -> List[str]:
+    """The top slowest imports of app.main by cumulative time, as 'seconds  module' lines."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        cwd=workdir, env=worker_env(workdir), capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        rows.append((int(cumulative) / 1e6, module.rstrip()))
+    rows.sort(reverse=True)
+    return [f"{seconds:>8.3f}s  {module}" for seconds, module in rows[:top]]
+
+
+def summarize(name: str, samples: List[float], baseline: Optional[float]) -> None:
+    delta = f"  {statistics.median(samples) / baseline - 1:+.1%} vs baseline" if baseline else ""
+    print(f"{name:<8} best {min(samples):.3f}s  median {statistics.median(samples):.3f}s  ({len(samples)} runs){delta}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="API worker cold start benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=str(BASELINE_PATH))
+    parser.add_argument("--save-baseline", action="store_true", help="Write the medians into the baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown of a median over its baseline")
+    parser.add_argument("--max-ready-seconds", type=float, default=None, help="Also fail if the median time to ready exceeds this")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Give up on a server that isn't ready after this long")
+    parser.add_argument("--top", type=int, default=0, help="Also list this many slowest imports of app.main")
+    args = parser.parse_args(argv)
+
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    workdir = Path(tempfile.mkdtemp(prefix="cohort-startup-"))
+    try:
+        results = {
+            "import": [measure_import(workdir) for _ in range(args.repeat)],
+            "ready": [measure_ready(workdir, args.timeout) for _ in range(args.repeat)],
+        }
+        for name, samples in results.items():
+            summarize(name, samples, baseline.get(f"{name}_seconds"))
+        if args.top:
+            print("\nSlowest imports (cumulative):")
+            for line in slowest_imports(workdir, args.top):
+                print(line)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    medians = {f"{name}_seconds": round(statistics.median(samples), 3) for name, samples in results.items()}
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(medians, indent=2, sort_keys=True) + "\n")
+        print(f"Baseline written to {baseline_path}")
+        return 0
+
+    regressions = [
+        f"median {key[:-len('_seconds')]} {value:.3f}s vs baseline {baseline[key]:.3f}s (+{args.tolerance:.0%} allowed)"
+        for key, value in medians.items()
+        if baseline.get(key) and value > baseline[key] * (1 + args.tolerance)
+    ]
+    if args.max_ready_seconds is not None and medians["ready_seconds"] > args.max_ready_seconds:
+        regressions.append(f"median time to ready {medians['ready_seconds']:.3f}s exceeds {args.max_ready_seconds:.3f}s")
+    if regressions:
+        print("\nSTARTUP REGRESSIONS:", file=sys.stderr)
+        for message in regressions:
+            print(f"  {message}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+# Deterministic synthetic event data for benchmarks and load tests
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+
+def generate_events(
+    rows: int,
+    users: Optional[int] = None,
+    events_per_user: float = 10.0,
+    start_date: str = "2023-01-01",
+    days: int = 365,
+    revenue: bool = True,
+    id_type: str = "int",
+    seed: int = 42
+) -> pd.DataFrame:
+    """
+    Generate a reproducible event log with realistic cohort structure.
+
+    Parameters:
+    rows: Number of events to generate
+    users: Number of distinct users (defaults to rows / events_per_user)
+    events_per_user: Average events per user, used when users is not given
+    start_date: First possible signup date
+    days: Date span of the data set in days
+    revenue: Add a non-negative 'revenue' column
+    id_type: 'int' for integer user IDs or 'str' for 16-char hex strings
+    seed: Random seed; the same arguments always produce the same frame
+
+    Returns:
+    DataFrame with columns user_id, event_date and optionally revenue
+    """
+    rng = np.random.default_rng(seed)
+    if users is None:
+        users = max(1, int(rows / max(events_per_user, 1.0)))
+    users = min(users, rows)
+
+    # Every user has a signup event; the rest are spread over users and
+    # decay exponentially after signup so later periods retain fewer users
+    signup_day = rng.integers(0, days, size=users)
+    extra = rows - users
+    event_users = np.concatenate([np.arange(users), rng.integers(0, users, size=extra)])
+    offsets = np.concatenate([
+        np.zeros(users, dtype=np.int64),
+        rng.exponential(scale=max(days / 6, 1), size=extra).astype(np.int64),
+    ])
+    event_day = np.minimum(signup_day[event_users] + offsets, days - 1)
+    seconds = rng.integers(0, 86400, size=rows)
+
+    base = np.datetime64(start_date, "s")
+    event_date = base + event_day.astype("timedelta64[D]") + seconds.astype("timedelta64[s]")
+
+    if id_type == "str":
+        id_values = np.array([f"{v:016x}" for v in rng.integers(0, 2**63, size=users)], dtype=object)
+        user_ids = id_values[event_users]
+    elif id_type == "int":
+        user_ids = event_users + 100000
+    else:
+        raise ValueError("id_type must be 'int' or 'str'")
+
+    data = {"user_id": user_ids, "event_date": event_date}
+    if revenue:
+        data["revenue"] = np.round(rng.gamma(shape=2.0, scale=15.0, size=rows), 2)
+
+    # Shuffle so the frame is not ordered by user
+    order = rng.permutation(rows)
+    return pd.DataFrame(data).iloc[order].reset_index(drop=True)
@@ -0,0 +1,54 @@
+# Local stand-in for the Groq chat completions API
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_CONTENT = (
+    "- Retention drops most sharply after the first period.\n"
+    "- Recent cohorts retain slightly better than older ones.\n"
+    "- A small group of cohorts drives most of the revenue."
+)
+
+
+def make_handler(latency: float):
+    class FakeLLMHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(length)
+            if latency:
+                time.sleep(latency)
+            body = json.dumps({
+                "id": "fake-completion",
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": CANNED_CONTENT}}],
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeLLMHandler
+
+
+def start_fake_llm(port: int = 0, latency: float = 0.0) -> ThreadingHTTPServer:
+    """Start the fake LLM server in a daemon thread; port 0 picks a free port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(latency))
+    thread = threading.Thread(target=server.serve_forever, name="fake-llm", daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Groq chat completions server")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds to wait before answering")
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args.latency))
+    print(f"Fake LLM listening on http://127.0.0.1:{args.port}/openai/v1/chat/completions")
+    server.serve_forever()
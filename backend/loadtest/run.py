@@ -0,0 +1,253 @@
+"""
+End-to-end load test for the analysis API.
+
+Drives /api/upload -> /api/analysis -> /api/analysis-status at a fixed
+concurrency and reports throughput, latency percentiles and error rates.
+
+By default it starts its own uvicorn server wired to local stand-ins, so no
+Supabase project or Groq key is needed:
+
+- job store:  SQLite file in a temporary directory (SUPABASE_DB_URL=sqlite://...)
+- storage:    result zips copied to the filesystem (STORAGE_BACKEND=local)
+- LLM:        loadtest.fake_llm with configurable latency (GROQ_API_URL)
+
+Run from the backend directory:
+
+    python -m loadtest.run --concurrency 8 --sessions 40 --workers 2
+    python -m loadtest.run --url http://127.0.0.1:8000 --concurrency 4
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+from benchmarks.synthetic import generate_events
+from loadtest.fake_llm import start_fake_llm
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Recorder:
+    """Thread-safe latency and error bookkeeping per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.error_samples: List[str] = []
+
+    def record(self, endpoint: str, seconds: float, ok: bool, detail: str = "") -> None:
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+                if len(self.error_samples) < 10:
+                    self.error_samples.append(f"{endpoint}: {detail[:200]}")
+
+
+def timed(recorder: Recorder, endpoint: str, call):
+    start = time.perf_counter()
+    try:
+        response = call()
+    except requests.RequestException as e:
+        recorder.record(endpoint, time.perf_counter() - start, False, str(e))
+        return None
+    ok = response.status_code < 400
+    recorder.record(endpoint, time.perf_counter() - start, ok, f"{response.status_code} {response.text}")
+    return response if ok else None
+
+
+def run_session(base_url: str, csv_path: Path, args, recorder: Recorder) -> bool:
+    """One user journey: upload, analyse, poll until the export is ready."""
+    session_start = time.perf_counter()
+    with requests.Session() as http:
+        with open(csv_path, "rb") as f:
+            upload = timed(recorder, "/api/upload", lambda: http.post(
+                f"{base_url}/api/upload", files={"file": ("events.csv", f, "text/csv")}, timeout=args.timeout
+            ))
+        if upload is None:
+            return False
+
+        payload = {
+            "filename": upload.json()["filename"],
+            "userId": "user_id",
+            "cohortGrouping": "event_date",
+            "eventColumn": "event_date",
+            "revenueColumn": "revenue" if args.metric == "revenue" else None,
+            "analysisMetric": args.metric,
+            "cohortInterval": args.interval,
+            "columns": [],
+            "llm_insights": args.llm,
+        }
+        analysis = timed(recorder, "/api/analysis", lambda: http.post(
+            f"{base_url}/api/analysis", json=payload, timeout=args.timeout
+        ))
+        if analysis is None:
+            return False
+
+        job_id = analysis.json()["job_id"]
+        deadline = time.perf_counter() + args.status_timeout
+        while time.perf_counter() < deadline:
+            status = timed(recorder, "/api/analysis-status", lambda: http.get(
+                f"{base_url}/api/analysis-status", params={"job_id": job_id}, timeout=args.timeout
+            ))
+            if status is not None and status.json().get("status") == "ready":
+                recorder.record("session (upload to ready)", time.perf_counter() - session_start, True)
+                return True
+            time.sleep(args.poll_interval)
+        recorder.record("session (upload to ready)", time.perf_counter() - session_start, False, "status timeout")
+        return False
+
+
+def start_server(args, workdir: Path, llm_url: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": str(BACKEND_DIR) + os.pathsep + env.get("PYTHONPATH", ""),
+        "SUPABASE_DB_URL": f"sqlite:///{workdir / 'jobs.db'}",
+        "STORAGE_BACKEND": "local",
+        "LOCAL_STORAGE_DIR": str(workdir / "storage"),
+        "GROQ_API_URL": llm_url,
+        "GROQ_API_KEY": "loadtest",
+    })
+    command = [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(args.port),
+        "--workers", str(args.workers), "--log-level", "warning",
+    ]
+    # Run inside the scratch directory so uploads/, static/ and results/ land there
+    return subprocess.Popen(command, cwd=workdir, env=env)
+
+
+def wait_until_up(base_url: str, timeout: float) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/api/ready", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not come up within {timeout}s")
+
+
+def report(recorder: Recorder, elapsed: float, sessions_ok: int, sessions: int) -> Dict:
+    summary = {
+        "elapsed_seconds": round(elapsed, 3),
+        "sessions": sessions,
+        "sessions_ok": sessions_ok,
+        "session_throughput_per_s": round(sessions_ok / elapsed, 3) if elapsed else None,
+        "endpoints": {},
+    }
+    print(f"\n{sessions_ok}/{sessions} sessions completed in {elapsed:.1f}s "
+          f"({summary['session_throughput_per_s']} sessions/s)\n")
+    header = f"{'endpoint':<28}{'count':>7}{'err%':>7}{'req/s':>8}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, values in recorder.latencies.items():
+        count = len(values)
+        errors = recorder.errors.get(endpoint, 0)
+        stats = {
+            "count": count,
+            "errors": errors,
+            "error_rate": round(errors / count, 4) if count else 0.0,
+            "throughput_per_s": round(count / elapsed, 3) if elapsed else None,
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": max(values) if values else None,
+        }
+        summary["endpoints"][endpoint] = stats
+        print(f"{endpoint:<28}{count:>7}{stats['error_rate'] * 100:>6.1f}%{stats['throughput_per_s']:>8.2f}"
+              + "".join(f"{stats[k] * 1000:>7.0f}ms" for k in ("p50", "p90", "p95", "p99", "max")))
+    if recorder.error_samples:
+        print("\nSample errors:")
+        for sample in recorder.error_samples:
+            print(f"  {sample}")
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the cohort analysis API")
+    parser.add_argument("--url", default=None, help="Target an already running server instead of starting one")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the spawned server")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--sessions", type=int, default=20, help="Total upload/analysis/status journeys")
+    parser.add_argument("--rows", type=int, default=50_000, help="Rows in the generated CSV")
+    parser.add_argument("--interval", default="monthly")
+    parser.add_argument("--metric", choices=["retention", "revenue"], default="retention")
+    parser.add_argument("--llm", action="store_true", help="Request LLM insights (served by the fake LLM)")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per request timeout in seconds")
+    parser.add_argument("--status-timeout", type=float, default=300.0)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--json-output", default=None, help="Write the summary as JSON to this path")
+    parser.add_argument("--keep-workdir", action="store_true")
+    args = parser.parse_args(argv)
+
+    workdir = Path(tempfile.mkdtemp(prefix="cohort-loadtest-"))
+    server = None
+    llm = None
+    try:
+        csv_path = workdir / "events.csv"
+        generate_events(args.rows).to_csv(csv_path, index=False)
+
+        base_url = args.url
+        if base_url is None:
+            llm = start_fake_llm(latency=args.llm_latency)
+            llm_url = f"http://127.0.0.1:{llm.server_address[1]}/openai/v1/chat/completions"
+            args.port = args.port or free_port()
+            server = start_server(args, workdir, llm_url)
+            base_url = f"http://127.0.0.1:{args.port}"
+        wait_until_up(base_url, timeout=60)
+
+        recorder = Recorder()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            outcomes = list(pool.map(lambda _: run_session(base_url, csv_path, args, recorder), range(args.sessions)))
+        elapsed = time.perf_counter() - start
+
+        summary = report(recorder, elapsed, sum(outcomes), args.sessions)
+        summary["config"] = {k: v for k, v in vars(args).items() if k != "json_output"}
+        if args.json_output:
+            Path(args.json_output).write_text(json.dumps(summary, indent=2))
+        return 0 if all(outcomes) else 1
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        if llm is not None:
+            llm.shutdown()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Test setup: the app is imported against a scratch directory, with a SQLite
+job store and local result storage, so no external service is needed.
+
+Run from the backend directory:
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+WORKDIR = Path(tempfile.mkdtemp(prefix="cohort-tests-"))
+
+sys.path.insert(0, str(BACKEND_DIR))
+os.environ.update({
+    "SUPABASE_DB_URL": f"sqlite:///{WORKDIR / 'jobs.db'}",
+    "STORAGE_BACKEND": "local",
+    "LOCAL_STORAGE_DIR": str(WORKDIR / "storage"),
+    "STORAGE_SWEEP_SECONDS": "0",
+})
+# uploads/, static/ and results/ are relative to the working directory
+os.chdir(WORKDIR)
+
+
+def write_events(path, rows=1_000, users=100, days=90, revenue=False, seed=0):
+    """CSV of synthetic events: user_id, event_date (YYYY-MM-DD) and optionally revenue."""
+    rng = np.random.default_rng(seed)
+    events = pd.DataFrame({
+        'user_id': rng.integers(0, users, rows),
+        'event_date': (pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, days, rows), unit='D')).strftime('%Y-%m-%d'),
+    })
+    if revenue:
+        events['revenue'] = np.round(rng.gamma(2, 10, rows), 2)
+    events.to_csv(path, index=False)
+
+
+@pytest.fixture
+def upload(request):
+    """
+    Filename of a fresh upload of synthetic events, removed after the test.
+
+    Parametrise indirectly with write_events options, e.g.
+    @pytest.mark.parametrize("upload", [{"revenue": True}], indirect=True).
+    """
+    os.makedirs("uploads", exist_ok=True)
+    filename = f"events-{uuid.uuid4().hex[:8]}.csv"
+    write_events(f"uploads/{filename}", **getattr(request, "param", {}))
+    yield filename
+    os.remove(f"uploads/{filename}")
+
+
+@pytest.fixture
+def analysis_body(upload):
+    """/api/analysis request body for the upload: monthly retention without LLM insights."""
+    return {
+        'filename': upload, 'userId': 'user_id', 'cohortGrouping': 'event_date', 'eventColumn': 'event_date',
+        'analysisMetric': 'retention', 'cohortInterval': 'monthly', 'columns': [], 'llm_insights': False
+    }
@@ -0,0 +1,237 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main as main
+from app.admission import (
+    AdmissionController, AdmissionRejected, JobCost, MB, MEMORY_FACTOR,
+    PRIORITY_PREVIEW, PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_WARMUP, batch_cost
+)
+from app.warmup import DatasetWarmup
+
+
+def job(memory_mb=1, cpu_seconds=0.0):
+    return JobCost(memory_mb * MB, cpu_seconds)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def run_queued(controller, jobs):
+    """Queue (name, cost, priority) jobs behind a running one, release it and return the order they ran in."""
+    order, threads = [], []
+
+    def run(name, cost, priority):
+        with controller.admit(cost, priority):
+            order.append(name)
+
+    with controller.admit(job()):
+        for name, cost, priority in jobs:
+            threads.append(threading.Thread(target=run, args=(name, cost, priority)))
+            threads[-1].start()
+            wait_for(lambda: controller.stats()["queued"] == len(threads))
+    for thread in threads:
+        thread.join(5)
+    return order
+
+
+def test_priority_classes_run_in_order():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=1)
+    order = run_queued(controller, [
+        ("warmup", job(), PRIORITY_WARMUP),
+        ("batch", job(), PRIORITY_BATCH),
+        ("interactive", job(), PRIORITY_INTERACTIVE),
+        ("preview", job(), PRIORITY_PREVIEW),
+    ])
+    assert order == ["preview", "interactive", "batch", "warmup"]
+
+
+def test_short_jobs_overtake_long_ones_of_the_same_class():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=1)
+    order = run_queued(controller, [
+        ("long", job(cpu_seconds=60), PRIORITY_INTERACTIVE),
+        ("short", job(cpu_seconds=0.1), PRIORITY_INTERACTIVE),
+    ])
+    assert order == ["short", "long"]
+
+
+def test_head_of_queue_is_not_passed_over_by_smaller_jobs():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=4)
+    order, threads = [], []
+
+    def run(name, cost):
+        with controller.admit(cost):
+            order.append(name)
+
+    with controller.admit(job(60)):
+        for name, cost in [("large", job(80)), ("small", job(10))]:
+            threads.append(threading.Thread(target=run, args=(name, cost)))
+            threads[-1].start()
+            wait_for(lambda: controller.stats()["queued"] == len(threads))
+    for thread in threads:
+        thread.join(5)
+    assert order == ["large", "small"]
+
+
+def test_full_queue_rejects_immediately():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=1, max_queued=1)
+    with controller.admit(job()):
+        waiter = threading.Thread(target=lambda: controller.admit(job()).__enter__())
+        waiter.daemon = True
+        waiter.start()
+        wait_for(lambda: controller.stats()["queued"] == 1)
+        started = time.monotonic()
+        with pytest.raises(AdmissionRejected, match="queue is full"):
+            with controller.admit(job()):
+                pass
+        assert time.monotonic() - started < 1
+    waiter.join(5)
+    assert controller.stats()["rejected"] == 1
+
+
+def test_queue_timeout_rejects_and_leaves_the_queue():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=1, queue_timeout=0.1)
+    with controller.admit(job()):
+        with pytest.raises(AdmissionRejected, match="No capacity"):
+            with controller.admit(job()):
+                pass
+        stats = controller.stats()
+        assert stats["queued"] == 0 and stats["rejected"] == 1
+    # The budget and slot of the running job are returned
+    with controller.admit(job(100)):
+        assert controller.stats()["memory_in_use_mb"] == 100
+
+
+def test_oversized_job_runs_alone():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=4, queue_timeout=0.1)
+    assert controller.oversized(job(60))
+    with controller.admit(job(500)):
+        assert controller.stats()["memory_in_use_mb"] == 100
+        with pytest.raises(AdmissionRejected):
+            with controller.admit(job(1)):
+                pass
+
+
+def test_batch_is_charged_for_the_configs_running_at_once():
+    single = job(100, cpu_seconds=2)
+    working_set = 100 * MB * (MEMORY_FACTOR - 1) / MEMORY_FACTOR
+    assert batch_cost(single, 1, 4).memory_bytes == single.memory_bytes
+    cost = batch_cost(single, 20, 4)
+    assert cost.slots == 4
+    assert cost.memory_bytes == int(100 * MB + 3 * working_set)
+    assert cost.cpu_seconds == 40
+    assert batch_cost(single, 2, 4).slots == 2
+
+
+def test_multi_slot_job_waits_for_enough_slots():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=3, queue_timeout=0.1)
+    with controller.admit(job()):
+        with controller.admit(JobCost(MB, 0.0, slots=2)):
+            assert controller.stats()["running"] == 3
+            with pytest.raises(AdmissionRejected):
+                with controller.admit(job()):
+                    pass
+        with pytest.raises(AdmissionRejected):
+            with controller.admit(JobCost(MB, 0.0, slots=3)):
+                pass
+    # More slots than the controller has: runs alone
+    with controller.admit(JobCost(MB, 0.0, slots=10)):
+        assert controller.stats()["running"] == 3
+    assert controller.stats()["running"] == 0
+
+
+def test_held_memory_is_evicted_for_queued_jobs():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=2, queue_timeout=1)
+    evicted = []
+    controller.hold("old", 40 * MB, lambda: evicted.append("old"))
+    controller.hold("new", 40 * MB, lambda: evicted.append("new"))
+    assert controller.stats()["memory_held_mb"] == 80
+
+    with controller.admit(job(50)):
+        # Oldest first, and only as much as the job needs
+        assert evicted == ["old"]
+        assert controller.stats()["memory_held_mb"] == 40
+    controller.release("new")
+    stats = controller.stats()
+    assert stats["memory_held_mb"] == 0 and stats["evicted"] == 1
+
+
+def test_warmed_frames_are_charged_and_evicted():
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=2, queue_timeout=1)
+    warmup = DatasetWarmup(enabled=False, max_frames=2, admission=controller)
+    frame = pd.DataFrame({'value': np.zeros(5 * MB // 8)})
+    for name in ("a", "b", "c"):
+        warmup.store_frame((name,), frame, [])
+    # The frame dropped from the LRU no longer counts
+    assert warmup.frame(("a",)) is None
+    assert controller.stats()["memory_held_mb"] == pytest.approx(10, abs=0.1)
+
+    with controller.admit(job(92)):
+        assert warmup.frame(("b",)) is None and warmup.frame(("c",)) is not None
+    with controller.admit(job(100)):
+        assert warmup.frame(("c",)) is None
+    assert controller.stats()["memory_held_mb"] == 0
+
+
+@pytest.fixture
+def full_queue(monkeypatch):
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=1, max_queued=0)
+    monkeypatch.setattr(main, "admission_controller", controller)
+    return controller
+
+
+def test_rejected_analysis_gets_503(analysis_body, full_queue):
+    response = TestClient(main.app).post("/api/analysis", json=analysis_body)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
+
+
+def test_rejected_warmup_is_skipped(upload, full_queue, monkeypatch):
+    warmup = DatasetWarmup(enabled=False, admission=full_queue)
+    monkeypatch.setattr(main, "dataset_warmup", warmup)
+    schema = {"candidates": {"user_id": ["user_id"], "timestamp": ["event_date"]}}
+    main.warm_dataset(upload, schema, lambda wait=True: None)
+    assert warmup.frame(main.dataset_key(f"uploads/{upload}")) is None
+    assert full_queue.stats()["rejected"] == 1
+
+
+def test_warmup_is_admitted_and_keeps_its_frame(upload, monkeypatch):
+    controller = AdmissionController(memory_budget=100 * MB, cpu_slots=1)
+    warmup = DatasetWarmup(enabled=False, admission=controller)
+    monkeypatch.setattr(main, "admission_controller", controller)
+    monkeypatch.setattr(main, "dataset_warmup", warmup)
+    schema = {"candidates": {"user_id": ["user_id"], "timestamp": ["event_date"]}}
+    main.warm_dataset(upload, schema, lambda wait=True: None)
+    assert warmup.frame(main.dataset_key(f"uploads/{upload}")) is not None
+    stats = controller.stats()
+    assert stats["admitted"] == 1 and stats["running"] == 0
+    # The kept frame is charged: a job needing the whole budget evicts it
+    with controller.admit(job(100)):
+        assert warmup.frame(main.dataset_key(f"uploads/{upload}")) is None
+
+
+def test_batch_admission_covers_concurrent_configs(upload, analysis_body, monkeypatch):
+    controller = AdmissionController(memory_budget=10_000 * MB, cpu_slots=8)
+    monkeypatch.setattr(main, "admission_controller", controller)
+    costs = []
+    admit = controller.admit
+    monkeypatch.setattr(controller, "admit", lambda cost, priority: (costs.append((cost, priority)), admit(cost, priority))[1])
+    configs = [dict(analysis_body, cohortInterval=interval) for interval in ("weekly", "monthly", "quarterly")] * 2
+    requests = main.BatchAnalysisRequest(filename=upload, configs=configs).analysis_requests()
+    single = main.analysis_cost(requests[0], use_index=False)
+    response = TestClient(main.app).post("/api/analysis/batch", json={"filename": upload, "configs": configs})
+    assert response.status_code == 200
+
+    (cost, priority), = costs
+    assert priority == PRIORITY_BATCH
+    assert cost.slots == min(len(configs), main.BATCH_WORKERS)
+    assert cost.memory_bytes == batch_cost(single, len(configs), main.BATCH_WORKERS).memory_bytes > single.memory_bytes
+    assert controller.stats()["running"] == 0
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.analysis import cohort_service
+
+INTERVALS = ['daily', 'weekly', 'monthly', 'quarterly', 'yearly']
+KEYS = ['CohortPeriod', 'PeriodIndex']
+
+
+@pytest.fixture(scope="module")
+def events():
+    rng = np.random.default_rng(3)
+    n = 8_000
+    amount = pd.Series(rng.gamma(2.0, 20.0, n).round(2), dtype=object)
+    amount[rng.random(n) < 0.15] = 0.0
+    amount[rng.random(n) < 0.1] = np.nan
+    amount[rng.random(n) < 0.02] = 'n/a'
+    uid = pd.Series(rng.integers(0, 800, n).astype(float))
+    uid[rng.random(n) < 0.01] = np.nan
+    df = pd.DataFrame({
+        'uid': uid,
+        'event_time': pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 500 * 86_400, n), unit='s'),
+        'signup': pd.Timestamp('2022-12-01') + pd.to_timedelta(rng.integers(0, 400, n), unit='D'),
+        'amount': amount,
+    })
+    # Repeated rows, and repeated (user, cell) rows with other amounts
+    repeats = df.sample(1_000, random_state=0)
+    others = df.sample(1_000, random_state=1).assign(amount=lambda d: d['amount'].sample(frac=1, random_state=2).to_numpy())
+    return pd.concat([df, repeats, others], ignore_index=True)
+
+
+def analysis_frame(df, cohort_col):
+    """The renamed, date-parsed frame perform_cohort_analysis hands to _aggregate."""
+    if cohort_col == 'event_time':
+        return df.rename(columns={'uid': 'CustomerID', 'event_time': 'InvoiceDate'})
+    df_analysis = df.rename(columns={'uid': 'CustomerID', 'signup': 'CohortDate', 'event_time': 'EventDate'})
+    df_analysis['InvoiceDate'] = df_analysis['EventDate']
+    return df_analysis
+
+
+def two_pass(df_analysis, self_cohort, interval, revenue_col):
+    """Users and revenue per cell from separate passes, as before they were fused."""
+    df_clean = cohort_service._assign_periods(df_analysis, self_cohort, interval)
+    df_clean = df_clean[df_clean['PeriodIndex'] >= 0].drop_duplicates(subset=['CustomerID'] + KEYS)
+    users = df_clean.groupby(KEYS)['CustomerID'].nunique().unstack(fill_value=0)
+    df_clean[revenue_col] = pd.to_numeric(df_clean[revenue_col], errors='coerce')
+    df_revenue = df_clean.dropna(subset=[revenue_col])
+    revenue = None
+    if not df_revenue.empty:
+        revenue = df_revenue.groupby(KEYS)[revenue_col].sum().unstack(fill_value=0)
+        revenue = revenue.reindex(index=users.index, columns=users.columns, fill_value=0)
+    return users, users.divide(users[0], axis=0), revenue
+
+
+def assert_matrix_equal(actual, expected):
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False, check_names=False, check_freq=False)
+
+
+@pytest.mark.parametrize("cohort_col", ['event_time', 'signup'])
+@pytest.mark.parametrize("interval", INTERVALS)
+def test_fused_pass_matches_two_passes(events, cohort_col, interval):
+    self_cohort = cohort_col == 'event_time'
+    cohort_pivot, cohort_sizes, retention, revenue_table, approximation = cohort_service._aggregate(
+        events, analysis_frame(events, cohort_col), cohort_col, 'event_time', interval, 'amount'
+    )
+    users, expected_retention, expected_revenue = two_pass(
+        analysis_frame(events, cohort_col), self_cohort, interval, 'amount'
+    )
+
+    assert approximation is None
+    assert_matrix_equal(cohort_pivot, users)
+    assert_matrix_equal(retention, expected_retention)
+    pd.testing.assert_series_equal(cohort_sizes, users[0], check_dtype=False, check_names=False, check_freq=False)
+    assert_matrix_equal(revenue_table, expected_revenue)
+
+
+def test_without_valid_revenue_only_users_are_counted(events):
+    df = events.assign(amount=np.nan)
+    cohort_pivot, _, _, revenue_table, _ = cohort_service._aggregate(
+        df, analysis_frame(df, 'event_time'), 'event_time', 'event_time', 'monthly', 'amount'
+    )
+    users, _, expected_revenue = two_pass(analysis_frame(df, 'event_time'), True, 'monthly', 'amount')
+    assert revenue_table is None and expected_revenue is None
+    assert_matrix_equal(cohort_pivot, users)
+
+
+def test_zero_revenue_cells_stay_zero():
+    df = pd.DataFrame({
+        'uid': [1, 1, 2, 2, 3],
+        'event_time': pd.to_datetime(['2024-01-05', '2024-02-03', '2024-01-09', '2024-01-09', '2024-02-11']),
+        'amount': [0.0, np.nan, 5.0, 7.0, 0.0],
+    })
+    cohort_pivot, _, _, revenue_table, _ = cohort_service._aggregate(
+        df, analysis_frame(df, 'event_time'), 'event_time', 'event_time', 'monthly', 'amount'
+    )
+    assert cohort_pivot.to_numpy().tolist() == [[2, 1], [1, 0]]
+    # User 2's repeated January row is deduplicated before revenue is summed
+    assert revenue_table.to_numpy().tolist() == [[5.0, 0.0], [0.0, 0.0]]
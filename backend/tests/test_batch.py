@@ -0,0 +1,89 @@
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main as main
+
+REVENUE = {"revenue": True}
+# Every dataCleaning variant: none, capping, removal, and both (capping wins)
+CLEANING = [None, {"capping": True, "remove": False}, {"capping": False, "remove": True}, {"capping": True, "remove": True}]
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def revenue_configs(analysis_body):
+    body = dict(analysis_body, analysisMetric="revenue", revenueColumn="revenue", heatmap={"renderer": "png"})
+    body.pop("filename")
+    configs = []
+    for cleaning in CLEANING:
+        preprocessing = {"dataCleaning": cleaning, "typeConversion": False} if cleaning else None
+        configs += [dict(body, cohortInterval=interval, preprocessing=preprocessing) for interval in ("weekly", "monthly")]
+    return configs
+
+
+def analysis_data(response):
+    """The 'data' section of an analysis response, without the job's chart files."""
+    data = dict(response["data"], cohort_analysis=dict(response["data"]["cohort_analysis"]))
+    data["cohort_analysis"].pop("charts", None)
+    return data
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """Upload filenames passed to load_dataframe."""
+    filenames = []
+    load_dataframe = main.load_dataframe
+    monkeypatch.setattr(main, "load_dataframe", lambda payload, *args, **kwargs: (filenames.append(payload.filename), load_dataframe(payload, *args, **kwargs))[1])
+    return filenames
+
+
+@pytest.mark.parametrize("upload", [REVENUE], indirect=True)
+def test_batch_loads_the_dataset_once(client, upload, revenue_configs, loads):
+    response = client.post("/api/analysis/batch", json={"filename": upload, "configs": revenue_configs})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == len(revenue_configs) and all("data" in result for result in results)
+    assert loads == [upload]
+
+
+@pytest.mark.parametrize("upload", [REVENUE], indirect=True)
+def test_cleaning_variants_leave_the_shared_frame_unmodified(client, upload, revenue_configs, monkeypatch):
+    shared = []
+    prepare = main.prepare_batch_frames
+
+    def tracked(configs):
+        frames = prepare(configs)
+        # The first config has no dataCleaning, so its frame is the shared one; the
+        # configs must not write to it while they run
+        shared.append((frames[0], frames[0].copy(deep=True)))
+        return frames
+
+    monkeypatch.setattr(main, "prepare_batch_frames", tracked)
+    response = client.post("/api/analysis/batch", json={"filename": upload, "configs": revenue_configs})
+    assert response.status_code == 200
+    (frame, before), = shared
+    pd.testing.assert_frame_equal(frame, before)
+
+    # Each config gets the result it would get on its own, so no variant saw another's capping or removal
+    for config, result in zip(revenue_configs, response.json()["results"]):
+        alone = client.post("/api/analysis", json=dict(config, filename=upload))
+        assert alone.status_code == 200
+        assert analysis_data(result) == analysis_data(alone.json())
+
+
+def test_failing_config_does_not_fail_the_batch(client, upload, analysis_body):
+    configs = [dict(analysis_body, heatmap={"renderer": "png"}, cohortInterval=interval) for interval in ("weekly", "monthly")]
+    configs.insert(1, dict(configs[0], userId="missing"))
+    response = client.post("/api/analysis/batch", json={"filename": upload, "configs": configs})
+    assert response.status_code == 200
+    ok, failed, also_ok = response.json()["results"]
+
+    assert failed["status_code"] == 400 and "missing" in failed["detail"]
+    assert client.get("/api/analysis-status", params={"job_id": failed["job_id"]}).json()["status"] == "failed"
+    for result, interval in ((ok, "weekly"), (also_ok, "monthly")):
+        assert result["data"]["cohort_interval"] == interval
+        assert client.get("/api/analysis-status", params={"job_id": result["job_id"]}).json()["status"] != "failed"
@@ -0,0 +1,9 @@
+from benchmarks import bench_cohort
+
+
+def test_cohort_benchmark_runs_every_target(tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    assert bench_cohort.main(["--rows", "1k", "--repeat", "1", "--no-memory", "--baseline", str(baseline)]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    for target in bench_cohort.TARGETS:
+        assert any(line.startswith(f"{target}|1k|") for line in lines), target
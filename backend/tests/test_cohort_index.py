@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.analysis import cohort_service
+from app.cohort_index import CohortIndex
+
+INTERVALS = ['daily', 'weekly', 'monthly', 'quarterly']
+WINDOWS = [(None, None), ('2023-03-01', '2023-09-30'), (None, '2023-06-15'), ('2023-02-10', None)]
+COMPARED = ['totalRows', 'cohorts', 'periods', 'row_lengths', 'cohort_sizes', 'tables']
+FAST_HEATMAP = {'renderer': 'png'}
+
+
+@pytest.fixture(scope="module")
+def events():
+    rng = np.random.default_rng(1)
+    n = 6_000
+    users = pd.Series(rng.integers(0, 600, n).astype(str), dtype=object)
+    users[rng.random(n) < 0.02] = None
+    event_time = pd.Series(pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 400 * 86_400, n), unit='s'))
+    # Rows stamped exactly at midnight matter for end dates
+    midnight = rng.random(n) < 0.2
+    event_time[midnight] = event_time[midnight].dt.normalize()
+    event_time[rng.random(n) < 0.01] = pd.NaT
+    signup = pd.Series(pd.Timestamp('2022-12-01') + pd.to_timedelta(rng.integers(0, 300, n), unit='D'))
+    signup[rng.random(n) < 0.02] = pd.NaT
+    df = pd.DataFrame({'uid': users, 'event_time': event_time, 'signup': signup})
+    # A signup cohort whose rows all lack a user: the engine keeps it with 0 users
+    orphans = pd.DataFrame({
+        'uid': [None, None],
+        'event_time': pd.to_datetime(['2023-04-03 10:00', '2023-05-20 00:00']),
+        'signup': pd.to_datetime(['2022-11-15', '2022-11-15'])
+    })
+    return pd.concat([df, orphans], ignore_index=True)
+
+
+def engine(df, cohort_col, interval, start, end):
+    if start is not None:
+        df = df[df['event_time'] >= start]
+    if end is not None:
+        df = df[df['event_time'] <= end]
+    result = cohort_service.perform_cohort_analysis(
+        df.copy(), 'uid', cohort_col, 'event_time', interval, output_format='compact', heatmap_options=FAST_HEATMAP
+    )
+    return {key: result[key] for key in COMPARED}
+
+
+def indexed(index, interval, start, end):
+    result = cohort_service.perform_indexed_analysis(
+        index, interval, start, end, output_format='compact', heatmap_options=FAST_HEATMAP
+    )
+    return {key: result[key] for key in COMPARED}
+
+
+@pytest.mark.parametrize("cohort_col", ['event_time', 'signup'])
+@pytest.mark.parametrize("interval", INTERVALS)
+def test_index_matches_engine(events, cohort_col, interval):
+    index = CohortIndex(events, 'uid', cohort_col, 'event_time')
+    for start, end in WINDOWS:
+        start = pd.Timestamp(start) if start else None
+        end = pd.Timestamp(end) if end else None
+        expected = engine(events, cohort_col, interval, start, end)
+        np.testing.assert_equal(indexed(index, interval, start, end), expected)
+
+
+def test_user_less_cohort_has_empty_row(events):
+    index = CohortIndex(events, 'uid', 'signup', 'event_time')
+    result = indexed(index, 'daily', None, None)
+    position = result['cohorts'].index('2022-11-15')
+    assert result['cohort_sizes'][position] == 0
+
+
+@pytest.mark.parametrize("cohort_col", ['event_time', 'signup'])
+def test_chunked_build_matches_whole_frame(events, cohort_col):
+    whole = CohortIndex(events, 'uid', cohort_col, 'event_time')
+    chunks = [events.iloc[start:start + 1_000] for start in range(0, len(events), 1_000)]
+    chunked = CohortIndex.from_chunks(
+        chunks, 'uid', cohort_col, 'event_time', list(events.columns), set()
+    )
+    for name in CohortIndex.ARRAYS:
+        np.testing.assert_array_equal(getattr(chunked, name), getattr(whole, name), err_msg=name)
+    for interval in INTERVALS:
+        for start, end in WINDOWS:
+            start = pd.Timestamp(start) if start else None
+            end = pd.Timestamp(end) if end else None
+            expected = whole.query(interval, start, end)
+            actual = chunked.query(interval, start, end)
+            pd.testing.assert_frame_equal(actual.pop('cohort_data'), expected.pop('cohort_data'))
+            assert actual == expected
@@ -0,0 +1,100 @@
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.cohort_index import CohortIndex, CohortIndexCache
+
+WORKERS = 2
+
+
+@pytest.fixture(scope="module")
+def events():
+    rng = np.random.default_rng(2)
+    n = 20_000
+    return pd.DataFrame({
+        'uid': rng.integers(0, 2_000, n),
+        'event_time': pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 200 * 86_400, n), unit='s'),
+        'signup': pd.Timestamp('2022-12-01') + pd.to_timedelta(rng.integers(0, 200, n), unit='D'),
+    })
+
+
+def assert_same_answers(actual, expected):
+    for interval in ['daily', 'weekly', 'monthly']:
+        for start, end in [(None, None), (pd.Timestamp('2023-02-01'), pd.Timestamp('2023-05-01'))]:
+            a, e = actual.query(interval, start, end), expected.query(interval, start, end)
+            pd.testing.assert_frame_equal(a.pop('cohort_data'), e.pop('cohort_data'))
+            assert a == e
+
+
+def test_saved_index_reloads_memory_mapped(events, tmp_path):
+    index = CohortIndex(events, 'uid', 'signup', 'event_time')
+    index.save(tmp_path / "index")
+    loaded = CohortIndex.load(tmp_path / "index")
+
+    for name in CohortIndex.ARRAYS:
+        array = getattr(loaded, name)
+        assert isinstance(array, np.memmap), name
+        assert not array.flags.writeable
+        np.testing.assert_array_equal(array, getattr(index, name), err_msg=name)
+    assert loaded.columns == index.columns
+    assert loaded.numeric_columns == index.numeric_columns
+    assert_same_answers(loaded, index)
+
+
+def test_incompatible_index_is_not_opened(events, tmp_path):
+    cache = CohortIndexCache(directory=str(tmp_path))
+    key = ('events.csv', 0, 0, 'uid', 'signup', 'event_time')
+    CohortIndex(events, *key[3:]).save(cache._path(key))
+    meta = cache._path(key) / "meta.json"
+    meta.write_text(meta.read_text().replace('"format": ', '"format": -'))
+    assert cache.get(key) is None
+
+
+def build_in_worker(directory, key, events, barrier, builds, results):
+    init = CohortIndex.__init__
+
+    def counted_init(self, *args):
+        with builds.get_lock():
+            builds.value += 1
+        init(self, *args)
+
+    # Forked worker: the patch stays in this process
+    CohortIndex.__init__ = counted_init
+    cache = CohortIndexCache(directory=directory)
+    barrier.wait()
+    cache.build(key, events)
+    index = cache.get(key)
+    results.put((isinstance(index.user, np.memmap), index.query('weekly')['cohort_data'].to_dict('list')))
+
+
+def test_concurrent_workers_share_one_index(events, tmp_path):
+    source = tmp_path / "events.csv"
+    source.write_text("placeholder")
+    key = CohortIndexCache.key(str(source), 'uid', 'signup', 'event_time')
+    directory = tmp_path / "shared"
+
+    context = multiprocessing.get_context("fork")
+    barrier, builds, results = context.Barrier(WORKERS), context.Value('i', 0), context.Queue()
+    workers = [
+        context.Process(target=build_in_worker, args=(str(directory), key, events, barrier, builds, results))
+        for _ in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    answers = [results.get(timeout=120) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=30)
+        assert worker.exitcode == 0
+
+    assert builds.value == 1
+    expected = CohortIndex(events, *key[3:])
+    for memory_mapped, cohort_data in answers:
+        assert memory_mapped
+        assert cohort_data == expected.query('weekly')['cohort_data'].to_dict('list')
+    # One complete index and its lock are left; no half-written copies
+    index_dirs = [path for path in directory.iterdir() if path.is_dir()]
+    assert len(index_dirs) == 1
+    assert not any(path.name.endswith(".tmp") for path in directory.iterdir())
+    assert_same_answers(CohortIndex.load(index_dirs[0]), expected)
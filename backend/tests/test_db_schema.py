@@ -0,0 +1,65 @@
+import sqlite3
+
+import pytest
+import sqlalchemy
+
+from app.db_schema import DBSchemaCache
+
+
+@pytest.fixture
+def databases(tmp_path):
+    urls = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}.db"
+        with sqlite3.connect(path) as conn:
+            conn.execute(f"CREATE TABLE events_{name} (user_id INTEGER, event_date TEXT)")
+        urls.append(f"sqlite:///{path}")
+    return urls
+
+
+@pytest.fixture
+def disposed(monkeypatch):
+    urls = []
+    create_engine = sqlalchemy.create_engine
+
+    def tracked(url, *args, **kwargs):
+        engine = create_engine(url, *args, **kwargs)
+        dispose = engine.dispose
+        engine.dispose = lambda *a, **k: (urls.append(url), dispose(*a, **k))
+        return engine
+
+    monkeypatch.setattr(sqlalchemy, "create_engine", tracked)
+    return urls
+
+
+def test_schema_is_reflected_once_per_ttl(databases, monkeypatch):
+    cache = DBSchemaCache(ttl_seconds=60)
+    reflections = []
+    reflect = cache._reflect
+    monkeypatch.setattr(cache, "_reflect", lambda url: (reflections.append(url), reflect(url))[1])
+    assert cache.get(databases[0]) == {"events_a": [{"name": "user_id", "type": "INTEGER"}, {"name": "event_date", "type": "TEXT"}]}
+    cache.get(databases[0])
+    assert reflections == [databases[0]]
+
+
+def test_least_recently_used_urls_are_evicted_and_disposed(databases, disposed):
+    a, b, c = databases
+    cache = DBSchemaCache(ttl_seconds=60, max_urls=2)
+    cache.get(a)
+    cache.get(b)
+    # Reading a makes b the least recently used
+    cache.get(a)
+    cache.get(c)
+    assert disposed == [b]
+    assert set(cache._engines) == set(cache._entries) == {a, c}
+
+
+def test_invalidate_disposes_engines(databases, disposed):
+    cache = DBSchemaCache(ttl_seconds=60)
+    for url in databases:
+        cache.get(url)
+    assert cache.invalidate(databases[0]) == 1
+    assert disposed == [databases[0]]
+    assert cache.invalidate() == 2
+    assert sorted(disposed) == sorted(databases)
+    assert not cache._engines and not cache._entries
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.analysis import cohort_service
+from app.main import EXPORT_TABLES, export_tables
+
+
+def revenue_events(seed=0, rows=5_000):
+    rng = np.random.default_rng(seed)
+    users = rng.integers(0, 800, rows).astype(float)
+    users[rng.random(rows) < 0.02] = np.nan
+    days = np.minimum(rng.exponential(40, rows), 180).astype(int)
+    revenue = np.round(rng.gamma(2, 10, rows), 2)
+    revenue[rng.random(rows) < 0.3] = 0
+    revenue[rng.random(rows) < 0.02] = np.nan
+    return pd.DataFrame({
+        'user_id': users,
+        'event_date': pd.Timestamp('2024-01-01') + pd.to_timedelta(days, unit='D'),
+        'revenue': revenue,
+    })
+
+
+def run(df, interval, output_format):
+    return cohort_service.perform_cohort_analysis(
+        df.copy(), 'user_id', 'event_date', 'event_date', interval, revenue_col='revenue',
+        output_format=output_format, heatmap_options={'renderer': 'png'}
+    )
+
+
+def csv_text(frame):
+    return frame.to_csv(index=False)
+
+
+# Weekly is left out: nested revenue tables label weekly cohorts as %Y-W%U, retention as the week's start
+@pytest.mark.parametrize("interval", ["daily", "monthly", "quarterly"])
+def test_nested_and_compact_exports_agree(interval):
+    df = revenue_events()
+    nested = export_tables(run(df, interval, 'nested'))
+    compact = export_tables(run(df, interval, 'compact'))
+
+    assert list(nested) == list(compact) == EXPORT_TABLES
+    for name in EXPORT_TABLES:
+        assert csv_text(compact[name]) == csv_text(nested[name]), name
+
+
+def test_ltv_is_carried_past_the_last_active_period():
+    df = revenue_events()
+    results = run(df, 'daily', 'compact')
+    lengths = np.asarray(results['row_lengths'])
+    assert (lengths < len(results['periods'])).any()
+    ltv = export_tables(results)['ltv_table']
+    assert not ltv.isna().to_numpy().any()
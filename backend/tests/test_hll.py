@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.analysis import cohort_service
+from app.utils.hll import HLLSketchMatrix, hash_users, relative_standard_error
+
+PRECISIONS = [4, 8, 12, 14]
+CELL_SIZES = [0, 1, 3, 40, 300, 2_000, 20_000, 60_000]
+
+
+def cell_events(rng, sizes):
+    """Events of one cohort with a cell per size; every user appears twice, size-0 cells only have null users."""
+    periods, users = [], []
+    for period, size in enumerate(sizes):
+        ids = rng.choice(1_000_000, size, replace=False).astype(float) if size else np.array([np.nan])
+        periods.append(np.full(2 * len(ids), period))
+        users.append(np.concatenate([ids, ids]))
+    periods, users = np.concatenate(periods), pd.Series(np.concatenate(users))
+    return pd.Series(np.full(len(users), '2024-01')), pd.Series(periods), users
+
+
+def add_users(sketch, cohorts, periods, users):
+    sketch.add(cohorts, periods, hash_users(users), users.notna().to_numpy())
+
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+def test_estimates_within_standard_error(precision):
+    rng = np.random.default_rng(precision)
+    cohorts, periods, users = cell_events(rng, CELL_SIZES)
+    sketch = HLLSketchMatrix(precision)
+    add_users(sketch, cohorts, periods, users)
+
+    estimates = sketch.cohort_data().set_index('PeriodIndex')['CustomerID']
+    exact = pd.Series(users.to_numpy()).groupby(periods.to_numpy()).nunique()
+    bound = 4 * relative_standard_error(precision)
+    for period, size in enumerate(CELL_SIZES):
+        assert exact[period] == size
+        if size <= sketch.sparse_limit:
+            assert estimates[period] == size
+        else:
+            assert abs(estimates[period] - size) <= bound * size + 1, (period, estimates[period], size)
+
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+def test_chunks_match_single_pass(precision):
+    rng = np.random.default_rng(0)
+    cohorts, periods, users = cell_events(rng, CELL_SIZES)
+    whole = HLLSketchMatrix(precision)
+    add_users(whole, cohorts, periods, users)
+
+    chunked = HLLSketchMatrix(precision)
+    order = rng.permutation(len(users))
+    for part in np.array_split(order, 7):
+        add_users(chunked, cohorts.iloc[part], periods.iloc[part], users.iloc[part])
+
+    pd.testing.assert_frame_equal(
+        whole.cohort_data().sort_values('PeriodIndex', ignore_index=True),
+        chunked.cohort_data().sort_values('PeriodIndex', ignore_index=True)
+    )
+
+
+def sorted_cells(sketch):
+    return sketch.cohort_data().sort_values(['CohortPeriod', 'PeriodIndex'], ignore_index=True)
+
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+def test_merged_partitions_match_single_pass(precision):
+    rng = np.random.default_rng(2)
+    cohorts, periods, users = cell_events(rng, CELL_SIZES)
+    whole = HLLSketchMatrix(precision)
+    add_users(whole, cohorts, periods, users)
+
+    # Partitions overlap in users and cells; a cell can be dense in one and sparse in another
+    partitions = np.array_split(rng.permutation(len(users)), 3)
+    sketches = []
+    for part in partitions:
+        sketches.append(HLLSketchMatrix(precision))
+        add_users(sketches[-1], cohorts.iloc[part], periods.iloc[part], users.iloc[part])
+    merged = sketches[0].merge(sketches[1]).merge(sketches[2])
+
+    pd.testing.assert_frame_equal(sorted_cells(whole), sorted_cells(merged))
+    assert merged.describe()['exact_cells'] == whole.describe()['exact_cells']
+
+
+def test_merge_into_empty_sketch_and_with_itself():
+    rng = np.random.default_rng(3)
+    cohorts, periods, users = cell_events(rng, CELL_SIZES)
+    sketch = HLLSketchMatrix(8)
+    add_users(sketch, cohorts, periods, users)
+    expected = sorted_cells(sketch)
+    pd.testing.assert_frame_equal(sorted_cells(HLLSketchMatrix(8).merge(sketch)), expected)
+    pd.testing.assert_frame_equal(sorted_cells(sketch.merge(sketch)), expected)
+
+
+def test_merge_requires_the_same_precision():
+    with pytest.raises(ValueError):
+        HLLSketchMatrix(8).merge(HLLSketchMatrix(12))
+
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+def test_regroup_matches_single_pass_at_coarser_interval(precision):
+    # Daily cohorts and periods rolled up to weeks
+    rng = np.random.default_rng(4)
+    n = 50_000
+    days = pd.Series(rng.integers(0, 56, n))
+    offsets = pd.Series(rng.integers(0, 28, n))
+    users = pd.Series(np.minimum(rng.zipf(1.3, n), 10_000).astype(float))
+    daily = HLLSketchMatrix(precision)
+    add_users(daily, days, offsets, users)
+
+    weekly = HLLSketchMatrix(precision)
+    add_users(weekly, days // 7, offsets // 7, users)
+    regrouped = daily.regroup(lambda cohort, period: (cohort // 7, period // 7))
+
+    pd.testing.assert_frame_equal(sorted_cells(weekly), sorted_cells(regrouped))
+    assert len(daily) == 56 * 28
+
+
+def test_empty_cells_count_zero():
+    sketch = HLLSketchMatrix(8)
+    users = pd.Series([np.nan, np.nan, 7.0])
+    add_users(sketch, pd.Series(['a', 'b', 'b']), pd.Series([0, 0, 1]), users)
+    data = sketch.cohort_data().set_index(['CohortPeriod', 'PeriodIndex'])['CustomerID']
+    assert data.to_dict() == {('a', 0): 0, ('b', 0): 0, ('b', 1): 1}
+    assert sketch.describe()['exact_cells'] == 3
+
+
+def test_memory_bounded_by_sparse_cells():
+    # Many small daily cells stay exact and never allocate registers
+    rng = np.random.default_rng(1)
+    n = 200_000
+    sketch = HLLSketchMatrix(16)
+    add_users(
+        sketch,
+        pd.Series(rng.integers(0, 365, n)),
+        pd.Series(rng.integers(0, 365, n)),
+        pd.Series(rng.integers(0, 50_000, n))
+    )
+    description = sketch.describe()
+    assert description['exact_cells'] == description['cells']
+    assert description['sketch_bytes'] <= 16 * n
+
+
+def test_precision_bounds():
+    with pytest.raises(ValueError):
+        HLLSketchMatrix(3)
+    with pytest.raises(ValueError):
+        HLLSketchMatrix(17)
+
+
+def daily_events(seed=0, rows=60_000, users=20_000):
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(0, users, rows).astype(float)
+    user_ids[rng.random(rows) < 0.01] = np.nan
+    # Most users start in the first days so the early cohorts outgrow the sparse limit
+    days = np.minimum(rng.exponential(4, rows), 59).astype(int)
+    dates = pd.Timestamp('2024-01-01') + pd.to_timedelta(days, unit='D')
+    dates = pd.Series(dates).mask(rng.random(rows) < 0.01)
+    return pd.DataFrame({'user_id': user_ids, 'event_date': dates})
+
+
+def run_daily(df, **options):
+    return cohort_service.perform_cohort_analysis(
+        df.copy(), 'user_id', 'event_date', 'event_date', 'daily', output_format='compact',
+        heatmap_options={'renderer': 'png'}, **options
+    )
+
+
+@pytest.mark.parametrize("precision", [8, 12])
+def test_daily_approximate_matches_exact(precision):
+    df = daily_events()
+    exact = run_daily(df)
+    approximate = run_daily(df, approximate=True, hll_precision=precision)
+
+    assert approximate['cohorts'] == exact['cohorts']
+    assert approximate['periods'] == exact['periods']
+    assert approximate['approximation']['precision'] == precision
+    assert approximate['approximation']['cells'] > approximate['approximation']['exact_cells'] > 0
+    sparse_limit = (1 << precision) // 16
+    bound = 4 * relative_standard_error(precision)
+    for estimate, size in zip(approximate['cohort_sizes'], exact['cohort_sizes']):
+        if size <= sparse_limit:
+            assert estimate == size
+        else:
+            assert abs(estimate - size) <= bound * size + 1
@@ -0,0 +1,163 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main as main
+from app.admission import AdmissionController, MB
+from app.analysis import cohort_service
+
+SAMPLED = {"rows": 20_000, "users": 2_000, "days": 180}
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def preview_body(analysis_body):
+    return dict(analysis_body, preview=True, previewSampleRate=0.5, heatmap={'renderer': 'png'})
+
+
+def wait_until_ready(client, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        status = client.get("/api/analysis-status", params={"job_id": job_id}).json()["status"]
+        if status != "processing":
+            return status
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def normalized(response):
+    """Response without the parts that differ between jobs (ids, timings, chart and result URLs)."""
+    response = {k: v for k, v in response.items() if k not in ("job_id", "timings", "chart_data", "results", "coalesced")}
+    response["data"] = dict(response["data"], cohort_analysis=dict(response["data"]["cohort_analysis"]))
+    response["data"]["cohort_analysis"].pop("charts", None)
+    return response
+
+
+def exact_response(client, preview_body):
+    body = {k: v for k, v in preview_body.items() if k not in ("preview", "previewSampleRate")}
+    response = client.post("/api/analysis", json=body)
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.fixture
+def blocked_export(monkeypatch):
+    """Holds every export until the returned event is set."""
+    release = threading.Event()
+    export = main.zip_and_upload_task
+
+    def held(*args, **kwargs):
+        assert release.wait(30)
+        return export(*args, **kwargs)
+
+    monkeypatch.setattr(main, "zip_and_upload_task", held)
+    yield release
+    release.set()
+
+
+@pytest.mark.parametrize("upload", [SAMPLED], indirect=True)
+def test_preview_within_budget_then_exact_result(client, preview_body, blocked_export):
+    response = client.post("/api/analysis", json=preview_body)
+    assert response.status_code == 200
+    preview = response.json()
+    job_id = preview["job_id"]
+    assert preview["result"] == f"/api/analysis-result?job_id={job_id}"
+    sample = preview["preview"]
+    assert sample["sample_rate"] == 0.5 and sample["confidence_level"] == 0.95
+    assert 0 < sample["sampled_users"] < SAMPLED["users"]
+    retention = preview["data"]["cohort_analysis"]["retention_table"]
+    assert retention.keys() == sample["retention_intervals"].keys()
+
+    # The exact result is stored before the export, but the job turns ready only after it
+    deadline = time.monotonic() + 30
+    while client.get("/api/analysis-result", params={"job_id": job_id}).status_code == 404:
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+    assert client.get("/api/analysis-status", params={"job_id": job_id}).json()["status"] == "processing"
+    blocked_export.set()
+    assert wait_until_ready(client, job_id) == "ready"
+
+    result = client.get("/api/analysis-result", params={"job_id": job_id}).json()
+    assert result["job_id"] == job_id
+    exact = exact_response(client, preview_body)
+    assert normalized(result) == normalized(exact)
+
+    # Nearly all exact rates fall within the sampled 95% intervals
+    cells = [
+        low <= exact["data"]["cohort_analysis"]["retention_table"][cohort].get(period, 0.0) <= high
+        for cohort, row in sample["retention_intervals"].items()
+        for period, (low, high) in row.items()
+    ]
+    assert len(cells) > 10 and sum(cells) >= 0.9 * len(cells)
+
+
+@pytest.mark.parametrize("upload", [SAMPLED], indirect=True)
+def test_missed_budget_returns_no_preview(client, preview_body, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    prepare = main.prepare_dataframe
+
+    def slow_prepare(*args, **kwargs):
+        started.set()
+        assert release.wait(30)
+        return prepare(*args, **kwargs)
+
+    monkeypatch.setattr(main, "prepare_dataframe", slow_prepare)
+    monkeypatch.setattr(main, "PREVIEW_BUDGET_SECONDS", 0.1)
+    response = client.post("/api/analysis", json=preview_body)
+    assert response.status_code == 200
+    missed = response.json()
+    assert started.is_set()
+    assert missed["preview"] is None and missed["data"] is None
+    job_id = missed["job_id"]
+    assert missed["result"] == f"/api/analysis-result?job_id={job_id}"
+    assert client.get("/api/analysis-result", params={"job_id": job_id}).status_code == 404
+
+    # The job carries on to the exact result
+    release.set()
+    assert wait_until_ready(client, job_id) == "ready"
+    result = client.get("/api/analysis-result", params={"job_id": job_id}).json()
+    assert normalized(result) == normalized(exact_response(client, preview_body))
+
+
+def test_rejected_preview_gets_503(client, preview_body, monkeypatch):
+    monkeypatch.setattr(main, "admission_controller", AdmissionController(memory_budget=100 * MB, cpu_slots=1, max_queued=0))
+    response = client.post("/api/analysis", json=preview_body)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
+
+
+def test_failed_preview_gets_400_and_fails_the_job(client, preview_body, monkeypatch):
+    job_ids = []
+    save_job = main.save_job
+    monkeypatch.setattr(main, "save_job", lambda job_id, *args, **kwargs: (job_ids.append(job_id), save_job(job_id, *args, **kwargs)))
+    response = client.post("/api/analysis", json=dict(preview_body, userId="missing"))
+    assert response.status_code == 400
+    assert "missing" in response.json()["detail"]
+    job_id, = job_ids
+    assert client.get("/api/analysis-status", params={"job_id": job_id}).json()["status"] == "failed"
+
+
+@pytest.mark.parametrize("output_format", ["nested", "compact"])
+def test_wilson_intervals(output_format):
+    # One cohort of 100 users: all of them at period 0, half at period 1, none at period 2, ten at period 3
+    periods = pd.Index([0, 1, 2, 3], name='PeriodIndex')
+    cohort_pivot = pd.DataFrame([[100, 50, 0, 10]], index=pd.Index([pd.Period('2024-01', 'M')]), columns=periods)
+    retention = cohort_pivot.divide(cohort_pivot[0], axis=0)
+    intervals = cohort_service._preview_intervals(retention, cohort_pivot, 'monthly', output_format)
+    assert intervals['sampled_users'] == 100
+
+    # Published 95% Wilson score intervals for n = 100
+    expected = [[0.9630, 1.0], [0.4038, 0.5962], [0.0, 0.0370], [0.0552, 0.1744]]
+    if output_format == 'compact':
+        assert intervals['retention_lower'] == [low for low, _ in expected]
+        assert intervals['retention_upper'] == [high for _, high in expected]
+    else:
+        # Only periods with retained users, like retention_table
+        assert intervals['retention_intervals'] == {'2024-01': {'0': expected[0], '1': expected[1], '3': expected[3]}}
@@ -0,0 +1,80 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main as main
+from app.utils import profiling
+from app.utils.profiling import has_profile_token, profiling_slot, should_profile
+
+TOKEN = "s3cret-profile-token"
+
+
+@pytest.fixture
+def token(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_TOKEN", TOKEN)
+    return TOKEN
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+def analyze(client, body, header=None):
+    body = dict(body, heatmap={'renderer': 'png'})
+    return client.post("/api/analysis", json=body, headers={"X-Profile": header} if header else {})
+
+
+def test_profiling_is_off_without_a_token():
+    assert profiling.PROFILE_TOKEN is None
+    for header in (None, "", "1", "true", "yes"):
+        assert not should_profile(header)
+        assert not has_profile_token(header)
+
+
+def test_only_the_configured_token_enables_profiling(token):
+    assert should_profile(token)
+    for header in (None, "1", "true", token + "x", token[:-1]):
+        assert not should_profile(header)
+
+
+def test_one_request_is_profiled_at_a_time():
+    with profiling_slot() as first:
+        with profiling_slot() as second:
+            assert first and not second
+    with profiling_slot() as again:
+        assert again
+
+
+def test_profile_download_needs_the_token(client, token):
+    assert client.get("/api/analysis-profile", params={"job_id": "missing"}).status_code == 403
+    assert client.get("/api/analysis-profile", params={"job_id": "missing"}, headers={"X-Profile": "1"}).status_code == 403
+    response = client.get("/api/analysis-profile", params={"job_id": "missing"}, headers={"X-Profile": token})
+    assert response.status_code == 404
+
+
+def test_profile_download_is_disabled_without_a_configured_token(client):
+    response = client.get("/api/analysis-profile", params={"job_id": "missing"}, headers={"X-Profile": "1"})
+    assert response.status_code == 403
+
+
+def test_header_without_token_runs_unprofiled(client, analysis_body):
+    response = analyze(client, analysis_body, "1")
+    assert response.status_code == 200
+    assert "profile" not in response.json()
+
+
+def test_profiled_request_and_download(client, analysis_body, token):
+    response = analyze(client, analysis_body, token)
+    assert response.status_code == 200
+    links = response.json()["profile"]
+    collapsed = client.get(links["collapsed"], headers={"X-Profile": token})
+    assert collapsed.status_code == 200 and collapsed.text
+    assert client.get(links["collapsed"]).status_code == 403
+
+
+def test_request_runs_unprofiled_while_another_is_profiled(client, analysis_body, token):
+    with profiling_slot() as held:
+        assert held
+        response = analyze(client, analysis_body, token)
+    assert response.status_code == 200
+    assert "profile" not in response.json()
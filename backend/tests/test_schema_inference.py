@@ -0,0 +1,64 @@
+import gzip
+import io
+
+import pandas as pd
+import pytest
+import zstandard
+
+from app.utils import schema_inference
+from app.utils.schema_inference import read_csv_sample
+
+ROWS = 200_000
+SAMPLE_ROWS = 100
+
+
+class CountingStream(io.RawIOBase):
+    """Binary stream over another one that counts the bytes read from it."""
+
+    def __init__(self, stream, counter):
+        self.stream, self.counter = stream, counter
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self.counter.append(len(data))
+        return len(data)
+
+    def close(self):
+        self.stream.close()
+        super().close()
+
+
+def write_events(path, ext):
+    # A quoted note spanning lines around the sample cut makes the cut sample unparseable
+    lines = ["user_id,event_date,note\n"]
+    for i in range(ROWS):
+        note = '"first line\nsecond line"' if i == SAMPLE_ROWS - 1 else "plain"
+        lines.append(f"{i},2024-01-{i % 28 + 1:02d},{note}\n")
+    data = "".join(lines).encode()
+    if ext == ".csv.gz":
+        data = gzip.compress(data)
+    elif ext == ".csv.zst":
+        data = zstandard.ZstdCompressor().compress(data)
+    path.write_bytes(data)
+    return len("".join(lines))
+
+
+@pytest.mark.parametrize("ext", [".csv", ".csv.gz", ".csv.zst"])
+def test_multi_line_field_at_the_cut_streams_a_bounded_prefix(tmp_path, monkeypatch, ext):
+    path = tmp_path / f"events{ext}"
+    uncompressed = write_events(path, ext)
+    reads = []
+    open_csv = schema_inference._open_csv
+    monkeypatch.setattr(schema_inference, "_open_csv", lambda *args: io.BufferedReader(CountingStream(open_csv(*args), reads)))
+
+    sample, encoding, _, whole_file = read_csv_sample(str(path), SAMPLE_ROWS, ext)
+    assert len(sample) == SAMPLE_ROWS and not whole_file
+    assert encoding == "utf-8"
+    assert sample["note"].iloc[SAMPLE_ROWS - 1] == "first line\nsecond line"
+    pd.testing.assert_series_equal(sample["user_id"], pd.Series(range(SAMPLE_ROWS), name="user_id"))
+    # Both passes stop near the sample instead of decompressing the whole upload
+    assert sum(reads) < uncompressed / 4
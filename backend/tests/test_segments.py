@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.analysis import MISSING_SEGMENT, OTHER_SEGMENT, cohort_service
+
+HEATMAP = {'renderer': 'png'}
+# Segments a-c hold clearly more users than d-f, so top_k=3 keeps exactly a, b and c
+SEGMENTS = ['a', 'b', 'c', 'd', 'e', 'f']
+WEIGHTS = [0.35, 0.25, 0.15, 0.1, 0.1, 0.05]
+
+
+@pytest.fixture(scope="module")
+def events():
+    rng = np.random.default_rng(7)
+    n = 3_000
+    segment = pd.Series(rng.choice(SEGMENTS, n, p=WEIGHTS), dtype=object)
+    segment[rng.random(n) < 0.05] = None
+    return pd.DataFrame({
+        'user_id': rng.integers(0, 1_000, n),
+        'event_date': (pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 150, n), unit='D')).strftime('%Y-%m-%d'),
+        'signup': (pd.Timestamp('2023-12-01') + pd.to_timedelta(rng.integers(0, 120, n), unit='D')).strftime('%Y-%m-%d'),
+        'plan': segment,
+    })
+
+
+def analyze(df, cohort_col, interval, output_format, **kwargs):
+    return cohort_service.perform_cohort_analysis(
+        df, 'user_id', cohort_col, 'event_date', interval=interval, output_format=output_format,
+        heatmap_options=HEATMAP, **kwargs
+    )
+
+
+@pytest.mark.parametrize("output_format", ['nested', 'compact'])
+@pytest.mark.parametrize("interval", ['weekly', 'monthly'])
+@pytest.mark.parametrize("cohort_col", ['event_date', 'signup'])
+def test_segment_tables_equal_per_segment_runs(events, cohort_col, interval, output_format):
+    segments = analyze(events, cohort_col, interval, output_format, segment_col='plan', segment_top_k=3)['segments']
+    assert segments['segment_count'] == len(SEGMENTS) and segments['truncated']
+
+    plan = events['plan']
+    buckets = {
+        'a': plan == 'a',
+        'b': plan == 'b',
+        'c': plan == 'c',
+        OTHER_SEGMENT: plan.isin(['d', 'e', 'f']),
+        MISSING_SEGMENT: plan.isna(),
+    }
+    tables = {table['segment']: table for table in segments['values']}
+    assert list(tables) == ['a', 'b', 'c', OTHER_SEGMENT, MISSING_SEGMENT]
+    for label, rows in buckets.items():
+        table = dict(tables[label])
+        assert table.pop('segment') == label
+        assert table.pop('users') == events.loc[rows, 'user_id'].nunique()
+        expected = analyze(events[rows], cohort_col, interval, output_format)
+        assert table == {key: expected[key] for key in table}
+
+
+def test_no_other_bucket_when_every_segment_fits(events):
+    segments = analyze(events, 'event_date', 'monthly', 'nested', segment_col='plan')['segments']
+    assert not segments['truncated']
+    labels = [table['segment'] for table in segments['values']]
+    assert labels[-1] == MISSING_SEGMENT and sorted(labels[:-1]) == SEGMENTS
+
+
+def test_segments_without_missing_values_have_no_missing_bucket(events):
+    segments = analyze(events.dropna(subset=['plan']), 'event_date', 'monthly', 'nested', segment_col='plan', segment_top_k=3)['segments']
+    assert [table['segment'] for table in segments['values']] == ['a', 'b', 'c', OTHER_SEGMENT]
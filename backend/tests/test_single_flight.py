@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+from app.main import analysis_flight_key
+from app.models.analyze import AnalysisRequest
+from app.utils.single_flight import SingleFlight
+
+FOLLOWERS = 4
+
+
+def run_concurrently(flight, key, fn):
+    """Run flight.do(key, fn) on a leader and FOLLOWERS threads that all join while the leader is running."""
+    started, release = threading.Event(), threading.Event()
+    outcomes = []
+
+    def leader_fn():
+        started.set()
+        release.wait(10)
+        return fn()
+
+    def call(target):
+        try:
+            outcomes.append(('ok', flight.do(key, target)))
+        except Exception as e:
+            outcomes.append(('error', e))
+
+    threads = [threading.Thread(target=call, args=(leader_fn,))]
+    threads[0].start()
+    assert started.wait(10)
+    for _ in range(FOLLOWERS):
+        threads.append(threading.Thread(target=call, args=(lambda: pytest.fail("follower ran its own computation"),)))
+        threads[-1].start()
+    # Followers block on the leader's result; give them time to get there
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+    return outcomes
+
+
+def test_concurrent_calls_share_one_result():
+    flight, runs = SingleFlight(), []
+
+    def compute():
+        runs.append(1)
+        return {'rows': 42}
+
+    outcomes = run_concurrently(flight, 'key', compute)
+    assert len(runs) == 1
+    assert [status for status, _ in outcomes] == ['ok'] * (FOLLOWERS + 1)
+    results = [result for _, (result, _) in outcomes]
+    assert all(result is results[0] for result in results)
+    assert sorted(shared for _, (_, shared) in outcomes) == [False] + [True] * FOLLOWERS
+    assert flight.in_flight() == 0
+
+
+def test_exception_reaches_every_waiter_and_clears_key():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("bad input")
+
+    outcomes = run_concurrently(flight, 'key', fail)
+    assert len(outcomes) == FOLLOWERS + 1
+    assert all(status == 'error' and isinstance(e, ValueError) and str(e) == "bad input" for status, e in outcomes)
+    assert flight.in_flight() == 0
+    # The failure is not cached: the next caller runs again
+    assert flight.do('key', lambda: 'fresh') == ('fresh', False)
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight()
+    assert flight.do('a', lambda: 1) == (1, False)
+    assert flight.do('b', lambda: 2) == (2, False)
+
+
+def request(**overrides):
+    fields = dict(
+        filename='events.csv', userId='user_id', cohortGrouping='event_date', eventColumn='event_date',
+        analysisMetric='retention', cohortInterval='monthly', columns=[]
+    )
+    fields.update(overrides)
+    return AnalysisRequest(**fields)
+
+
+def test_identical_requests_share_a_flight_key():
+    assert analysis_flight_key(request()) == analysis_flight_key(request())
+
+
+@pytest.mark.parametrize("overrides", [
+    {'responseFormat': 'compact'},
+    {'heatmap': {'renderer': 'png'}},
+    {'heatmap': {'dpi': 100}},
+    {'preview': True},
+    {'preview': True, 'previewSampleRate': 0.1},
+    {'inlineTables': False},
+    {'approximate': True},
+    {'hllPrecision': 14},
+    {'filename': 'other.csv'},
+])
+def test_requests_with_different_responses_get_different_keys(overrides):
+    assert analysis_flight_key(request(**overrides)) != analysis_flight_key(request())
+
+
+def test_preview_sample_rate_separates_previews():
+    assert analysis_flight_key(request(preview=True, previewSampleRate=0.1)) != \
+        analysis_flight_key(request(preview=True, previewSampleRate=0.2))
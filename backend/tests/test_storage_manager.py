@@ -0,0 +1,138 @@
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main as main
+from app.utils.storage_manager import StorageManager, storage_manager
+
+QUOTA = 250
+
+
+@pytest.fixture
+def areas(tmp_path):
+    return {
+        "uploads": (str(tmp_path / "uploads"), QUOTA, ()),
+        "results": (str(tmp_path / "results"), 0, ("jobs",)),
+    }
+
+
+def write(directory, name, size=100, age=0.0):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    if age:
+        then = time.time() - age
+        os.utime(path, (then, then))
+    return path
+
+
+def remaining(directory):
+    return sorted(os.listdir(directory))
+
+
+def test_sweep_evicts_least_recently_used_until_within_quota(areas):
+    manager = StorageManager(areas, ttl_seconds=0, sweep_seconds=0)
+    uploads = areas["uploads"][0]
+    for name in ("a.csv", "b.csv", "c.csv", "d.csv"):
+        manager.register(write(uploads, name))
+        time.sleep(0.01)
+    # Reading a.csv makes b.csv and c.csv the least recently used
+    manager.touch(os.path.join(uploads, "a.csv"))
+
+    evicted = manager.sweep()
+    assert evicted["uploads"] == {"artifacts": 2, "bytes": 200}
+    assert remaining(uploads) == ["a.csv", "d.csv"]
+    assert manager.usage()["uploads"]["bytes"] <= QUOTA
+
+
+def test_untracked_files_are_ordered_by_mtime(areas):
+    manager = StorageManager(areas, ttl_seconds=0, sweep_seconds=0)
+    uploads = areas["uploads"][0]
+    write(uploads, "new.csv", age=10)
+    write(uploads, "old.csv", age=1000)
+    write(uploads, "mid.csv", age=100)
+    manager.sweep()
+    assert remaining(uploads) == ["mid.csv", "new.csv"]
+
+
+def test_companion_files_go_with_their_artifact(areas):
+    manager = StorageManager(areas, ttl_seconds=0, sweep_seconds=0)
+    uploads = areas["uploads"][0]
+    write(uploads, "old.csv", age=1000)
+    write(uploads, "old.csv.schema.json", size=10, age=1000)
+    write(uploads, "new.csv", size=200)
+    manager.sweep()
+    assert remaining(uploads) == ["new.csv"]
+
+
+def test_pinned_and_owned_artifacts_survive_a_sweep(areas):
+    manager = StorageManager(areas, ttl_seconds=0, sweep_seconds=0)
+    uploads, results = areas["uploads"][0], areas["results"][0]
+    old = write(uploads, "input.csv", size=300, age=1000)
+    write(uploads, "other.csv", size=100, age=500)
+    manager.register(write(results, "export.zip"), job_id="job-1")
+    manager.pin("job-1", old)
+
+    manager.sweep()
+    # Over quota, but the job reads input.csv; the unpinned upload goes instead
+    assert remaining(uploads) == ["input.csv"]
+    assert manager.usage()["uploads"]["pinned"] == 1
+
+    manager.release("job-1")
+    manager.sweep()
+    assert remaining(uploads) == []
+
+
+def test_job_directories_belong_to_their_job(areas):
+    manager = StorageManager(areas, ttl_seconds=60, sweep_seconds=0)
+    jobs = os.path.join(areas["results"][0], "jobs")
+    for job_id in ("running", "finished"):
+        directory = os.path.join(jobs, job_id)
+        write(directory, "matrix.npy", age=3600)
+        os.utime(directory, (time.time() - 3600,) * 2)
+    manager.pin("running")
+
+    manager.sweep()
+    assert remaining(jobs) == ["running"]
+
+
+def test_expired_artifacts_are_evicted_under_quota(areas):
+    manager = StorageManager(areas, ttl_seconds=60, sweep_seconds=0)
+    uploads = areas["uploads"][0]
+    write(uploads, "stale.csv", size=10, age=120)
+    manager.register(write(uploads, "fresh.csv", size=10))
+    evicted = manager.sweep()
+    assert evicted["uploads"]["artifacts"] == 1
+    assert remaining(uploads) == ["fresh.csv"]
+
+
+def test_leaked_pins_expire(areas):
+    manager = StorageManager(areas, ttl_seconds=60, sweep_seconds=0, pin_max_seconds=0.05)
+    uploads = areas["uploads"][0]
+    stale = write(uploads, "stale.csv", size=10, age=120)
+    manager.pin("crashed", stale)
+    manager.sweep()
+    assert remaining(uploads) == ["stale.csv"]
+    time.sleep(0.1)
+    manager.sweep()
+    assert remaining(uploads) == []
+
+
+def test_temporary_files_are_not_artifacts(areas):
+    manager = StorageManager(areas, ttl_seconds=60, sweep_seconds=0)
+    uploads = areas["uploads"][0]
+    write(uploads, "upload.csv.tmp", size=1000, age=120)
+    manager.sweep()
+    assert remaining(uploads) == ["upload.csv.tmp"]
+    assert manager.usage()["uploads"]["artifacts"] == 0
+
+
+def test_sweeper_runs_with_the_app(monkeypatch):
+    monkeypatch.setattr(storage_manager, "sweep_seconds", 3600)
+    assert storage_manager._sweeper is None
+    with TestClient(main.app):
+        assert storage_manager._sweeper is not None and storage_manager._sweeper.is_alive()
+    assert storage_manager._sweeper is None
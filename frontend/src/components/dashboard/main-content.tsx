@@ -18,7 +18,11 @@ export function MainContent() {
 
   // Poll for job status and download URL
   // console.log("jobId:", jobId);
-  const { status, downloadUrl } = useAnalysisStatus(jobId);
+  const {
+    status,
+    downloadUrl,
+    llmObservations: polledObservations,
+  } = useAnalysisStatus(jobId);
 
   // Show toast when download is ready
   useEffect(() => {
@@ -83,7 +87,7 @@ export function MainContent() {
         </div>
       </div>
       {/* Key Observations */}
-      <KeyObservations data={llmObservations} />
+      <KeyObservations data={llmObservations ?? polledObservations} />
       {/* Footer Links */}
       <div className="flex justify-end space-x-6 text-sm text-muted-foreground pt-6 border-t">
         <a href="#" className="hover:text-foreground transition-colors">
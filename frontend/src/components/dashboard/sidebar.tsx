@@ -378,7 +378,7 @@ export function Sidebar() {
               <div className="space-y-3">
                 <Input
                   type="file"
-                  accept=".csv"
+                  accept=".csv,.gz,.zst,.parquet,.feather"
                   onChange={handleFileChangeWrapper}
                   className="file:mr-4 file:py-2 file:px-4 file:rounded-md file:border-0 file:text-sm file:font-medium file:bg-primary file:text-primary-foreground hover:file:bg-primary/90"
                 />
@@ -123,10 +123,15 @@ export function useAnalysisStatus(jobId: string | null) {
     "processing" | "ready" | "failed" | null
   >(null);
   const [downloadUrl, setDownloadUrl] = useState<string | null>(null);
+  // LLM insights are generated after the analysis response and arrive here
+  const [llmObservations, setLlmObservations] = useState<string[] | null>(
+    null
+  );
   const intervalRef = useRef<NodeJS.Timeout | null>(null);
 
   useEffect(() => {
     if (!jobId) return;
+    setLlmObservations(null);
 
     const fetchStatus = async () => {
       try {
@@ -142,7 +147,10 @@ export function useAnalysisStatus(jobId: string | null) {
           setStatus(null);
         }
         setDownloadUrl(data.download_url);
-        if (data.status === "ready") {
+        if (data.llm_observations) {
+          setLlmObservations(data.llm_observations);
+        }
+        if (data.status === "ready" && data.llm_status !== "pending") {
           if (intervalRef.current) clearInterval(intervalRef.current);
         }
       } catch (err) {
@@ -162,5 +170,5 @@ export function useAnalysisStatus(jobId: string | null) {
   }, [jobId]);
   console.log(status, downloadUrl);
 
-  return { status, downloadUrl };
+  return { status, downloadUrl, llmObservations };
 }
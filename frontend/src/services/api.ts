@@ -136,7 +136,12 @@ export const uploadService = {
     filename?: string;
     dbUrl?: string;
     table?: string;
-  }): Promise<{ tables: string[]; columns: string[] }> => {
+  }): Promise<{
+    tables: string[];
+    columns: string[];
+    // Columns ranked as likely user ID / timestamp / revenue (uploaded files only)
+    candidates?: Record<"user_id" | "timestamp" | "revenue", string[]>;
+  }> => {
     const search = new URLSearchParams();
     if (params.filename) search.append("filename", params.filename);
     if (params.dbUrl) search.append("db_url", params.dbUrl);
@@ -146,13 +151,19 @@ export const uploadService = {
     return {
       tables: res.data.tables || [],
       columns: res.data.columns || [],
+      candidates: res.data.candidates,
     };
   },
 };
 
 export const fetchAnalysisStatus = async (
   jobId: string
-): Promise<{ status: string; download_url: string }> => {
+): Promise<{
+  status: string;
+  download_url: string;
+  llm_status?: "disabled" | "pending" | "ready" | "failed" | null;
+  llm_observations?: string[] | null;
+}> => {
   const res = await apiClient.get(`/analysis-status?job_id=${jobId}`);
-  return res.data; // { status, download_url }
+  return res.data; // { status, download_url, llm_status, llm_observations }
 };